@@ -27,3 +27,6 @@ from .base import BibliotecaSAT
 from .clientelocal import ClienteSATLocal
 from .clientelocal import ClienteVfpeLocal
 from .clientesathub import ClienteSATHub
+from .clientelocalasync import ClienteSATLocalAsync
+from .clientelocalasync import ClienteVfpeLocalAsync
+from .roteador import RoteadorSAT
@@ -19,89 +19,475 @@
 
 import collections
 import ctypes
+import logging
 import os
 import random
+import threading
 import time
-import xmltodict
 
-from ctypes import c_int
-from ctypes import c_char_p
+from concurrent.futures import Future
 
 from satcomum import constantes
-from xml import render_xml, sanitize_response
-from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler
+from .xml import Chunks, iter_bytes, render_parts, sanitize_response
+from .integrador import OBSERVAR_AUTOMATICO
+from .integrador import SINCRONIZAR_NUNCA
+from .integrador import DespachanteIntegrador
+from .integrador import publicar_arquivo
+from .integrador import relogio
+from . import coordenacao
+from .transporte import FUNCTION_PROTOTYPES
+from .transporte import Transporte
+from .transporte import nome_operacao
 
 
-class MonitorIntegrador(PatternMatchingEventHandler):
-    patterns = ["*.xml"]
+logger = logging.getLogger('satcfe')
 
-    def __init__(self, observer):
-        super(MonitorIntegrador, self).__init__()
-        self.observer = observer
 
-    def process(self, event):
-        """ Realiza o processamento dos arquivos criados e modificados dentro da pasta de output do integrador
+TEMPO_LIMITE = 10
+"""Tempo limite padrão (em segundos) para aguardar a resposta do Integrador."""
 
-        E ao ler o arquivo notifica o observador do numero identificador do arquivo e seu caminho.
 
-        :param event:
-                event_type = None
+class Prazo(collections.namedtuple('Prazo',
+        'tempo_limite tentativas espera fator')):
+    """Regras de espera para uma operação do Integrador.
 
-                    The type of the event as a string.
+    :param float tempo_limite: Tempo máximo, em segundos, para aguardar a
+        resposta de cada tentativa.
 
-                is_directory = False
+    :param int tentativas: Quantas vezes a remessa será reenviada, com o
+        mesmo número identificador, caso o tempo limite se esgote. Deve ser
+        zero para operações que não podem ser repetidas com segurança, como
+        ``EnviarDadosVenda``.
 
-                    True if event was emitted for a directory; False otherwise.
+    :param float espera: Tempo, em segundos, aguardado antes do primeiro
+        reenvio.
 
-                src_path[source]
+    :param float fator: Fator de multiplicação da espera a cada novo reenvio.
 
-                    Source path of the file system object that triggered this event.
+    .. sourcecode:: python
+
+        >>> prazo = Prazo(3, tentativas=2, espera=0.5)
+        >>> [prazo.espera_antes(n) for n in (1, 2)]
+        [0.5, 1.0]
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, tempo_limite=TEMPO_LIMITE, tentativas=0, espera=0.5,
+                fator=2.0):
+        return super(Prazo, cls).__new__(
+                cls, tempo_limite, tentativas, espera, fator)
+
+
+    def espera_antes(self, tentativa):
+        """Tempo de espera antes da tentativa indicada (a primeira tentativa
+        é a de número zero e não aguarda).
+        """
+        if tentativa < 1:
+            return 0
+        return self.espera * (self.fator ** (tentativa - 1))
+
+
+def como_prazo(valor):
+    """Converte um tempo limite, em segundos, em um :class:`Prazo` sem
+    reenvios. Instâncias de :class:`Prazo` são retornadas sem alteração.
+    """
+    if isinstance(valor, Prazo):
+        return valor
+    return Prazo(tempo_limite=valor)
+
+
+class PoliticaPrazos(object):
+    """Determina o :class:`Prazo` de cada operação do Integrador, permitindo
+    que consultas rápidas (``ConsultarSAT``) falhem cedo enquanto operações
+    fiscais e de manutenção (``EnviarDadosVenda``, ``AtualizarSoftwareSAT``,
+    ``ExtrairLogs``) tenham mais tempo para concluir.
+
+    .. sourcecode:: python
+
+        >>> politica = PoliticaPrazos(ExtrairLogs=Prazo(600))
+        >>> politica.prazo('ConsultarSAT.xml').tempo_limite
+        3
+        >>> politica.prazo('ExtrairLogs.xml').tempo_limite
+        600
+        >>> politica.prazo('OperacaoDesconhecida.xml') == politica.padrao
+        True
 
-        :return:
+    :param padrao: Opcional. O :class:`Prazo` das operações sem regra
+        específica. Se não informado, será utilizado :attr:`TEMPO_LIMITE`,
+        sem reenvios.
+
+    :param prazos: Regras específicas, por nome da operação (o nome do
+        template, sem a extensão), que complementam ou substituem as regras
+        de :attr:`PRAZOS`.
+    """
+
+    PRAZOS = {
+            'ConsultarSAT': Prazo(3, tentativas=2, espera=0.5),
+            'ConsultarStatusOperacional': Prazo(5, tentativas=1),
+            'ConsultarNumeroSessao': Prazo(5, tentativas=1),
+            'VerificarStatusValidador': Prazo(5, tentativas=1),
+            'EnviarDadosVenda': Prazo(30),
+            'CancelarUltimaVenda': Prazo(30),
+            'TesteFimAFim': Prazo(30),
+            'EnviarPagamento': Prazo(30),
+            'AtivarSAT': Prazo(60),
+            'ExtrairLogs': Prazo(120),
+            'AtualizarSoftwareSAT': Prazo(300),
+        }
+    """Regras padrão, por operação."""
+
+    def __init__(self, padrao=None, **prazos):
+        self._padrao = como_prazo(padrao or TEMPO_LIMITE)
+        self._prazos = {}
+        for operacao, prazo in self.PRAZOS.items():
+            self._prazos[operacao.lower()] = prazo
+        for operacao, prazo in prazos.items():
+            self._prazos[operacao.lower()] = como_prazo(prazo)
+
+
+    @classmethod
+    def uniforme(cls, tempo_limite):
+        """Uma política que aplica o mesmo tempo limite a todas as operações,
+        sem reenvios.
         """
-        with open(event.src_path, 'r') as xml_source:
-            xml_string = xml_source.read()
-            parsed = xmltodict.parse(xml_string)
-            self.observer.src_path = event.src_path
-            self.observer.resposta = \
-                parsed.get('Integrador', {}).get('Resposta', {}).get('retorno') or \
-                parsed.get('Integrador', {}).get('Resposta', {}).get('IdPagamento') or \
-                parsed.get('Integrador', {}).get('Resposta', {})
-            if not isinstance(self.observer.resposta, dict):
-                self.observer.resposta += '|' + parsed.get('Integrador', {}).get('Identificador', {}).get('Valor')
-            self.observer.numero_identificador = parsed.get('Integrador', {}).get('Identificador', {}).get('Valor')
-
-    def on_modified(self, event):
-        self.process(event)
-
-    def on_created(self, event):
-        self.process(event)
-
-
-class _Prototype(object):
-    def __init__(self, argtypes, restype=c_char_p):
-        self.argtypes = argtypes
-        self.restype = restype
-
-
-FUNCTION_PROTOTYPES = dict(
-        AtivarSAT=_Prototype([c_int, c_int, c_char_p, c_char_p, c_int]),
-        ComunicarCertificadoICPBRASIL=_Prototype([c_int, c_char_p, c_char_p]),
-        EnviarDadosVenda=_Prototype([c_int, c_char_p, c_char_p]),
-        CancelarUltimaVenda=_Prototype([c_int, c_char_p, c_char_p, c_char_p]),
-        ConsultarSAT=_Prototype([c_int,]),
-        TesteFimAFim=_Prototype([c_int, c_char_p, c_char_p]),
-        ConsultarStatusOperacional=_Prototype([c_int, c_char_p]),
-        ConsultarNumeroSessao=_Prototype([c_int, c_char_p, c_int]),
-        ConfigurarInterfaceDeRede=_Prototype([c_int, c_char_p, c_char_p]),
-        AssociarAssinatura=_Prototype([c_int, c_char_p, c_char_p, c_char_p]),
-        AtualizarSoftwareSAT=_Prototype([c_int, c_char_p]),
-        ExtrairLogs=_Prototype([c_int, c_char_p]),
-        BloquearSAT=_Prototype([c_int, c_char_p]),
-        DesbloquearSAT=_Prototype([c_int, c_char_p]),
-        TrocarCodigoDeAtivacao=_Prototype([c_int, c_char_p, c_int, c_char_p, c_char_p])
-    )
+        politica = cls(padrao=tempo_limite)
+        politica._prazos.clear()
+        return politica
+
+
+    @property
+    def padrao(self):
+        return self._padrao
+
+
+    def prazo(self, template):
+        """Obtém o :class:`Prazo` da operação.
+
+        :param str template: Nome do template da remessa (por exemplo,
+            ``'ConsultarSAT.xml'``) ou o nome da operação.
+        """
+        return self._prazos.get(nome_operacao(template).lower(), self._padrao)
+
+
+def _medir(biblioteca, fase, inicio):
+    metricas = biblioteca.metricas
+    if metricas is not None:
+        metricas.registrar(fase, relogio() - inicio)
+
+
+def _medir_fila(biblioteca, pendente):
+    # separa a espera na fila do Integrador do tempo de processamento; se a
+    # resposta chegar antes que o consumo seja notado, considera o último
+    # momento em que a remessa foi vista na pasta de input
+    metricas = biblioteca.metricas
+    if metricas is not None and pendente.enviada_em is not None \
+            and not pendente.parada:
+        consumida_em = pendente.consumida_em or pendente.vista_em or \
+                pendente.enviada_em
+        metricas.registrar('queue', consumida_em - pendente.enviada_em)
+        metricas.registrar('process', relogio() - consumida_em)
+
+
+MENSAGEM_ERRO_INTERNO = 'Erro interno'
+"""Mensagem da resposta produzida quando o Integrador não responde."""
+
+
+def resposta_erro_interno(numero_identificador):
+    """Resposta produzida quando o Integrador não responde a uma remessa dentro
+    do tempo limite.
+    """
+    return str(numero_identificador)+'|'+str(numero_identificador)+'|'+'0'+'|'+MENSAGEM_ERRO_INTERNO+'|'+'0'+'|'+'ERRO'
+
+
+def enviar_remessa(biblioteca, caminho_templates, template,
+                   numero_identificador, **kwargs):
+    """Registra a remessa no despachante da biblioteca e a escreve na pasta de
+    *input* do Integrador, sem aguardar pela resposta. A remessa é renderizada
+    em memória, diretamente no documento final (veja
+    :func:`~mfecfe.xml.render_parts`), exceto pelos valores
+    :class:`~mfecfe.xml.Chunks`, como o CF-e de uma venda grande, que são
+    produzidos aos poucos enquanto a remessa é publicada atomicamente (veja
+    :func:`~mfecfe.integrador.publicar_arquivo`). O consumo da remessa pelo
+    Integrador passa a ser acompanhado (veja
+    :class:`~mfecfe.integrador.VigiaConsumo`).
+
+    :param biblioteca: Uma instância de :class:`BibliotecaSAT`.
+
+    :param str caminho_templates: Caminho para a pasta de templates.
+
+    :param str template: Nome do template da remessa.
+
+    :param numero_identificador: Número identificador da remessa.
+
+    :return: A resposta pendente, que deverá ser descartada do despachante
+        (:meth:`~mfecfe.integrador.DespachanteIntegrador.descartar`) assim que
+        não for mais aguardada.
+    :rtype: mfecfe.integrador.RespostaPendente
+    """
+    inicio = relogio()
+    kwargs['numero_identificador'] = numero_identificador
+    path_file = biblioteca.caminho+'input/' + str(numero_identificador) + '-' + template.lower()
+    partes = render_parts(caminho_templates, template, **kwargs)
+    _medir(biblioteca, 'render', inicio)
+
+    inicio = relogio()
+    despachante = biblioteca.despachante
+    pendente = despachante.registrar(numero_identificador)
+    try:
+        publicar_arquivo(path_file, iter_bytes(partes), biblioteca.sincronizar)
+    except:
+        despachante.descartar(pendente)
+        raise
+    _medir(biblioteca, 'write', inicio)
+    despachante.acompanhar(pendente, path_file)
+    pendente.adicionar_callback(lambda p: _medir_fila(biblioteca, p))
+    return pendente
+
+
+def _aguardar_vaga(agendador, template, tempo_limite):
+    # aguarda por uma vaga na janela do agendador; None se o tempo se esgotar
+    concedida = threading.Event()
+    vaga = agendador.solicitar(template, lambda vaga: concedida.set())
+    if concedida.wait(tempo_limite) or not agendador.cancelar(vaga):
+        return vaga
+    return None
+
+
+def comando_integrador(biblioteca, caminho_templates, template,
+                       numero_identificador, prazo, **kwargs):
+    """Escreve a remessa na pasta de *input* do Integrador e aguarda pela
+    resposta, que será entregue pelo despachante da biblioteca assim que
+    aparecer na pasta de *output*. Os argumentos são os mesmos de
+    :func:`enviar_remessa`, mais o prazo.
+
+    :param prazo: Um :class:`Prazo` ou o tempo máximo de espera, em segundos.
+        Se o tempo limite se esgotar e o prazo permitir, a remessa é
+        reenviada com o mesmo número identificador, de modo que a resposta
+        de qualquer das tentativas é aceita. O tempo em que a remessa
+        aguarda por uma vaga no agendador do despachante (veja
+        :class:`~mfecfe.integrador.AgendadorRemessas`) faz parte do tempo
+        limite.
+
+    :return: Retorna *verbatim* a resposta do Integrador ou uma resposta de
+        erro interno, caso o tempo limite se esgote. Neste caso, a resposta
+        poderá ser encontrada mais tarde através de
+        :attr:`~mfecfe.integrador.DespachanteIntegrador.respostas_tardias`.
+    """
+    prazo = como_prazo(prazo)
+    despachante = biblioteca.despachante
+    agendador = despachante.agendador
+    inicio = time.time()
+    for tentativa in range(prazo.tentativas + 1):
+        if tentativa:
+            time.sleep(prazo.espera_antes(tentativa))
+            tardia = despachante.respostas_tardias.por_identificador(
+                    numero_identificador, desde=inicio)
+            if tardia is not None:
+                # a resposta de uma tentativa anterior chegou durante a espera
+                return tardia.resposta
+        limite = relogio() + prazo.tempo_limite
+        vaga = _aguardar_vaga(agendador, template, prazo.tempo_limite)
+        if vaga is None:
+            # a fila do agendador nao andou dentro do tempo limite
+            continue
+        try:
+            pendente = enviar_remessa(biblioteca, caminho_templates, template,
+                                      numero_identificador, **kwargs)
+            inicio_espera = relogio()
+            try:
+                if pendente.aguardar(max(0, limite - inicio_espera)):
+                    _medir(biblioteca, 'wait', inicio_espera)
+                    return pendente.resposta
+                # Ao nao encontrar um arquivo de retorno com o mesmo numero identificador
+                despachante.expirar(pendente)
+                if pendente.entregue:
+                    return pendente.resposta
+            finally:
+                despachante.descartar(pendente)
+        finally:
+            agendador.liberar(vaga)
+    return resposta_erro_interno(numero_identificador)
+
+
+def comando_integrador_nowait(biblioteca, caminho_templates, template,
+                              numero_identificador, prazo, **kwargs):
+    """Escreve a remessa na pasta de *input* do Integrador sem aguardar pela
+    resposta. Os argumentos são os mesmos de :func:`comando_integrador`. A
+    espera por uma vaga no agendador e os reenvios previstos no prazo são
+    agendados no vigia de prazos do despachante, sem bloquear nenhuma
+    *thread*.
+
+    :return: Um :class:`~concurrent.futures.Future` que resultará na resposta
+        *verbatim* do Integrador ou em uma resposta de erro interno, caso o
+        tempo limite se esgote. Cancelar o ``Future`` descarta a remessa do
+        despachante.
+    :rtype: concurrent.futures.Future
+    """
+    prazo = como_prazo(prazo)
+    despachante = biblioteca.despachante
+    agendador = despachante.agendador
+    vigia = despachante.vigia
+    futuro = Future()
+    lock = threading.Lock()
+    estado = dict(tentativa=0, concluido=False,
+                  pendente=None, agendamento=None, vaga=None)
+    inicio = time.time()
+
+    def _devolver(vaga):
+        # cancela a solicitação ainda na fila ou libera a vaga concedida
+        if vaga is not None and not agendador.cancelar(vaga):
+            agendador.liberar(vaga)
+
+    def _atual(tentativa):
+        return estado['tentativa'] == tentativa and not estado['concluido']
+
+    def _concluir(resposta=None, erro=None):
+        # a resposta, o prazo e o cancelamento podem concorrer entre si
+        with lock:
+            if estado['concluido']:
+                return
+            estado['concluido'] = True
+            pendente, agendamento = estado['pendente'], estado['agendamento']
+            vaga, estado['vaga'] = estado['vaga'], None
+        if agendamento is not None:
+            vigia.cancelar(agendamento)
+        if pendente is not None:
+            despachante.descartar(pendente)
+        _devolver(vaga)
+        if futuro.set_running_or_notify_cancel():
+            if erro is not None:
+                futuro.set_exception(erro)
+            else:
+                futuro.set_result(resposta)
+
+    def _tentar():
+        # o prazo de cada tentativa inclui a espera por uma vaga
+        with lock:
+            if estado['concluido']:
+                return
+            tentativa = estado['tentativa']
+            estado['agendamento'] = vigia.agendar(prazo.tempo_limite, _expirar)
+        vaga = agendador.solicitar(template,
+                lambda vaga: _iniciar(vaga, tentativa))
+        with lock:
+            atual = _atual(tentativa)
+            if atual and estado['vaga'] is None:
+                estado['vaga'] = vaga
+        if not atual:
+            _devolver(vaga)
+
+    def _iniciar(vaga, tentativa):
+        with lock:
+            atual = _atual(tentativa)
+            if atual:
+                estado['vaga'] = vaga
+        if not atual:
+            agendador.liberar(vaga)
+            return
+        try:
+            pendente = enviar_remessa(biblioteca, caminho_templates, template,
+                                      numero_identificador, **kwargs)
+        except Exception as erro:
+            _concluir(erro=erro)
+            return
+        with lock:
+            atual = _atual(tentativa)
+            if atual:
+                estado['pendente'] = pendente
+        if not atual:
+            despachante.descartar(pendente)
+            return
+        inicio = relogio()
+
+        def _entregue(p):
+            _medir(biblioteca, 'wait', inicio)
+            _concluir(p.resposta)
+
+        pendente.adicionar_callback(_entregue)
+
+    def _reenviar():
+        tardia = despachante.respostas_tardias.por_identificador(
+                numero_identificador, desde=inicio)
+        if tardia is not None:
+            _concluir(tardia.resposta)
+            return
+        _tentar()
+
+    def _expirar():
+        with lock:
+            if estado['concluido']:
+                return
+            pendente = estado['pendente']
+        if pendente is not None:
+            despachante.expirar(pendente)
+            if pendente.entregue:
+                _concluir(pendente.resposta)
+                return
+        with lock:
+            if estado['concluido']:
+                return
+            estado['tentativa'] += 1
+            tentativa = estado['tentativa']
+            estado['pendente'] = None
+            vaga, estado['vaga'] = estado['vaga'], None
+            reenviar = tentativa <= prazo.tentativas
+            if reenviar:
+                estado['agendamento'] = vigia.agendar(
+                        prazo.espera_antes(tentativa), _reenviar)
+        _devolver(vaga)
+        if not reenviar:
+            _concluir(resposta_erro_interno(numero_identificador))
+
+    _tentar()
+    futuro.add_done_callback(lambda f: f.cancelled() and _concluir())
+    return futuro
+
+
+class TransporteIntegrador(Transporte):
+    """Transporte padrão, através da troca de arquivos com o Integrador
+    Fiscal (veja :func:`comando_integrador`).
+
+    :param biblioteca: Uma instância de :class:`BibliotecaSAT`.
+
+    :param str caminho_templates: Caminho para a pasta de templates.
+    """
+
+    DOCUMENTOS_EM_PARTES = True
+
+    def __init__(self, biblioteca, caminho_templates):
+        super(TransporteIntegrador, self).__init__()
+        self._biblioteca = biblioteca
+        self._caminho_templates = caminho_templates
+
+
+    @property
+    def biblioteca(self):
+        return self._biblioteca
+
+
+    @property
+    def caminho_templates(self):
+        return self._caminho_templates
+
+
+    def comando(self, template, numero_identificador, prazo, **kwargs):
+        return comando_integrador(self._biblioteca, self._caminho_templates,
+                                  template, numero_identificador, prazo,
+                                  **kwargs)
+
+
+    def comando_nowait(self, template, numero_identificador, prazo, **kwargs):
+        return comando_integrador_nowait(self._biblioteca,
+                                         self._caminho_templates, template,
+                                         numero_identificador, prazo,
+                                         **kwargs)
+
+
+def _politica_padrao(tempo_limite):
+    if tempo_limite:
+        return PoliticaPrazos.uniforme(tempo_limite)
+    return PoliticaPrazos()
 
 
 class BibliotecaSAT(object):
@@ -120,12 +506,86 @@ class BibliotecaSAT(object):
         extensões ``.DLL`` ou ``.dll``. Quaisquer outras extensões, assume a
         convenção de chamada :attr:`~satcomum.constantes.STANDARD_C`.
 
+    :param int sincronizar: Opcional. Política de sincronização (``fsync``)
+        dos arquivos de remessa escritos na pasta de *input* do Integrador,
+        devendo ser uma das constantes
+        :attr:`~mfecfe.integrador.SINCRONIZAR_NUNCA` (padrão),
+        :attr:`~mfecfe.integrador.SINCRONIZAR_ARQUIVO` ou
+        :attr:`~mfecfe.integrador.SINCRONIZAR_DIRETORIO`.
+
+    :param metricas: Opcional. Um objeto com o método
+        ``registrar(fase, segundos)`` que receberá a duração de cada fase dos
+        comandos: ``render``, ``write``, ``queue`` (espera até que o
+        Integrador consuma a remessa), ``process`` e ``wait`` (veja
+        :class:`mfecfe.benchmark.Metricas`).
+
+    :param int observacao: Opcional. Como a pasta de *output* do Integrador é
+        observada, devendo ser uma das constantes
+        :attr:`~mfecfe.integrador.OBSERVAR_AUTOMATICO` (padrão),
+        :attr:`~mfecfe.integrador.OBSERVAR_EVENTOS` ou
+        :attr:`~mfecfe.integrador.OBSERVAR_VARREDURA`. Pastas montadas de um
+        compartilhamento de rede (CIFS, por exemplo) não produzem eventos e,
+        no modo automático, são varridas periodicamente.
+
+    :param int janela: Opcional. Quantidade máxima de remessas em andamento
+        no equipamento. As demais aguardam em uma fila ordenada por
+        prioridade (veja :class:`~mfecfe.integrador.AgendadorRemessas`). Se
+        ``None`` (padrão), as remessas são escritas imediatamente.
+
+    :param bool coordenar: Opcional. Se vários processos desta máquina
+        compartilham a pasta do Integrador, coordena-os (veja
+        :mod:`mfecfe.coordenacao`): apenas um deles observa a pasta de
+        *output*, a janela de remessas vale para todos e os números
+        identificadores são únicos entre eles.
+
+    :param float prazo_consumo: Opcional. Prazo, em segundos, para que o
+        Integrador consuma as remessas antes de ser considerado parado (veja
+        :class:`~mfecfe.integrador.VigiaConsumo`). Se ``None`` (padrão), a
+        detecção de Integrador parado não é ativada.
+
     """
 
-    def __init__(self, caminho, convencao=None):
+    def __init__(self, caminho, convencao=None, sincronizar=SINCRONIZAR_NUNCA,
+                 metricas=None, observacao=OBSERVAR_AUTOMATICO, janela=None,
+                 coordenar=False, prazo_consumo=None):
         self._libsat = None
         self._caminho = self.limpa_formatacao_caminho_integrador(caminho)
         self._convencao = convencao
+        self._sincronizar = sincronizar
+        self._coordenador = None
+        if coordenar and coordenacao.disponivel():
+            self._coordenador = coordenacao.CoordenadorIntegrador(
+                    self._caminho, NumeroSessaoMemoria())
+        elif coordenar:
+            logger.warning('Coordenacao entre processos indisponivel nesta '
+                           'plataforma')
+        self._despachante = DespachanteIntegrador(self._caminho + 'output',
+                observacao=observacao, prazo_consumo=prazo_consumo,
+                janela=janela, coordenador=self._coordenador,
+                medir_consumo=metricas is not None)
+        self._metricas = metricas
+
+    @property
+    def metricas(self):
+        """Coletor das métricas das remessas ou ``None``. O consumo das
+        remessas só é acompanhado na pasta de *input* se houver um coletor ou
+        um prazo de consumo.
+        """
+        return self._metricas
+
+    @metricas.setter
+    def metricas(self, metricas):
+        self._metricas = metricas
+        self._despachante.consumo.medir = metricas is not None
+
+    @property
+    def numerador_sessao(self):
+        """Numerador de sessão compartilhado entre os processos coordenados
+        ou ``None``, se a biblioteca não for coordenada.
+        """
+        if self._coordenador is None:
+            return None
+        return self._coordenador.numero
 
     @property
     def ref(self):
@@ -146,6 +606,21 @@ class BibliotecaSAT(object):
         """
         return self._convencao
 
+
+    @property
+    def sincronizar(self):
+        """Política de sincronização dos arquivos de remessa."""
+        return self._sincronizar
+
+
+    @property
+    def despachante(self):
+        """O :class:`~mfecfe.integrador.DespachanteIntegrador` que observa a
+        pasta de *output* do Integrador. É compartilhado por todos os clientes
+        que utilizarem esta biblioteca.
+        """
+        return self._despachante
+
     def limpa_formatacao_caminho_integrador(self, caminho):
         if caminho[0] != '/':
             caminho = '/' + caminho
@@ -159,7 +634,8 @@ class NumeroSessaoMemoria(object):
     """Implementa um numerador de sessão simples, baseado em memória, não
     persistente, que irá gerar um número de sessão (seis dígitos) diferente
     entre os ``n`` últimos números de sessão gerados. Conforme a ER SAT, um
-    número de sessão não poderá ser igual aos últimos ``100`` números.
+    número de sessão não poderá ser igual aos últimos ``100`` números. O
+    numerador pode ser compartilhado entre *threads*.
 
     .. sourcecode:: python
 
@@ -185,6 +661,7 @@ class NumeroSessaoMemoria(object):
         super(NumeroSessaoMemoria, self).__init__()
         self._tamanho = tamanho
         self._memoria = collections.deque(maxlen=tamanho)
+        self._lock = threading.Lock()
 
 
     def __contains__(self, item):
@@ -192,11 +669,12 @@ class NumeroSessaoMemoria(object):
 
 
     def __call__(self, *args, **kwargs):
-        while True:
-            numero = random.randint(100000, 999999)
-            if numero not in self._memoria:
-                self._memoria.append(numero)
-                break
+        with self._lock:
+            while True:
+                numero = random.randint(100000, 999999)
+                if numero not in self._memoria:
+                    self._memoria.append(numero)
+                    break
         return numero
 
 
@@ -254,13 +732,42 @@ class FuncoesSAT(object):
         Equipamento SAT", da ER SAT. Se não for especificado, será utilizado
         um :class:`NumeroSessaoMemoria`.
 
+    :param float tempo_limite: Opcional. Tempo máximo, em segundos, para
+        aguardar a resposta do Integrador em qualquer operação, sem reenvios.
+        Ignorado se uma política for informada.
+
+    :param politica: Opcional. Uma :class:`PoliticaPrazos` que determina o
+        prazo de cada operação. Se não for especificada (e nem o tempo
+        limite), serão utilizadas as regras de :attr:`PoliticaPrazos.PRAZOS`.
+        O prazo também pode ser sobreposto a cada invocação de
+        :meth:`comando_sat`.
+
+    :param transporte: Opcional. O :class:`~mfecfe.transporte.Transporte`
+        através do qual os comandos são entregues. Se não for especificado,
+        será utilizado um :class:`TransporteIntegrador` sobre a biblioteca,
+        que pode ser ``None`` caso um transporte seja informado.
+
+    .. note::
+
+        Uma mesma instância pode ser usada por várias *threads* ao mesmo
+        tempo. Cada comando é correlacionado à sua resposta exclusivamente
+        pelo número identificador da remessa, de modo que vários comandos
+        podem estar em andamento simultaneamente, limitados apenas pela
+        capacidade de processamento do Integrador.
+
     """
 
-    def __init__(self, biblioteca, codigo_ativacao=None, numerador_sessao=None):
+    def __init__(self, biblioteca, codigo_ativacao=None, numerador_sessao=None,
+                 tempo_limite=None, politica=None, transporte=None):
         self._biblioteca = biblioteca
         self._codigo_ativacao = codigo_ativacao
-        self._numerador_sessao = numerador_sessao or NumeroSessaoMemoria()
+        self._numerador_sessao = numerador_sessao or \
+                getattr(biblioteca, 'numerador_sessao', None) or \
+                NumeroSessaoMemoria()
+        self._politica = politica or _politica_padrao(tempo_limite)
         self._path = os.path.join(os.path.dirname(__file__), 'templates')
+        self._transporte = transporte or \
+                TransporteIntegrador(biblioteca, self._path)
 
 
     @property
@@ -273,6 +780,29 @@ class FuncoesSAT(object):
         return self._codigo_ativacao
 
 
+    @property
+    def politica(self):
+        return self._politica
+
+
+    @property
+    def transporte(self):
+        return self._transporte
+
+
+    def prazo(self, template, tempo_limite=None, prazo=None):
+        """Determina o :class:`Prazo` de uma invocação. Um prazo informado
+        tem precedência sobre o tempo limite, que por sua vez substitui
+        apenas o tempo limite da regra da política para a operação.
+        """
+        if prazo is not None:
+            return como_prazo(prazo)
+        regra = self._politica.prazo(template)
+        if tempo_limite:
+            return regra._replace(tempo_limite=tempo_limite)
+        return regra
+
+
     def gerar_numero_sessao(self):
         """Gera o número de sessão para a próxima invocação de função SAT."""
         return self._numerador_sessao()
@@ -288,54 +818,34 @@ class FuncoesSAT(object):
         raise AttributeError('{!r} object has no attribute {!r}'.format(
                 self.__class__.__name__, name))
 
-    def comando_sat(self, template, **kwargs):
-        if kwargs['consulta']['numero_identificador'] != 'False':
-            numero_identificador = kwargs.get(
+    def obter_numero_identificador(self, **kwargs):
+        """Determina o número identificador da remessa a partir dos argumentos
+        do comando, gerando um novo número se nenhum for informado.
+        """
+        if kwargs['consulta'].get('numero_identificador', 'False') != 'False':
+            return kwargs.get(
                 'numero_sessao',
                 kwargs['consulta']['numero_identificador'],
             )
-        else:
-            numero_identificador = kwargs.get(
-                'numero_sessao',
-                self.gerar_numero_sessao(),
-            )
-
-        kwargs['numero_identificador'] = numero_identificador
-        path_file = self.biblioteca.caminho+'input/' + str(numero_identificador) + '-' + template.lower()
-        # remove arquivo se ele existir
-        if os.path.isfile(path_file):
-            os.remove(path_file)
-
-        observer = Observer()
-        observer.numero_identificador = False
-        observer.src_path = False
-        observer.schedule(MonitorIntegrador(observer), path=self.biblioteca.caminho+'output')
-        observer.start()
-
-        xml = render_xml(self._path, template, True, **kwargs)
-        xml.write(
-            path_file,
-            xml_declaration=True,
-            encoding='UTF-8'
+        return kwargs.get(
+            'numero_sessao',
+            self.gerar_numero_sessao(),
         )
 
-        cont_time = 0
-        while True:
-            # Analisa a pasta a cada um segundo.
-            # entra10 vezes e sai da verificacao
-            time.sleep(1)
-            cont_time = cont_time + 1
-            if (str(numero_identificador) == str(observer.numero_identificador) and \
-                observer.src_path):
-                # Ao encontrar um arquivo de retorno com o mesmo numero identificador da remessa sai do loop.
-                break
-            if  cont_time == 10:
-                observer.resposta = str(numero_identificador)+'|'+str(numero_identificador)+'|'+'0'+'|'+'Erro interno'+'|'+'0'+'|'+'ERRO'
-                # Ao nao encontrar um arquivo de retorno com o mesmo numero identificador
-                break
-        observer.stop()
-        observer.join()
-        return observer.resposta
+    def _documento(self, entidade):
+        # o XML da entidade é produzido aos poucos se o transporte aceitar,
+        # evitando manter em memória o CF-e inteiro de uma venda grande
+        if isinstance(entidade, basestring):
+            return entidade
+        if getattr(self._transporte, 'DOCUMENTOS_EM_PARTES', False) and \
+                hasattr(entidade, 'iterar_documento'):
+            return Chunks(entidade.iterar_documento)
+        return entidade.documento()
+
+    def comando_sat(self, template, tempo_limite=None, prazo=None, **kwargs):
+        numero_identificador = self.obter_numero_identificador(**kwargs)
+        return self._transporte.comando(template, numero_identificador,
+                self.prazo(template, tempo_limite, prazo), **kwargs)
 
 
     def ativar_sat(self, tipo_certificado, cnpj, codigo_uf):
@@ -390,7 +900,7 @@ class FuncoesSAT(object):
         }
         return self.comando_sat('ComunicarCertificadoICPBRASIL.xml', consulta=consulta)
 
-    def enviar_dados_venda(self, dados_venda, numero_identificador):
+    def enviar_dados_venda(self, dados_venda, numero_identificador='False'):
         """Função ``EnviarDadosVenda`` conforme ER SAT, item 6.1.3. Envia o
         CF-e de venda para o equipamento SAT, que o enviará para autorização
         pela SEFAZ.
@@ -401,9 +911,7 @@ class FuncoesSAT(object):
         :return: Retorna *verbatim* a resposta da função SAT.
         :rtype: string
         """
-        cfe_venda = dados_venda \
-            if isinstance(dados_venda, basestring) \
-            else dados_venda.documento()
+        cfe_venda = self._documento(dados_venda)
         if isinstance(self._numerador_sessao, basestring):
             numero_sessao = self._numerador_sessao
         else:
@@ -468,9 +976,7 @@ class FuncoesSAT(object):
         :return: Retorna *verbatim* a resposta da função SAT.
         :rtype: string
         """
-        cfe_venda = dados_venda \
-            if isinstance(dados_venda, basestring) \
-            else dados_venda.documento()
+        cfe_venda = self._documento(dados_venda)
 
         consulta = {
             'numero_sessao': self.gerar_numero_sessao(),
@@ -672,12 +1178,31 @@ class FuncoesSAT(object):
         return self.comando_sat('TrocarCodigoDeAtivacao.xml', consulta=consulta)
 
 
+class FuncoesSATNowait(FuncoesSAT):
+    """Variante de :class:`FuncoesSAT` cujos métodos não aguardam pela resposta
+    do Integrador. Cada método resulta em um
+    :class:`~concurrent.futures.Future` que será concluído com a resposta
+    *verbatim* assim que ela for encontrada na pasta de *output*.
+    """
+
+    def comando_sat(self, template, tempo_limite=None, prazo=None, **kwargs):
+        numero_identificador = self.obter_numero_identificador(**kwargs)
+        return self._transporte.comando_nowait(template, numero_identificador,
+                self.prazo(template, tempo_limite, prazo), **kwargs)
+
+
 class FuncoesVFPE(object):
-    def __init__(self, biblioteca, chave_acesso_validador=None, numerador_sessao=None):
+    def __init__(self, biblioteca, chave_acesso_validador=None, numerador_sessao=None,
+                 tempo_limite=None, politica=None, transporte=None):
         self._biblioteca = biblioteca
         self._chave_acesso_validador = chave_acesso_validador
-        self._numerador_sessao = numerador_sessao or NumeroSessaoMemoria()
+        self._numerador_sessao = numerador_sessao or \
+                getattr(biblioteca, 'numerador_sessao', None) or \
+                NumeroSessaoMemoria()
+        self._politica = politica or _politica_padrao(tempo_limite)
         self._path = os.path.join(os.path.dirname(__file__), 'templates/')
+        self._transporte = transporte or \
+                TransporteIntegrador(biblioteca, self._path)
 
 
     @property
@@ -693,6 +1218,28 @@ class FuncoesVFPE(object):
         return self._chave_acesso_validador
 
 
+    @property
+    def politica(self):
+        return self._politica
+
+
+    @property
+    def transporte(self):
+        return self._transporte
+
+
+    def prazo(self, template, tempo_limite=None, prazo=None):
+        """Determina o :class:`Prazo` de uma invocação, da mesma forma que
+        :meth:`FuncoesSAT.prazo`.
+        """
+        if prazo is not None:
+            return como_prazo(prazo)
+        regra = self._politica.prazo(template)
+        if tempo_limite:
+            return regra._replace(tempo_limite=tempo_limite)
+        return regra
+
+
     def __getattr__(self, name):
         if name.startswith('invocar__'):
             metodo_vfpe = name.replace('invocar__', '')
@@ -704,54 +1251,29 @@ class FuncoesVFPE(object):
         raise AttributeError('{!r} object has no attribute {!r}'.format(
                 self.__class__.__name__, name))
 
-    def comando_vfpe(self, template, **kwargs):
-        if kwargs['numero_identificador'] != 'False':
-            numero_identificador = kwargs.get(
+    def obter_numero_identificador(self, **kwargs):
+        """Determina o número identificador da remessa a partir dos argumentos
+        do comando, gerando um novo número se nenhum for informado.
+
+        A ausência do argumento ``numero_identificador`` equivale a
+        ``'False'`` (um novo número é gerado) e não resulta em
+        :exc:`KeyError`, pois as funções desta classe não o informam.
+        """
+        if kwargs.get('numero_identificador', 'False') != 'False':
+            return kwargs.get(
                 'numero_sessao',
                 kwargs['numero_identificador'],
             )
-        else:
-            numero_identificador = kwargs.get(
-                'numero_sessao',
-                self.gerar_numero_sessao(),
-            )
-
-        kwargs['numero_identificador'] = numero_identificador
-        path_file = self.biblioteca.caminho+'input/' + str(numero_identificador) + '-' + template.lower()
-        # remove arquivo se ele existir
-        if os.path.isfile(path_file):
-            os.remove(path_file)
-
-        observer = Observer()
-        observer.numero_identificador = False
-        observer.src_path = False
-        observer.schedule(MonitorIntegrador(observer), path=self.biblioteca.caminho+'output')
-        observer.start()
-
-        xml = render_xml(self._path, template, True, **kwargs)
-        xml.write(
-            path_file,
-            xml_declaration=True,
-            encoding='UTF-8'
+        return kwargs.get(
+            'numero_sessao',
+            self.gerar_numero_sessao(),
         )
 
-        cont_time = 0
-        while True:
-            # Analisa a pasta a cada um segundo.
-            # entra10 vezes e sai da verificacao
-            time.sleep(1)
-            cont_time = cont_time + 1
-            if (str(numero_identificador) == str(observer.numero_identificador) and \
-                observer.src_path):
-                # Ao encontrar um arquivo de retorno com o mesmo numero identificador da remessa sai do loop.
-                break
-            if  cont_time == 10:
-                observer.resposta = str(numero_identificador)+'|'+str(numero_identificador)+'|'+'0'+'|'+'Erro interno'+'|'+'0'+'|'+'ERRO'
-                # Ao nao encontrar um arquivo de retorno com o mesmo numero identificador
-                break
-        observer.stop()
-        observer.join()
-        return observer.resposta
+    def comando_vfpe(self, template, tempo_limite=None, prazo=None, **kwargs):
+        numero_identificador = self.obter_numero_identificador(**kwargs)
+        kwargs.pop('numero_identificador', None)
+        return self._transporte.comando(template, numero_identificador,
+                self.prazo(template, tempo_limite, prazo), **kwargs)
 
     def verificar_status_validador(self, cpnj, id_fila):
         """Função ``VerificarStatusValidador`` conforme ER SAT, item 6.1.14. Desbloqueio
@@ -848,3 +1370,16 @@ class FuncoesVFPE(object):
         }
         return self.comando_vfpe("RespostaFiscal.xml", consulta=consulta)
 
+
+class FuncoesVFPENowait(FuncoesVFPE):
+    """Variante de :class:`FuncoesVFPE` cujos métodos não aguardam pela
+    resposta do Integrador. Cada método resulta em um
+    :class:`~concurrent.futures.Future` que será concluído com a resposta
+    *verbatim* assim que ela for encontrada na pasta de *output*.
+    """
+
+    def comando_vfpe(self, template, tempo_limite=None, prazo=None, **kwargs):
+        numero_identificador = self.obter_numero_identificador(**kwargs)
+        kwargs.pop('numero_identificador', None)
+        return self._transporte.comando_nowait(template, numero_identificador,
+                self.prazo(template, tempo_limite, prazo), **kwargs)
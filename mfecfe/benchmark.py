@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/benchmark.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Mede a vazão (operações por segundo) e a latência dos clientes locais sobre o
+Integrador, por padrão contra o :mod:`~mfecfe.simulador`, detalhando a
+duração de cada fase dos comandos:
+
+* ``render``: renderização da remessa;
+* ``write``: registro no despachante e publicação na pasta de *input*;
+* ``queue``: espera até que o Integrador consuma a remessa;
+* ``process``: processamento, do consumo da remessa até a resposta;
+* ``wait``: espera pela resposta na pasta de *output* (``queue`` mais
+  ``process``);
+* ``parse``: análise da resposta *verbatim*;
+* ``total``: a operação completa, do ponto de vista de quem a invoca.
+
+.. sourcecode:: shell
+
+    $ python -m mfecfe.benchmark --operacoes 500 --simultaneas 8 \\
+            --latencia 0.02 --saida resultado.json
+
+O resultado é gravado em JSON, para que execuções de diferentes versões
+possam ser comparadas.
+
+Com ``--poda``, mede apenas a remoção dos elementos vazios de vendas com as
+quantidades de itens informadas, comparando :func:`~mfecfe.xml.prune_empty`
+com a remoção anterior, que verificava a subárvore de cada elemento através
+de :func:`~mfecfe.xml.recursively_empty`:
+
+.. sourcecode:: shell
+
+    $ python -m mfecfe.benchmark --poda 1000 5000 20000
+"""
+
+import argparse
+import collections
+import copy
+import json
+import platform
+import shutil
+import tempfile
+import threading
+
+from datetime import datetime
+
+from lxml import etree
+
+import mfecfe
+
+from .base import BibliotecaSAT
+from .base import relogio
+from .integrador import OBSERVAR_AUTOMATICO
+from .integrador import OBSERVAR_EVENTOS
+from .integrador import OBSERVAR_INOTIFY
+from .integrador import OBSERVAR_VARREDURA
+from .clientelocal import ClienteSATLocal
+from .clientelocal import ClienteVfpeLocal
+from .resposta import RespostaEnviarDadosVenda
+from .resposta import RespostaSAT
+from .simulador import SimuladorIntegrador
+from .xml import prune_empty
+from .xml import recursively_empty
+from .xml import warm_up
+
+
+FASES = ('render', 'write', 'queue', 'process', 'wait', 'parse', 'total')
+
+PERCENTIS = (50, 95, 99)
+
+VENDA = (
+        u'<CFe><infCFe versaoDadosEnt="0.07">'
+        u'<ide><CNPJ>16716114000172</CNPJ><signAC>SGR-SAT SISTEMA DE GESTAO '
+        u'E RETAGUARDA DO SAT</signAC><numeroCaixa>1</numeroCaixa></ide>'
+        u'<emit><CNPJ>08723218000186</CNPJ><IE>149626224113</IE>'
+        u'<IM>123123</IM><cRegTribISSQN>3</cRegTribISSQN>'
+        u'<indRatISSQN>N</indRatISSQN></emit>'
+        u'<dest><CPF>11122233396</CPF><xNome>Joao de Teste</xNome></dest>'
+        u'{itens}'
+        u'<total/><pgto><MP><cMP>01</cMP><vMP>{total}</vMP></MP></pgto>'
+        u'</infCFe></CFe>')
+
+ITEM = (
+        u'<det nItem="{n}"><prod><cProd>{n:06d}</cProd>'
+        u'<xProd>Produto de teste {n}</xProd><NCM>84719000</NCM>'
+        u'<CFOP>5102</CFOP><uCom>UN</uCom><qCom>1.0000</qCom>'
+        u'<vUnCom>1.50</vUnCom><indRegra>A</indRegra></prod>'
+        u'<imposto><ICMS><ICMSSN102><Orig>2</Orig><CSOSN>500</CSOSN>'
+        u'</ICMSSN102></ICMS><PIS><PISSN><CST>49</CST></PISSN></PIS>'
+        u'<COFINS><COFINSSN><CST>49</CST></COFINSSN></COFINS></imposto></det>')
+
+
+def dados_venda(itens=10):
+    """Produz o XML de uma venda de teste com a quantidade de itens
+    informada.
+    """
+    return VENDA.format(
+            itens=u''.join(ITEM.format(n=n) for n in range(1, itens + 1)),
+            total='{:.2f}'.format(itens * 1.5))
+
+
+def poda_anterior(arvore):
+    """A remoção dos elementos vazios anterior a
+    :func:`~mfecfe.xml.prune_empty`, mantida apenas para comparação.
+    """
+    for dummy, elem in etree.iterwalk(arvore):
+        parent = elem.getparent()
+        if parent is not None and recursively_empty(elem):
+            parent.remove(elem)
+
+
+def _melhor_duracao(poda, venda, repeticoes):
+    melhor = None
+    for _ in range(repeticoes):
+        arvore = copy.deepcopy(venda)
+        inicio = relogio()
+        poda(arvore)
+        duracao = relogio() - inicio
+        melhor = duracao if melhor is None else min(melhor, duracao)
+    return melhor, arvore
+
+
+def medir_poda(itens, repeticoes=5):
+    """Mede a remoção dos elementos vazios de uma venda com a quantidade de
+    itens informada, em que cada item possui elementos vazios (inclusive
+    aninhados), como ocorre com os campos opcionais não preenchidos. A
+    remoção de :func:`~mfecfe.xml.prune_empty` e a de :func:`poda_anterior`
+    são medidas sobre cópias da mesma venda, e devem produzir o mesmo
+    documento.
+
+    :return: A quantidade de elementos e a melhor duração de cada remoção, em
+        milissegundos, total e por mil elementos.
+    :rtype: dict
+    """
+    venda = etree.fromstring(dados_venda(itens))
+    for det in venda.iter('det'):
+        etree.SubElement(det.find('prod'), 'obsFiscoDet')
+        issqn = etree.SubElement(det.find('imposto'), 'ISSQN')
+        etree.SubElement(etree.SubElement(issqn, 'vDeducISSQN'), 'cNatOp')
+        etree.SubElement(det, 'infAdProd')
+    elementos = sum(1 for _ in venda.iter())
+    anterior, esperado = _melhor_duracao(poda_anterior, venda, repeticoes)
+    melhor, arvore = _melhor_duracao(prune_empty, venda, repeticoes)
+    if etree.tostring(arvore) != etree.tostring(esperado):
+        raise AssertionError('As remocoes produziram documentos diferentes')
+    return collections.OrderedDict((
+            ('itens', itens),
+            ('elementos', elementos),
+            ('ms_anterior', 1000 * anterior),
+            ('ms', 1000 * melhor),
+            ('ms_por_mil_elementos_anterior',
+                    1000 * anterior * 1000 / elementos),
+            ('ms_por_mil_elementos', 1000 * melhor * 1000 / elementos),
+        ))
+
+
+def percentil(valores, p):
+    """Percentil pelo método do posto mais próximo, sobre valores ordenados.
+
+    .. sourcecode:: python
+
+        >>> percentil([1, 2, 3, 4], 50)
+        2
+        >>> percentil([1, 2, 3, 4], 99)
+        4
+        >>> percentil([], 50) is None
+        True
+    """
+    if not valores:
+        return None
+    posto = max(0, int(-(-p * len(valores) // 100)) - 1)
+    return valores[min(posto, len(valores) - 1)]
+
+
+class Metricas(object):
+    """Acumula a duração, em segundos, de cada fase dos comandos. Pode ser
+    informado como ``metricas`` de uma :class:`~mfecfe.base.BibliotecaSAT`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._duracoes = collections.defaultdict(list)
+
+
+    def registrar(self, fase, segundos):
+        with self._lock:
+            self._duracoes[fase].append(segundos)
+
+
+    def resumo(self):
+        """Resume as durações, em milissegundos, de cada fase.
+
+        :rtype: dict
+        """
+        resumo = collections.OrderedDict()
+        with self._lock:
+            duracoes = dict((f, sorted(v)) for f, v in self._duracoes.items())
+        for fase in FASES + tuple(sorted(set(duracoes) - set(FASES))):
+            valores = duracoes.get(fase)
+            if not valores:
+                continue
+            estatisticas = collections.OrderedDict()
+            estatisticas['n'] = len(valores)
+            estatisticas['media'] = 1000 * sum(valores) / len(valores)
+            for p in PERCENTIS:
+                estatisticas['p{}'.format(p)] = 1000 * percentil(valores, p)
+            estatisticas['max'] = 1000 * valores[-1]
+            resumo[fase] = estatisticas
+        return resumo
+
+
+def _operacao_venda(itens):
+    venda = dados_venda(itens)
+
+    def _vender(cliente):
+        retorno = super(ClienteSATLocal, cliente).enviar_dados_venda(venda)
+        return RespostaEnviarDadosVenda.analisar, retorno
+
+    return ClienteSATLocal, _vender
+
+
+def _operacao_consulta(itens):
+
+    def _consultar(cliente):
+        retorno = super(ClienteSATLocal, cliente).consultar_sat()
+        return RespostaSAT.consultar_sat, retorno
+
+    return ClienteSATLocal, _consultar
+
+
+def _operacao_vfpe(itens):
+
+    def _verificar(cliente):
+        retorno = super(ClienteVfpeLocal, cliente).verificar_status_validador(
+                '08723218000186', 1)
+        return RespostaEnviarDadosVenda.analisarVFPE, retorno
+
+    return ClienteVfpeLocal, _verificar
+
+
+OBSERVACOES = collections.OrderedDict((
+        ('automatico', OBSERVAR_AUTOMATICO),
+        ('eventos', OBSERVAR_EVENTOS),
+        ('varredura', OBSERVAR_VARREDURA),
+        ('inotify', OBSERVAR_INOTIFY),
+    ))
+
+
+OPERACOES = collections.OrderedDict((
+        ('venda', _operacao_venda),
+        ('consulta', _operacao_consulta),
+        ('vfpe', _operacao_vfpe),
+    ))
+
+
+def executar(caminho, operacao='venda', operacoes=200, simultaneas=4,
+             itens=10, tempo_limite=30, observacao='automatico', janela=None):
+    """Executa o *benchmark* contra o Integrador (ou o simulador) em
+    ``caminho``.
+
+    :param str operacao: Uma das chaves de :attr:`OPERACOES`.
+
+    :param int operacoes: Quantidade total de operações.
+
+    :param int simultaneas: Quantidade de *threads* invocando operações.
+
+    :param int itens: Quantidade de itens de cada venda.
+
+    :param str observacao: Como a pasta de *output* é observada, uma das
+        chaves de :attr:`OBSERVACOES`.
+
+    :param int janela: Opcional. Quantidade máxima de remessas em andamento
+        (veja :class:`~mfecfe.integrador.AgendadorRemessas`).
+
+    Os templates são compilados antes da primeira operação (veja
+    :func:`~mfecfe.xml.warm_up`), de modo que a fase ``render`` mede apenas
+    a renderização.
+
+    :return: O resultado, pronto para ser gravado como JSON.
+    :rtype: dict
+    """
+    warm_up()
+    metricas = Metricas()
+    biblioteca = BibliotecaSAT(caminho, metricas=metricas,
+            observacao=OBSERVACOES[observacao], janela=janela)
+    classe, invocar = OPERACOES[operacao](itens)
+    cliente = classe(biblioteca, tempo_limite=tempo_limite)
+    restantes = [operacoes]
+    erros = collections.Counter()
+    lock = threading.Lock()
+
+    def _trabalhar():
+        while True:
+            with lock:
+                if restantes[0] <= 0:
+                    return
+                restantes[0] -= 1
+            inicio = relogio()
+            try:
+                analisar, retorno = invocar(cliente)
+                inicio_analise = relogio()
+                analisar(retorno)
+                metricas.registrar('parse', relogio() - inicio_analise)
+            except Exception as e:
+                with lock:
+                    erros[type(e).__name__] += 1
+            metricas.registrar('total', relogio() - inicio)
+
+    biblioteca.despachante.iniciar()
+    inicio = relogio()
+    threads = [threading.Thread(target=_trabalhar) for _ in range(simultaneas)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = relogio() - inicio
+    biblioteca.despachante.parar()
+
+    parametros = collections.OrderedDict((
+            ('operacao', operacao),
+            ('operacoes', operacoes),
+            ('simultaneas', simultaneas),
+            ('itens', itens),
+            ('tempo_limite', tempo_limite),
+            ('observacao', observacao),
+            ('janela', janela),
+        ))
+    resultado = collections.OrderedDict()
+    resultado['mfecfe'] = mfecfe.__version__
+    resultado['python'] = platform.python_version()
+    resultado['plataforma'] = platform.platform()
+    resultado['data'] = datetime.now().isoformat()
+    resultado['parametros'] = parametros
+    resultado['duracao'] = duracao
+    resultado['operacoes_por_segundo'] = operacoes / duracao if duracao else None
+    resultado['erros'] = dict(erros)
+    resultado['fases'] = metricas.resumo()
+    return resultado
+
+
+def formatar(resultado):
+    """Formata o resultado como uma tabela legível."""
+    linhas = ['{operacao}: {operacoes} operacoes, {simultaneas} simultaneas'
+            .format(**resultado['parametros']),
+            '{:.1f} operacoes/s em {:.2f}s, erros: {}'.format(
+                    resultado['operacoes_por_segundo'] or 0,
+                    resultado['duracao'], resultado['erros'] or 0),
+            '{:<8}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+                    'fase', 'n', 'media', 'p50', 'p95', 'p99', 'max')]
+    for fase, e in resultado['fases'].items():
+        linhas.append('{:<8}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'
+                '{:>10.2f}'.format(fase, e['n'], e['media'], e['p50'],
+                        e['p95'], e['p99'], e['max']))
+    return '\n'.join(linhas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mfecfe.benchmark',
+            description='Mede a vazao e a latencia dos clientes locais '
+                    'sobre o Integrador (em milissegundos, por fase).')
+    parser.add_argument('--operacao', choices=list(OPERACOES),
+            default='venda', help='Operacao medida (padrao: %(default)s)')
+    parser.add_argument('--operacoes', type=int, default=200,
+            help='Quantidade de operacoes (padrao: %(default)s)')
+    parser.add_argument('--simultaneas', type=int, default=4,
+            help='Operacoes simultaneas (padrao: %(default)s)')
+    parser.add_argument('--itens', type=int, default=10,
+            help='Itens por venda (padrao: %(default)s)')
+    parser.add_argument('--tempo-limite', type=float, default=30,
+            help='Tempo limite de cada operacao, em segundos')
+    parser.add_argument('--observacao', choices=list(OBSERVACOES),
+            default='automatico', help='Como a pasta de output e observada '
+                    '(padrao: %(default)s)')
+    parser.add_argument('--janela', type=int,
+            help='Quantidade maxima de remessas em andamento')
+    parser.add_argument('--caminho',
+            help='Pasta de um Integrador em execucao. Se nao informada, '
+                    'um simulador e iniciado em uma pasta temporaria')
+    parser.add_argument('--latencia', type=float, default=0.0,
+            help='Latencia do simulador, em segundos')
+    parser.add_argument('--variacao', type=float, default=0.0,
+            help='Variacao da latencia do simulador, em segundos')
+    parser.add_argument('--trabalhadores', type=int, default=1,
+            help='Trabalhadores do simulador (padrao: %(default)s)')
+    parser.add_argument('--saida',
+            help='Arquivo onde o resultado sera gravado, em JSON')
+    parser.add_argument('--poda', type=int, nargs='+', metavar='ITENS',
+            help='Mede apenas a remocao de elementos vazios de vendas com '
+                    'as quantidades de itens informadas')
+    args = parser.parse_args(argv)
+
+    if args.poda:
+        resultado = [medir_poda(itens) for itens in args.poda]
+        print('{:>8}{:>12}{:>14}{:>10}{:>16}{:>14}'.format('itens',
+                'elementos', 'ms anterior', 'ms', 'anterior/1000', 'ms/1000'))
+        for r in resultado:
+            print('{:>8}{:>12}{:>14.2f}{:>10.2f}{:>16.3f}{:>14.3f}'.format(
+                    r['itens'], r['elementos'], r['ms_anterior'], r['ms'],
+                    r['ms_por_mil_elementos_anterior'],
+                    r['ms_por_mil_elementos']))
+        if args.saida:
+            with open(args.saida, 'w') as f:
+                json.dump(resultado, f, indent=2)
+        return resultado
+
+    argumentos = dict(operacao=args.operacao, operacoes=args.operacoes,
+            simultaneas=args.simultaneas, itens=args.itens,
+            tempo_limite=args.tempo_limite, observacao=args.observacao,
+            janela=args.janela)
+
+    if args.caminho:
+        resultado = executar(args.caminho, **argumentos)
+    else:
+        simulacao = collections.OrderedDict((
+                ('latencia', args.latencia),
+                ('variacao', args.variacao),
+                ('trabalhadores', args.trabalhadores),
+            ))
+        caminho = tempfile.mkdtemp(prefix='mfecfe-benchmark-')
+        try:
+            with SimuladorIntegrador(caminho, **simulacao):
+                resultado = executar(caminho, **argumentos)
+        finally:
+            shutil.rmtree(caminho, ignore_errors=True)
+        resultado['parametros']['simulador'] = simulacao
+
+    print(formatar(resultado))
+    if args.saida:
+        with open(args.saida, 'w') as f:
+            json.dump(resultado, f, indent=2)
+    return resultado
+
+
+if __name__ == '__main__':
+    main()
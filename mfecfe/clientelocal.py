@@ -17,10 +17,18 @@
 # limitations under the License.
 #
 
+import collections
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import wait
+
 from satcomum import constantes
 
 from .base import FuncoesSAT
+from .base import FuncoesSATNowait
 from .base import FuncoesVFPE
+from .base import FuncoesVFPENowait
 
 from .resposta import RespostaAtivarSAT
 from .resposta import RespostaCancelarUltimaVenda
@@ -32,16 +40,104 @@ from .resposta import RespostaSAT
 from .resposta import RespostaTesteFimAFim
 
 
+LOTE_SIMULTANEAS = 8
+"""Quantidade padrão de vendas de um lote em andamento ao mesmo tempo."""
+
+
+ResultadoLote = collections.namedtuple('ResultadoLote',
+        'indice dados_venda resposta erro')
+"""Resultado de uma venda enviada através de
+:meth:`ClienteSATLocal.enviar_lote_vendas`. O ``indice`` é a posição da venda
+no lote. Apenas um dos atributos ``resposta`` (uma
+:class:`~satcfe.resposta.enviardadosvenda.RespostaEnviarDadosVenda`) ou
+``erro`` (a exceção ocorrida) estará preenchido.
+"""
+
+
+def analisar_quando_concluido(futuro, analisar):
+    """Resulta em um novo :class:`~concurrent.futures.Future` que será
+    concluído com o resultado de ``analisar`` aplicado à resposta *verbatim*
+    do ``futuro`` informado. Exceções lançadas pela análise (por exemplo,
+    :exc:`~satcfe.excecoes.ExcecaoRespostaSAT`) são repassadas ao novo
+    ``Future``. Cancelar o novo ``Future`` cancela o ``futuro`` original.
+    """
+    resultado = Future()
+
+    def _analisar(f):
+        if f.cancelled():
+            resultado.cancel()
+        elif resultado.set_running_or_notify_cancel():
+            try:
+                resultado.set_result(analisar(f.result()))
+            except Exception as e:
+                resultado.set_exception(e)
+
+    resultado.add_done_callback(lambda r: r.cancelled() and futuro.cancel())
+    futuro.add_done_callback(_analisar)
+    return resultado
+
+
+def enviar_lote(enviar_nowait, vendas, simultaneas=LOTE_SIMULTANEAS):
+    """Envia as vendas através de ``enviar_nowait`` (por exemplo,
+    :meth:`ClienteSATLocal.enviar_dados_venda_nowait`), mantendo no máximo
+    ``simultaneas`` vendas em andamento ao mesmo tempo.
+
+    :return: Um gerador de :class:`ResultadoLote`, na ordem em que as vendas
+        são concluídas (veja :meth:`ClienteSATLocal.enviar_lote_vendas`).
+    """
+    restantes = enumerate(vendas)
+    em_andamento = {}
+    esgotado = False
+    while True:
+        while not esgotado and len(em_andamento) < simultaneas:
+            try:
+                indice, dados_venda = next(restantes)
+            except StopIteration:
+                esgotado = True
+                break
+            try:
+                futuro = enviar_nowait(dados_venda)
+            except Exception as erro:
+                yield ResultadoLote(indice, dados_venda, None, erro)
+                continue
+            em_andamento[futuro] = (indice, dados_venda)
+
+        if not em_andamento:
+            return
+
+        concluidos, _ = wait(list(em_andamento), return_when=FIRST_COMPLETED)
+        for futuro in concluidos:
+            indice, dados_venda = em_andamento.pop(futuro)
+            erro = futuro.exception()
+            resposta = futuro.result() if erro is None else None
+            yield ResultadoLote(indice, dados_venda, resposta, erro)
+
+
 class ClienteSATLocal(FuncoesSAT):
     """Fornece acesso ao equipamento SAT conectado na máquina local.
 
     As respostas às funções SAT serão trabalhadas resultando em objetos Python
     regulares cujos atributos representam as peças de informação conforme
     descrito, função por função, na ER SAT.
+
+    Uma mesma instância pode ser compartilhada por várias *threads* (por
+    exemplo, um servidor que atende vários caixas), cada uma com seus próprios
+    comandos em andamento, correlacionados pelo número identificador.
+
+    Cada operação possui uma variante com o sufixo ``_nowait`` (por exemplo,
+    :meth:`enviar_dados_venda_nowait`) que não aguarda pela resposta,
+    resultando em um :class:`~concurrent.futures.Future` que será concluído
+    com a mesma resposta especializada da operação original. Lotes de vendas
+    podem ser enviados através de :meth:`enviar_lote_vendas`.
     """
 
     def __init__(self, *args, **kwargs):
         super(ClienteSATLocal, self).__init__(*args, **kwargs)
+        self._nowait = FuncoesSATNowait(self._biblioteca,
+                codigo_ativacao=self._codigo_ativacao,
+                numerador_sessao=self._numerador_sessao,
+                politica=self._politica,
+                transporte=self._transporte)
 
     def ativar_sat(self, tipo_certificado, cnpj, codigo_uf):
         """Sobrepõe :meth:`~satcfe.base.FuncoesSAT.ativar_sat`.
@@ -64,13 +160,14 @@ class ClienteSATLocal(FuncoesSAT):
             comunicar_certificado_icpbrasil(certificado)
         return RespostaSAT.comunicar_certificado_icpbrasil(retorno)
 
-    def enviar_dados_venda(self, dados_venda):
+    def enviar_dados_venda(self, dados_venda, numero_identificador='False'):
         """Sobrepõe :meth:`~satcfe.base.FuncoesSAT.enviar_dados_venda`.
 
         :return: Uma resposta SAT especializada em ``EnviarDadosVenda``.
         :rtype: satcfe.resposta.enviardadosvenda.RespostaEnviarDadosVenda
         """
-        retorno = super(ClienteSATLocal, self).enviar_dados_venda(dados_venda)
+        retorno = super(ClienteSATLocal, self).enviar_dados_venda(
+            dados_venda, numero_identificador)
         return RespostaEnviarDadosVenda.analisar(retorno)
 
     def cancelar_ultima_venda(self, chave_cfe, dados_cancelamento):
@@ -190,10 +287,199 @@ class ClienteSATLocal(FuncoesSAT):
             codigo_emergencia=codigo_emergencia)
         return RespostaSAT.trocar_codigo_de_ativacao(retorno)
 
+    def ativar_sat_nowait(self, tipo_certificado, cnpj, codigo_uf):
+        """Variante de :meth:`ativar_sat` que não aguarda pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.ativar_sat(tipo_certificado, cnpj, codigo_uf),
+            RespostaAtivarSAT.analisar)
+
+    def comunicar_certificado_icpbrasil_nowait(self, certificado):
+        """Variante de :meth:`comunicar_certificado_icpbrasil` que não aguarda
+        pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.comunicar_certificado_icpbrasil(certificado),
+            RespostaSAT.comunicar_certificado_icpbrasil)
+
+    def enviar_dados_venda_nowait(self, dados_venda,
+                                  numero_identificador='False'):
+        """Variante de :meth:`enviar_dados_venda` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.enviar_dados_venda(dados_venda, numero_identificador),
+            RespostaEnviarDadosVenda.analisar)
+
+    def enviar_lote_vendas(self, vendas, simultaneas=LOTE_SIMULTANEAS):
+        """Envia um lote de vendas (por exemplo, as vendas acumuladas durante
+        uma indisponibilidade do Integrador), mantendo no máximo
+        ``simultaneas`` vendas em andamento ao mesmo tempo. Novas vendas são
+        escritas na pasta de *input* à medida que as anteriores são
+        respondidas, de modo que o tempo total é limitado pelo equipamento e
+        não pela espera de cada venda.
+
+        .. sourcecode:: python
+
+            for resultado in cliente.enviar_lote_vendas(vendas):
+                if resultado.erro is not None:
+                    reprocessar(vendas[resultado.indice], resultado.erro)
+
+        :param vendas: Um iterável de vendas, como as aceitas por
+            :meth:`enviar_dados_venda`. O iterável é consumido apenas à
+            medida que há espaço para novas vendas em andamento.
+
+        :param int simultaneas: Quantidade máxima de vendas em andamento.
+
+        :return: Um gerador de :class:`ResultadoLote`, na ordem em que as
+            vendas são concluídas (que não é, necessariamente, a ordem do
+            lote). Erros de uma venda não interrompem o lote. Se o gerador
+            for abandonado, as vendas já enviadas não são canceladas.
+        """
+        return enviar_lote(self.enviar_dados_venda_nowait, vendas,
+                           simultaneas=simultaneas)
+
+    def cancelar_ultima_venda_nowait(self, chave_cfe, dados_cancelamento):
+        """Variante de :meth:`cancelar_ultima_venda` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.cancelar_ultima_venda(chave_cfe, dados_cancelamento),
+            RespostaCancelarUltimaVenda.analisar)
+
+    def consultar_sat_nowait(self):
+        """Variante de :meth:`consultar_sat` que não aguarda pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.consultar_sat(),
+            RespostaSAT.consultar_sat)
+
+    def teste_fim_a_fim_nowait(self, dados_venda):
+        """Variante de :meth:`teste_fim_a_fim` que não aguarda pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.teste_fim_a_fim(dados_venda),
+            RespostaTesteFimAFim.analisar)
+
+    def consultar_status_operacional_nowait(self):
+        """Variante de :meth:`consultar_status_operacional` que não aguarda
+        pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.consultar_status_operacional(),
+            RespostaConsultarStatusOperacional.analisar)
+
+    def consultar_numero_sessao_nowait(self, numero_sessao):
+        """Variante de :meth:`consultar_numero_sessao` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.consultar_numero_sessao(numero_sessao),
+            RespostaConsultarNumeroSessao.analisar)
+
+    def configurar_interface_de_rede_nowait(self, configuracao):
+        """Variante de :meth:`configurar_interface_de_rede` que não aguarda
+        pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.configurar_interface_de_rede(configuracao),
+            RespostaSAT.configurar_interface_de_rede)
+
+    def associar_assinatura_nowait(self, sequencia_cnpj, assinatura_ac):
+        """Variante de :meth:`associar_assinatura` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.associar_assinatura(sequencia_cnpj, assinatura_ac),
+            RespostaSAT.associar_assinatura)
+
+    def atualizar_software_sat_nowait(self):
+        """Variante de :meth:`atualizar_software_sat` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.atualizar_software_sat(),
+            RespostaSAT.atualizar_software_sat)
+
+    def extrair_logs_nowait(self):
+        """Variante de :meth:`extrair_logs` que não aguarda pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.extrair_logs(),
+            RespostaExtrairLogs.analisar)
+
+    def bloquear_sat_nowait(self):
+        """Variante de :meth:`bloquear_sat` que não aguarda pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.bloquear_sat(),
+            RespostaSAT.bloquear_sat)
+
+    def desbloquear_sat_nowait(self):
+        """Variante de :meth:`desbloquear_sat` que não aguarda pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.desbloquear_sat(),
+            RespostaSAT.desbloquear_sat)
+
+    def trocar_codigo_de_ativacao_nowait(self, novo_codigo_ativacao,
+                                         opcao=constantes.CODIGO_ATIVACAO_REGULAR,
+                                         codigo_emergencia=None):
+        """Variante de :meth:`trocar_codigo_de_ativacao` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.trocar_codigo_de_ativacao(
+                novo_codigo_ativacao, opcao=opcao,
+                codigo_emergencia=codigo_emergencia),
+            RespostaSAT.trocar_codigo_de_ativacao)
+
+
 
 class ClienteVfpeLocal(FuncoesVFPE):
+    """Fornece acesso às funções do Validador Fiscal (VFP-e) através do
+    Integrador. Assim como em :class:`ClienteSATLocal`, cada operação possui
+    uma variante com o sufixo ``_nowait`` que resulta em um
+    :class:`~concurrent.futures.Future`.
+    """
+
     def __init__(self, *args, **kwargs):
         super(ClienteVfpeLocal, self).__init__(*args, **kwargs)
+        self._nowait = FuncoesVFPENowait(self._biblioteca,
+                chave_acesso_validador=self._chave_acesso_validador,
+                numerador_sessao=self._numerador_sessao,
+                politica=self._politica,
+                transporte=self._transporte)
 
     def verificar_status_validador(self, cpnj, id_fila):
         """Sobrepõe :meth:`~satcfe.base.FuncoesSAT.trocar_codigo_de_ativacao`.
@@ -241,4 +527,75 @@ class ClienteVfpeLocal(FuncoesVFPE):
         retorno = super(ClienteVfpeLocal, self). \
             resposta_fiscal(id_fila, chave_acesso, nsu, numero_aprovacao,
                             bandeira, adquirente, cnpj, impressao_fiscal,
-                            numero_documento)
\ No newline at end of file
+                            numero_documento)
+
+    def verificar_status_validador_nowait(self, cpnj, id_fila):
+        """Variante de :meth:`verificar_status_validador` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        return analisar_quando_concluido(
+            self._nowait.verificar_status_validador(cpnj, id_fila),
+            RespostaEnviarDadosVenda.analisarVFPE)
+
+    def enviar_pagamento_nowait(self, chave_requisicao, estabecimento,
+                                serial_pos, cpnj, icms_base, vr_total_venda,
+                                h_multiplos_pagamentos, h_anti_fraude,
+                                cod_moeda, origem_pagemento,
+                                numero_identificador='False'):
+        """Variante de :meth:`enviar_pagamento` que não aguarda pela resposta.
+
+        :return: Um ``Future`` que resultará na resposta *verbatim*.
+        :rtype: concurrent.futures.Future
+        """
+        return self._nowait.enviar_pagamento(
+            chave_requisicao, estabecimento, serial_pos, cpnj, icms_base,
+            vr_total_venda, h_multiplos_pagamentos, h_anti_fraude,
+            cod_moeda, origem_pagemento, numero_identificador)
+
+    def enviar_status_pagamento_nowait(self, codigo_autorizacao, bin,
+                                       dono_cartao, data_expiracao,
+                                       instituicao_financeira, parcelas,
+                                       codigo_pagamento, valor_pagamento,
+                                       id_fila, tipo, ultimos_quatro_digitos):
+        """Variante de :meth:`enviar_status_pagamento` que não aguarda pela
+        resposta.
+
+        :return: Um ``Future`` que resultará na resposta *verbatim*.
+        :rtype: concurrent.futures.Future
+        """
+        return self._nowait.enviar_status_pagamento(
+            codigo_autorizacao, bin, dono_cartao, data_expiracao,
+            instituicao_financeira, parcelas, codigo_pagamento,
+            valor_pagamento, id_fila, tipo, ultimos_quatro_digitos)
+
+    def recuperar_dados_locais_enviados_nowait(self):
+        """Variante de :meth:`recuperar_dados_locais_enviados` que não aguarda
+        pela resposta.
+
+        :return: Um ``Future`` que resultará na resposta *verbatim*.
+        :rtype: concurrent.futures.Future
+        """
+        return self._nowait.recuperar_dados_locais_enviados()
+
+    def enviar_pagamentos_armazenamento_local_nowait(self):
+        """Variante de :meth:`enviar_pagamentos_armazenamento_local` que não
+        aguarda pela resposta.
+
+        :return: Um ``Future`` que resultará na resposta *verbatim*.
+        :rtype: concurrent.futures.Future
+        """
+        return self._nowait.enviar_pagamentos_armazenamento_local()
+
+    def resposta_fiscal_nowait(self, id_fila, chave_acesso, nsu,
+                               numero_aprovacao, bandeira, adquirente, cnpj,
+                               impressao_fiscal, numero_documento):
+        """Variante de :meth:`resposta_fiscal` que não aguarda pela resposta.
+
+        :return: Um ``Future`` que resultará na resposta *verbatim*.
+        :rtype: concurrent.futures.Future
+        """
+        return self._nowait.resposta_fiscal(
+            id_fila, chave_acesso, nsu, numero_aprovacao, bandeira,
+            adquirente, cnpj, impressao_fiscal, numero_documento)
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/clientelocalasync.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Clientes assíncronos para o Integrador Fiscal. As operações são as mesmas de
+:class:`~mfecfe.clientelocal.ClienteSATLocal` e
+:class:`~mfecfe.clientelocal.ClienteVfpeLocal`, mas resultam, sem aguardar
+pela resposta, em um :class:`~concurrent.futures.Future` que será concluído
+com a mesma resposta especializada. Com um ``adaptador``, cada ``Future`` é
+entregue através dele; no Python 3, por exemplo, ``asyncio.wrap_future``
+torna as operações aguardáveis no laço de eventos:
+
+.. sourcecode:: python
+
+    cliente = ClienteSATLocalAsync(
+            BibliotecaSAT('/opt/Integrador'),
+            codigo_ativacao='12345678',
+            adaptador=asyncio.wrap_future)
+
+    resposta = await cliente.consultar_sat()
+
+A resposta é entregue pelo observador da pasta de *output* (compartilhado por
+todos os clientes da mesma :class:`~mfecfe.base.BibliotecaSAT`), de modo que
+nenhuma *thread* fica bloqueada enquanto o Integrador trabalha. A remessa é
+renderizada e escrita por um ``executor``, e não pela *thread* que invoca a
+operação, pois o CF-e de uma venda grande bloquearia, por exemplo, o laço de
+eventos.
+"""
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from satcomum import constantes
+
+from .base import FuncoesSAT
+from .base import FuncoesVFPE
+from .clientelocal import analisar_quando_concluido
+
+from .resposta import RespostaAtivarSAT
+from .resposta import RespostaCancelarUltimaVenda
+from .resposta import RespostaConsultarNumeroSessao
+from .resposta import RespostaConsultarStatusOperacional
+from .resposta import RespostaEnviarDadosVenda
+from .resposta import RespostaExtrairLogs
+from .resposta import RespostaSAT
+from .resposta import RespostaTesteFimAFim
+
+
+ESCRITORES = 4
+"""Quantidade de *threads* do ``executor`` padrão, que escrevem as remessas
+na pasta de *input*.
+"""
+
+
+def comando_em_segundo_plano(executor, transporte, template,
+                             numero_identificador, prazo, **kwargs):
+    """Entrega o comando através de
+    :meth:`~mfecfe.transporte.Transporte.comando_nowait`, invocado por uma
+    *thread* do ``executor``, sem aguardar pela resposta.
+
+    :return: Um :class:`~concurrent.futures.Future` que resultará na resposta
+        *verbatim*. Cancelar o ``Future`` cancela o comando, mesmo que ainda
+        não tenha sido entregue ao transporte.
+    :rtype: concurrent.futures.Future
+    """
+    resultado = Future()
+
+    def _copiar(futuro):
+        if futuro.cancelled():
+            resultado.cancel()
+        elif resultado.set_running_or_notify_cancel():
+            erro = futuro.exception()
+            if erro is not None:
+                resultado.set_exception(erro)
+            else:
+                resultado.set_result(futuro.result())
+
+    def _entregar():
+        if resultado.cancelled():
+            return
+        try:
+            futuro = transporte.comando_nowait(template, numero_identificador,
+                                               prazo, **kwargs)
+        except Exception as erro:
+            if resultado.set_running_or_notify_cancel():
+                resultado.set_exception(erro)
+            return
+        resultado.add_done_callback(lambda r: r.cancelled() and futuro.cancel())
+        futuro.add_done_callback(_copiar)
+
+    executor.submit(_entregar)
+    return resultado
+
+
+class _Assincrono(object):
+    # configuração comum aos clientes assíncronos
+
+    def _configurar(self, kwargs):
+        self._adaptador = kwargs.pop('adaptador', None)
+        self._executor = kwargs.pop('executor', None) or \
+                ThreadPoolExecutor(max_workers=ESCRITORES)
+
+    def _entregar(self, futuro, analisar=None):
+        if analisar is not None:
+            futuro = analisar_quando_concluido(futuro, analisar)
+        return futuro if self._adaptador is None else self._adaptador(futuro)
+
+
+class ClienteSATLocalAsync(_Assincrono, FuncoesSAT):
+    """Versão assíncrona de :class:`~mfecfe.clientelocal.ClienteSATLocal`.
+    Todos os métodos que invocam funções SAT resultam em um
+    :class:`~concurrent.futures.Future` (ou no que o ``adaptador`` produzir a
+    partir dele) concluído com as mesmas respostas especializadas.
+
+    Além dos argumentos de :class:`~mfecfe.base.FuncoesSAT`, aceita:
+
+    :param adaptador: Opcional. Um ``callable`` aplicado a cada ``Future``
+        antes de ser devolvido (por exemplo, ``asyncio.wrap_future``).
+
+    :param executor: Opcional. O :class:`~concurrent.futures.Executor` que
+        escreve as remessas. O padrão é um
+        :class:`~concurrent.futures.ThreadPoolExecutor` com
+        :data:`ESCRITORES` *threads*.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._configurar(kwargs)
+        super(ClienteSATLocalAsync, self).__init__(*args, **kwargs)
+
+    def comando_sat(self, template, tempo_limite=None, prazo=None, **kwargs):
+        numero_identificador = self.obter_numero_identificador(**kwargs)
+        return comando_em_segundo_plano(self._executor, self._transporte,
+                template, numero_identificador,
+                self.prazo(template, tempo_limite, prazo), **kwargs)
+
+    def ativar_sat(self, tipo_certificado, cnpj, codigo_uf):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.ativar_sat`.
+
+        :return: Uma resposta SAT especilizada em ``AtivarSAT``.
+        :rtype: satcfe.resposta.ativarsat.RespostaAtivarSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).ativar_sat(
+            tipo_certificado, cnpj, codigo_uf), RespostaAtivarSAT.analisar)
+
+    def comunicar_certificado_icpbrasil(self, certificado):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.comunicar_certificado_icpbrasil`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            comunicar_certificado_icpbrasil(certificado),
+            RespostaSAT.comunicar_certificado_icpbrasil)
+
+    def enviar_dados_venda(self, dados_venda, numero_identificador='False'):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.enviar_dados_venda`.
+
+        :return: Uma resposta SAT especializada em ``EnviarDadosVenda``.
+        :rtype: satcfe.resposta.enviardadosvenda.RespostaEnviarDadosVenda
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            enviar_dados_venda(dados_venda, numero_identificador),
+            RespostaEnviarDadosVenda.analisar)
+
+    def cancelar_ultima_venda(self, chave_cfe, dados_cancelamento):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.cancelar_ultima_venda`.
+
+        :return: Uma resposta SAT especializada em ``CancelarUltimaVenda``.
+        :rtype: satcfe.resposta.cancelarultimavenda.RespostaCancelarUltimaVenda
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            cancelar_ultima_venda(chave_cfe, dados_cancelamento),
+            RespostaCancelarUltimaVenda.analisar)
+
+    def consultar_sat(self):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.consultar_sat`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            consultar_sat(), RespostaSAT.consultar_sat)
+
+    def teste_fim_a_fim(self, dados_venda):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.teste_fim_a_fim`.
+
+        :return: Uma resposta SAT especializada em ``TesteFimAFim``.
+        :rtype: satcfe.resposta.testefimafim.RespostaTesteFimAFim
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            teste_fim_a_fim(dados_venda), RespostaTesteFimAFim.analisar)
+
+    def consultar_status_operacional(self):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.consultar_status_operacional`.
+
+        :return: Uma resposta SAT especializada em ``ConsultarStatusOperacional``.
+        :rtype: satcfe.resposta.consultarstatusoperacional.RespostaConsultarStatusOperacional
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            consultar_status_operacional(),
+            RespostaConsultarStatusOperacional.analisar)
+
+    def consultar_numero_sessao(self, numero_sessao):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.consultar_numero_sessao`.
+
+        :return: Uma resposta SAT que irá depender da sessão consultada.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            consultar_numero_sessao(numero_sessao),
+            RespostaConsultarNumeroSessao.analisar)
+
+    def configurar_interface_de_rede(self, configuracao):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.configurar_interface_de_rede`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            configurar_interface_de_rede(configuracao),
+            RespostaSAT.configurar_interface_de_rede)
+
+    def associar_assinatura(self, sequencia_cnpj, assinatura_ac):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.associar_assinatura`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        # (!) resposta baseada na redação com efeitos até 31-12-2016
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            associar_assinatura(sequencia_cnpj, assinatura_ac),
+            RespostaSAT.associar_assinatura)
+
+    def atualizar_software_sat(self):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.atualizar_software_sat`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            atualizar_software_sat(), RespostaSAT.atualizar_software_sat)
+
+    def extrair_logs(self):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.extrair_logs`.
+
+        :return: Uma resposta SAT especializada em ``ExtrairLogs``.
+        :rtype: satcfe.resposta.extrairlogs.RespostaExtrairLogs
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            extrair_logs(), RespostaExtrairLogs.analisar)
+
+    def bloquear_sat(self):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.bloquear_sat`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            bloquear_sat(), RespostaSAT.bloquear_sat)
+
+    def desbloquear_sat(self):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.desbloquear_sat`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            desbloquear_sat(), RespostaSAT.desbloquear_sat)
+
+    def trocar_codigo_de_ativacao(self, novo_codigo_ativacao,
+                                  opcao=constantes.CODIGO_ATIVACAO_REGULAR,
+                                  codigo_emergencia=None):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesSAT.trocar_codigo_de_ativacao`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteSATLocalAsync, self).
+            trocar_codigo_de_ativacao(novo_codigo_ativacao, opcao=opcao,
+                                      codigo_emergencia=codigo_emergencia),
+            RespostaSAT.trocar_codigo_de_ativacao)
+
+
+class ClienteVfpeLocalAsync(_Assincrono, FuncoesVFPE):
+    """Versão assíncrona de :class:`~mfecfe.clientelocal.ClienteVfpeLocal`.
+    Aceita os mesmos ``adaptador`` e ``executor`` de
+    :class:`ClienteSATLocalAsync`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._configurar(kwargs)
+        super(ClienteVfpeLocalAsync, self).__init__(*args, **kwargs)
+
+    def comando_vfpe(self, template, tempo_limite=None, prazo=None, **kwargs):
+        numero_identificador = self.obter_numero_identificador(**kwargs)
+        kwargs.pop('numero_identificador', None)
+        return comando_em_segundo_plano(self._executor, self._transporte,
+                template, numero_identificador,
+                self.prazo(template, tempo_limite, prazo), **kwargs)
+
+    def verificar_status_validador(self, cpnj, id_fila):
+        """Sobrepõe :meth:`~mfecfe.base.FuncoesVFPE.verificar_status_validador`.
+
+        :return: Uma resposta SAT padrão.
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._entregar(super(ClienteVfpeLocalAsync, self).
+            verificar_status_validador(cpnj, id_fila),
+            RespostaEnviarDadosVenda.analisarVFPE)
+
+    def enviar_pagamento(self, chave_requisicao, estabecimento, serial_pos,
+                         cpnj, icms_base, vr_total_venda,
+                         h_multiplos_pagamentos, h_anti_fraude, cod_moeda,
+                         origem_pagemento, numero_identificador):
+        return self._entregar(super(ClienteVfpeLocalAsync, self).
+            enviar_pagamento(chave_requisicao, estabecimento, serial_pos,
+                             cpnj, icms_base, vr_total_venda,
+                             h_multiplos_pagamentos, h_anti_fraude,
+                             cod_moeda, origem_pagemento,
+                             numero_identificador))
+
+    def enviar_status_pagamento(self, codigo_autorizacao, bin, dono_cartao,
+                                data_expiracao, instituicao_financeira,
+                                parcelas, codigo_pagamento, valor_pagamento,
+                                id_fila, tipo, ultimos_quatro_digitos):
+        return self._entregar(super(ClienteVfpeLocalAsync, self).
+            enviar_status_pagamento(codigo_autorizacao, bin, dono_cartao,
+                                    data_expiracao, instituicao_financeira,
+                                    parcelas, codigo_pagamento,
+                                    valor_pagamento, id_fila, tipo,
+                                    ultimos_quatro_digitos))
+
+    def recuperar_dados_locais_enviados(self):
+        return self._entregar(super(ClienteVfpeLocalAsync, self).
+            recuperar_dados_locais_enviados())
+
+    def enviar_pagamentos_armazenamento_local(self):
+        return self._entregar(super(ClienteVfpeLocalAsync, self).
+            enviar_pagamentos_armazenamento_local())
+
+    def resposta_fiscal(self, id_fila, chave_acesso, nsu, numero_aprovacao,
+                        bandeira, adquirente, cnpj, impressao_fiscal,
+                        numero_documento):
+        return self._entregar(super(ClienteVfpeLocalAsync, self).
+            resposta_fiscal(id_fila, chave_acesso, nsu, numero_aprovacao,
+                            bandeira, adquirente, cnpj, impressao_fiscal,
+                            numero_documento))
@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/coordenacao.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Coordena vários processos da mesma máquina que compartilham a mesma pasta do
+Integrador (veja ``coordenar`` em :class:`~mfecfe.base.BibliotecaSAT`).
+
+Um único processo, o *dono*, escolhido através de um *lock* de arquivo
+(``flock``), observa a pasta de *output* e atende os demais processos através
+de um *socket* local (``AF_UNIX``):
+
+* cada resposta é analisada uma única vez, pelo dono, e encaminhada ao
+  processo que aguarda pelo seu número identificador;
+* as vagas do :class:`~mfecfe.integrador.AgendadorRemessas` do dono são
+  compartilhadas por todos os processos, de modo que a janela de remessas em
+  andamento vale para o equipamento inteiro;
+* os números identificadores são gerados pelo numerador do dono, evitando
+  que dois processos usem o mesmo número ao mesmo tempo.
+
+Se o dono terminar, um dos demais processos obtém o *lock* e assume o seu
+lugar. As mensagens trocadas são objetos JSON, um por linha.
+
+O *lock* e o *socket* ficam, por padrão, em uma pasta do usuário, acessível
+apenas por ele, dentro do diretório temporário do sistema (veja
+:func:`diretorio_privado`). Assim, apenas processos do mesmo usuário são
+coordenados entre si.
+"""
+
+import collections
+import errno
+import hashlib
+import itertools
+import json
+import logging
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .excecoes import ErroCoordenacao
+
+
+logger = logging.getLogger('satcfe')
+
+
+TEMPO_LIMITE_CHAMADA = 2.0
+"""Tempo máximo, em segundos, para que o dono responda a uma chamada."""
+
+TEMPO_LIMITE_ELEICAO = 5.0
+"""Tempo máximo, em segundos, para que este processo se torne o dono ou se
+conecte ao dono atual.
+"""
+
+
+def disponivel():
+    """Indica se a coordenação entre processos está disponível nesta
+    plataforma (requer ``flock`` e *sockets* ``AF_UNIX``).
+    """
+    return fcntl is not None and hasattr(socket, 'AF_UNIX')
+
+
+def diretorio_privado():
+    """Obtém (criando, se necessário) a pasta do usuário atual para o *lock*
+    e o *socket* da coordenação, com permissão ``0700``, dentro do diretório
+    temporário do sistema.
+
+    :raises ErroCoordenacao: Se a pasta existir mas pertencer a outro
+        usuário, não for uma pasta ou puder ser acessada por outros usuários.
+    """
+    diretorio = os.path.join(tempfile.gettempdir(),
+            'mfecfe-{}'.format(os.getuid()))
+    try:
+        os.mkdir(diretorio, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(diretorio)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+            stat.S_IMODE(info.st_mode) & 0o077:
+        raise ErroCoordenacao('Pasta de coordenacao insegura: {}'.format(
+                diretorio))
+    return diretorio
+
+
+class _Conexao(object):
+    # uma conexão do socket local, com escrita protegida por um lock
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def enviar(self, **mensagem):
+        dados = (json.dumps(mensagem) + '\n').encode('utf-8')
+        try:
+            with self._lock:
+                self.sock.sendall(dados)
+        except (IOError, OSError, socket.error):
+            return False
+        return True
+
+    def mensagens(self):
+        arquivo = self.sock.makefile('rb')
+        try:
+            for linha in arquivo:
+                try:
+                    yield json.loads(linha.decode('utf-8'))
+                except ValueError:
+                    logger.warning('Mensagem invalida: %r', linha)
+        except (IOError, OSError, socket.error):
+            return
+        finally:
+            arquivo.close()
+
+    def fechar(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError, socket.error):
+            pass
+        self.sock.close()
+
+
+class VagaRemota(object):
+    """Uma solicitação de vaga feita ao agendador do processo dono."""
+
+    def __init__(self, sequencia, template, iniciar):
+        self.sequencia = sequencia
+        self.template = template
+        self.iniciar = iniciar
+        self.iniciada = False
+        self.cancelada = False
+        self.liberada = False
+
+
+class AgendadorRemoto(object):
+    """Mesma interface de :class:`~mfecfe.integrador.AgendadorRemessas`,
+    solicitando as vagas ao agendador do processo dono.
+    """
+
+    def __init__(self, coordenador):
+        self._coordenador = coordenador
+        self._vagas = {}
+        self._lock = threading.Lock()
+
+
+    def solicitar(self, template, iniciar):
+        vaga = VagaRemota(self._coordenador.sequencia(), template, iniciar)
+        with self._lock:
+            self._vagas[vaga.sequencia] = vaga
+        if not self._coordenador.enviar(op='vaga', seq=vaga.sequencia,
+                template=template):
+            # sem conexão com o dono: a remessa segue sem aguardar
+            self.conceder(vaga.sequencia)
+        return vaga
+
+
+    def cancelar(self, vaga):
+        with self._lock:
+            if vaga.iniciada:
+                return False
+            vaga.cancelada = True
+            self._vagas.pop(vaga.sequencia, None)
+        # se a vaga já tiver sido concedida, o dono a libera
+        self._coordenador.enviar(op='cancelar', seq=vaga.sequencia)
+        return True
+
+
+    def liberar(self, vaga):
+        with self._lock:
+            if not vaga.iniciada or vaga.liberada:
+                return
+            vaga.liberada = True
+        self._coordenador.enviar(op='liberar', seq=vaga.sequencia)
+
+
+    def conceder(self, sequencia):
+        with self._lock:
+            vaga = self._vagas.pop(sequencia, None)
+            if vaga is None or vaga.cancelada:
+                return
+            vaga.iniciada = True
+        try:
+            vaga.iniciar(vaga)
+        except Exception:
+            logger.exception('Falha ao iniciar remessa agendada')
+
+
+    def reenviar(self):
+        """Solicita novamente ao (novo) dono as vagas ainda não concedidas.
+        As vagas concedidas pelo dono anterior são consideradas liberadas.
+        """
+        with self._lock:
+            pendentes = sorted(self._vagas)
+        for sequencia in pendentes:
+            vaga = self._vagas.get(sequencia)
+            if vaga is not None and not self._coordenador.enviar(op='vaga',
+                    seq=sequencia, template=vaga.template):
+                self.conceder(sequencia)
+
+
+class CoordenadorIntegrador(object):
+    """Coordena os processos que compartilham a pasta do Integrador no
+    caminho informado. Os arquivos de *lock* e o *socket* ficam em
+    ``diretorio`` e são nomeados a partir do caminho completo do Integrador.
+
+    :param str caminho: Caminho da pasta do Integrador.
+
+    :param numerador: Um ``callable`` que gera números identificadores
+        únicos, usado enquanto este processo for o dono.
+
+    :param str diretorio: Opcional. Diretório do *lock* e do *socket*. O
+        padrão é a pasta do usuário obtida por :func:`diretorio_privado`.
+    """
+
+    MEMORIA_INTERESSADOS = 10000
+    """Quantidade máxima de números identificadores aguardados por outros
+    processos, dos quais o dono se lembra.
+    """
+
+    def __init__(self, caminho, numerador, diretorio=None):
+        caminho = os.path.realpath(caminho)
+        if not isinstance(caminho, bytes):
+            caminho = caminho.encode('utf-8')
+        chave = hashlib.sha1(caminho)
+        base = os.path.join(diretorio or diretorio_privado(),
+                'mfecfe-{}'.format(chave.hexdigest()[:16]))
+        self._caminho_lock = base + '.lock'
+        self._caminho_socket = base + '.sock'
+        self._numerador = numerador
+        self._despachante = None
+        self._iniciado = False
+        self._dono = False
+        self._parar = False
+        self._fd_lock = None
+        self._servidor = None
+        self._conexoes = set()
+        self._interessados = collections.OrderedDict()
+        self._conexao = None
+        self._chamadas = {}
+        self._sequencia = itertools.count(1)
+        self._agendador_remoto = AgendadorRemoto(self)
+        self._lock = threading.RLock()
+
+
+    @property
+    def dono(self):
+        """Indica se este processo observa a pasta de *output*."""
+        return self._dono
+
+
+    def sequencia(self):
+        return next(self._sequencia)
+
+
+    def iniciar(self, despachante):
+        """Inicia a coordenação, se ainda não iniciada.
+
+        :return: ``True`` se este processo for o dono e, portanto, deve
+            observar a pasta de *output*.
+        :rtype: bool
+        """
+        with self._lock:
+            if not self._iniciado:
+                self._despachante = despachante
+                self._parar = False
+                self._eleger()
+                self._iniciado = True
+            return self._dono
+
+
+    def parar(self):
+        with self._lock:
+            self._parar = True
+            self._iniciado = False
+            servidor, self._servidor = self._servidor, None
+            conexoes, self._conexoes = list(self._conexoes), set()
+            conexao, self._conexao = self._conexao, None
+            fd, self._fd_lock = self._fd_lock, None
+            self._dono = False
+        if servidor is not None:
+            try:
+                os.remove(self._caminho_socket)
+            except OSError:
+                pass
+            servidor.close()
+        for c in conexoes + ([conexao] if conexao else []):
+            c.fechar()
+        if fd is not None:
+            os.close(fd)
+
+
+    def agendador(self, local):
+        """O agendador a ser usado pelo despachante: o próprio, se este
+        processo for o dono, ou o :class:`AgendadorRemoto`.
+        """
+        return local if self._dono else self._agendador_remoto
+
+
+    def numero(self):
+        """Gera um número identificador único entre todos os processos. Se a
+        conexão com o dono for perdida, a chamada é repetida ao novo dono (ou
+        o número é gerado localmente, se este processo assumir o seu lugar).
+        O numerador local nunca é usado enquanto outro processo for o dono,
+        pois o número poderia coincidir com um número gerado pelo dono.
+
+        :raises ErroCoordenacao: Se nenhum dono responder dentro de
+            :data:`TEMPO_LIMITE_CHAMADA`.
+        """
+        limite = time.time() + TEMPO_LIMITE_CHAMADA
+        while not self._parar:
+            if self._dono:
+                return self._numerador()
+            if self._conexao is not None:
+                resposta = self._chamar(op='numero')
+                if resposta is not None:
+                    return resposta['numero']
+            if time.time() >= limite:
+                break
+            # aguarda a eleição de um novo dono
+            time.sleep(0.05)
+        raise ErroCoordenacao('Processo dono nao gerou o numero '
+                              'identificador a tempo')
+
+
+    def enviar(self, **mensagem):
+        """Envia uma mensagem ao dono (apenas em processos que não são o
+        dono).
+        """
+        conexao = self._conexao
+        return conexao is not None and conexao.enviar(**mensagem)
+
+
+    def aguardar(self, numero_identificador):
+        """Informa ao dono que este processo aguarda pela resposta. Aguarda
+        pela confirmação do dono, para que a resposta não chegue antes do
+        registro.
+        """
+        if not self._dono and self._chamar(op='aguardar',
+                id=str(numero_identificador)) is None:
+            logger.warning('Processo dono nao confirmou o registro de %s',
+                           numero_identificador)
+
+
+    def aguardando_remoto(self, numero_identificador):
+        """Indica se outro processo aguarda pela resposta (no dono)."""
+        with self._lock:
+            return str(numero_identificador) in self._interessados
+
+
+    def encaminhar(self, numero_identificador, resposta, src_path):
+        """Encaminha a resposta ao processo que a aguarda, se houver.
+
+        :return: ``True`` se a resposta foi encaminhada.
+        :rtype: bool
+        """
+        with self._lock:
+            conexao = self._interessados.pop(str(numero_identificador), None)
+        return conexao is not None and conexao.enviar(op='resposta',
+                id=str(numero_identificador), resposta=resposta,
+                src_path=src_path)
+
+
+    def progresso(self):
+        """Avisa os demais processos de um sinal de atividade do
+        Integrador (no dono).
+        """
+        with self._lock:
+            conexoes = list(self._conexoes)
+        for conexao in conexoes:
+            conexao.enviar(op='progresso')
+
+
+    def _eleger(self):
+        # tenta ser o dono; se outro processo for, conecta-se a ele (o socket
+        # pode ainda não existir, se o dono acabou de obter o lock, ou ter
+        # sido removido enquanto o dono mantém o lock)
+        limite = time.time() + TEMPO_LIMITE_ELEICAO
+        while not self._parar:
+            if self._fd_lock is None:
+                self._fd_lock = os.open(self._caminho_lock,
+                        os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(self._fd_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            else:
+                self._assumir()
+                return
+            if self._conectar():
+                return
+            if time.time() >= limite:
+                raise ErroCoordenacao('Processo dono nao aceita conexoes em '
+                                      '{}'.format(self._caminho_socket))
+            time.sleep(0.05)
+
+
+    def _assumir(self):
+        try:
+            os.remove(self._caminho_socket)
+        except OSError:
+            pass
+        servidor = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        servidor.bind(self._caminho_socket)
+        os.chmod(self._caminho_socket, 0o600)
+        servidor.listen(16)
+        self._servidor = servidor
+        self._dono = True
+        logger.info('Processo %s observa a pasta do Integrador', os.getpid())
+        self._thread('CoordenadorServidor', self._aceitar, servidor)
+
+
+    def _conectar(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._caminho_socket)
+        except (IOError, OSError, socket.error):
+            sock.close()
+            return False
+        self._conexao = _Conexao(sock)
+        self._dono = False
+        self._thread('CoordenadorCliente', self._atender_dono, self._conexao)
+        return True
+
+
+    def _thread(self, nome, alvo, *args):
+        thread = threading.Thread(target=alvo, args=args, name=nome)
+        thread.daemon = True
+        thread.start()
+
+
+    def _chamar(self, **mensagem):
+        sequencia = self.sequencia()
+        chamada = [threading.Event(), None]
+        with self._lock:
+            self._chamadas[sequencia] = chamada
+        try:
+            if self.enviar(seq=sequencia, **mensagem) and \
+                    chamada[0].wait(TEMPO_LIMITE_CHAMADA):
+                return chamada[1]
+            return None
+        finally:
+            with self._lock:
+                self._chamadas.pop(sequencia, None)
+
+
+    # processo dono
+
+    def _aceitar(self, servidor):
+        while True:
+            try:
+                sock, _ = servidor.accept()
+            except (IOError, OSError, socket.error):
+                return
+            conexao = _Conexao(sock)
+            with self._lock:
+                if self._servidor is not servidor:
+                    conexao.fechar()
+                    return
+                self._conexoes.add(conexao)
+            self._thread('CoordenadorConexao', self._atender_processo,
+                         conexao)
+
+
+    def _atender_processo(self, conexao):
+        agendador = self._despachante.agendador
+        vagas = {}
+        for mensagem in conexao.mensagens():
+            op = mensagem.get('op')
+            if op == 'aguardar':
+                with self._lock:
+                    self._interessados[mensagem['id']] = conexao
+                    while len(self._interessados) > self.MEMORIA_INTERESSADOS:
+                        self._interessados.popitem(last=False)
+                conexao.enviar(op='aguardando', seq=mensagem['seq'])
+            elif op == 'numero':
+                conexao.enviar(op='numero', seq=mensagem['seq'],
+                               numero=self._numerador())
+            elif op == 'vaga':
+                seq = mensagem['seq']
+                vagas[seq] = agendador.solicitar(mensagem['template'],
+                        lambda vaga, seq=seq: conexao.enviar(
+                                op='concedida', seq=seq))
+            elif op in ('liberar', 'cancelar'):
+                vaga = vagas.pop(mensagem['seq'], None)
+                if vaga is not None and not agendador.cancelar(vaga):
+                    agendador.liberar(vaga)
+        # processo terminou: devolve as suas vagas e esquece os seus números
+        for vaga in vagas.values():
+            if not agendador.cancelar(vaga):
+                agendador.liberar(vaga)
+        with self._lock:
+            self._conexoes.discard(conexao)
+            for numero, interessado in list(self._interessados.items()):
+                if interessado is conexao:
+                    del self._interessados[numero]
+        conexao.fechar()
+
+
+    # demais processos
+
+    def _atender_dono(self, conexao):
+        # as respostas e vagas são entregues por outra thread, pois quem as
+        # recebe pode registrar novas remessas e aguardar por chamadas ao
+        # dono, cujas respostas são lidas por esta thread
+        entregas = queue.Queue()
+        self._thread('CoordenadorEntrega', self._entregar, entregas)
+        for mensagem in conexao.mensagens():
+            if mensagem.get('op') in ('resposta', 'progresso', 'concedida'):
+                entregas.put(mensagem)
+            elif 'seq' in mensagem:
+                with self._lock:
+                    chamada = self._chamadas.get(mensagem['seq'])
+                if chamada is not None:
+                    chamada[1] = mensagem
+                    chamada[0].set()
+        entregas.put(None)
+        with self._lock:
+            chamadas = list(self._chamadas.values())
+        for chamada in chamadas:
+            # sem resposta; quem chamou não precisa esperar o tempo limite
+            chamada[0].set()
+        with self._lock:
+            if self._parar or self._conexao is not conexao:
+                return
+            self._conexao = None
+            self._iniciado = False
+        # o dono terminou: assume o seu lugar ou conecta-se ao novo dono
+        logger.warning('Conexao com o processo dono perdida')
+        despachante = self._despachante
+        try:
+            despachante.iniciar()
+        except ErroCoordenacao:
+            # uma nova eleição é feita na próxima remessa registrada
+            logger.exception('Falha ao eleger um novo processo dono')
+            return
+        if not self._dono:
+            for numero_identificador in despachante.aguardados():
+                self.aguardar(numero_identificador)
+        self._agendador_remoto.reenviar()
+
+
+    def _entregar(self, entregas):
+        despachante = self._despachante
+        for mensagem in iter(entregas.get, None):
+            op = mensagem['op']
+            if op == 'resposta':
+                despachante.despachar(mensagem['id'], mensagem['resposta'],
+                                      mensagem['src_path'])
+            elif op == 'progresso':
+                despachante.consumo.progresso()
+            else:
+                self._agendador_remoto.conceder(mensagem['seq'])
@@ -323,11 +323,33 @@ class Entidade(object):
         return doc
 
 
+    def iterar_documento(self, *args, **kwargs):
+        """Variante de :meth:`documento` que resulta no mesmo documento XML
+        em partes, sem jamais construí-lo por inteiro. Útil para documentos
+        grandes, como o CF-e de uma venda com milhares de itens (veja
+        :class:`~mfecfe.xml.Chunks`).
+        """
+        forcar_unicode = kwargs.pop('forcar_unicode', False)
+        incluir_xml_decl = kwargs.pop('incluir_xml_decl', True)
+        if incluir_xml_decl:
+            yield u'{}\n'.format(constantes.XML_DECL_UNICODE) \
+                    if forcar_unicode else '{}\n'.format(constantes.XML_DECL)
+        for parte in self._partes_xml(*args, **kwargs):
+            if not isinstance(parte, basestring):
+                parte = ET.tostring(parte, encoding='utf-8').decode('utf-8')
+            yield parte if forcar_unicode else unidecode(parte)
+
+
     def _xml(self, *args, **kwargs):
         self.validar()
         return self._construir_elemento_xml(*args, **kwargs)
 
 
+    def _partes_xml(self, *args, **kwargs):
+        # as subclasses podem produzir o XML em partes (elementos ou strings)
+        yield self._xml(*args, **kwargs)
+
+
     def _construir_elemento_xml(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -2287,30 +2309,50 @@ class CFeVenda(Entidade):
         return super(CFeVenda, self)._xml(*args, **kwargs)
 
 
+    def _partes_xml(self, *args, **kwargs):
+        # cada detalhamento é construído e serializado apenas quando chegar a
+        # sua vez, de modo que a memória não cresce com o número de itens
+        Entidade._erros.clear()
+        self.validar()
+        yield '<CFe><infCFe versaoDadosEnt="{}">'.format(self.versaoDadosEnt)
+        for elemento in self._elementos_infcfe():
+            yield elemento
+        yield '</infCFe></CFe>'
+
+
     def _construir_elemento_xml(self, *args, **kwargs):
 
         cfe = ET.Element('CFe')
         infCFe = ET.SubElement(cfe, 'infCFe')
         infCFe.attrib['versaoDadosEnt'] = self.versaoDadosEnt
 
-        ide = ET.SubElement(infCFe, 'ide')
+        for elemento in self._elementos_infcfe():
+            infCFe.append(elemento)
+
+        return cfe
+
+
+    def _elementos_infcfe(self):
+
+        ide = ET.Element('ide')
         ET.SubElement(ide, 'CNPJ').text = self.CNPJ
         ET.SubElement(ide, 'signAC').text = self.signAC
         ET.SubElement(ide, 'numeroCaixa').text = \
                 '{:03d}'.format(self.numeroCaixa)
+        yield ide
 
-        infCFe.append(self.emitente._xml())
+        yield self.emitente._xml()
 
         dest = self.destinatario or Destinatario()
-        infCFe.append(dest._xml())
+        yield dest._xml()
 
         if self.entrega is not None:
-            infCFe.append(self.entrega._xml())
+            yield self.entrega._xml()
 
         for n, det in enumerate(self.detalhamentos):
-            infCFe.append(det._xml(nItem=n+1))
+            yield det._xml(nItem=n+1)
 
-        total = ET.SubElement(infCFe, 'total')
+        total = ET.Element('total')
 
         if hasattr(self, 'vCFeLei12741'):
             ET.SubElement(total, 'vCFeLei12741').text = str(self.vCFeLei12741)
@@ -2318,14 +2360,15 @@ class CFeVenda(Entidade):
         if self.descontos_acrescimos_subtotal is not None:
             total.append(self.descontos_acrescimos_subtotal._xml())
 
-        pgto = ET.SubElement(infCFe, 'pgto')
+        yield total
+
+        pgto = ET.Element('pgto')
         for pg in self.pagamentos:
             pgto.append(pg._xml())
+        yield pgto
 
         if self.informacoes_adicionais is not None:
-            infCFe.append(self.informacoes_adicionais._xml())
-
-        return cfe
+            yield self.informacoes_adicionais._xml()
 
 
 class CFeCancelamento(Entidade):
@@ -58,3 +58,22 @@ class ExcecaoRespostaSAT(Exception):
     @property
     def resposta(self):
         return self._resposta
+
+
+class ErroEquipamentoIndisponivel(Exception):
+    """
+    Lançada pelo :class:`~satcfe.roteador.RoteadorSAT` quando não há um
+    equipamento disponível para a operação (por exemplo, o equipamento ao
+    qual o caixa da venda está vinculado acumula falhas de comunicação).
+    """
+    pass
+
+
+class ErroCoordenacao(Exception):
+    """
+    Lançada pelo :class:`~mfecfe.coordenacao.CoordenadorIntegrador` quando o
+    processo dono não responde a tempo a uma chamada que não pode ser
+    atendida localmente, como a geração de um número identificador, ou quando
+    não é possível se tornar o dono nem se conectar a ele.
+    """
+    pass
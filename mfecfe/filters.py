@@ -2,23 +2,67 @@
 # © 2016 Danimar Ribeiro, Trustcode
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import collections
+import threading
+
 from decimal import Decimal
 from datetime import date
 from datetime import datetime
 from unicodedata import normalize
 
 
+NORMALIZE_CACHE_SIZE = 1024
+"""How many normalized non-ASCII strings are kept by :func:`normalize_str`."""
+
+NORMALIZE_CACHE_MAX_LENGTH = 128
+"""Only strings up to this length are kept in the cache."""
+
+_normalized = collections.OrderedDict()
+_normalized_lock = threading.Lock()
+
+
+def _is_ascii(string):
+    try:
+        if isinstance(string, bytes):
+            string.decode('ascii')
+        else:
+            string.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def _normalize_non_ascii(string):
+    if isinstance(string, bytes):
+        string = string.decode('utf-8', 'replace')
+    return normalize('NFKD', string).encode('ASCII', 'ignore').decode()
+
+
 def normalize_str(string):
     """
     Remove special characters and strip spaces
+
+    ASCII strings are returned as is, since they are not changed by the
+    normalization. The most recently normalized short strings are cached.
     """
     if string:
-        if not isinstance(string, str):
-            string = str(string, 'utf-8', 'replace')
-
-        string = string.encode('utf-8')
-        return normalize(
-            'NFKD', string.decode('utf-8')).encode('ASCII', 'ignore').decode()
+        if not isinstance(string, (bytes, type(u''))):
+            string = u'{}'.format(string)
+        if _is_ascii(string):
+            return string
+        if len(string) > NORMALIZE_CACHE_MAX_LENGTH:
+            return _normalize_non_ascii(string)
+        with _normalized_lock:
+            normalized = _normalized.get(string)
+            if normalized is not None:
+                _normalized[string] = _normalized.pop(string)
+                return normalized
+        normalized = _normalize_non_ascii(string)
+        with _normalized_lock:
+            _normalized[string] = normalized
+            while len(_normalized) > NORMALIZE_CACHE_SIZE:
+                _normalized.popitem(last=False)
+        return normalized
     return ''
 
 
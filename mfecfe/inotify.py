@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/inotify.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Observador da pasta de *output* do Integrador baseado diretamente no
+``inotify`` do Linux (via :mod:`ctypes`), sem depender do *watchdog*.
+
+Apenas os eventos ``IN_CLOSE_WRITE`` (o Integrador terminou de escrever o
+arquivo) e ``IN_MOVED_TO`` (o arquivo foi publicado por renomeação) são
+observados, de modo que cada resposta é notificada uma única vez, já completa,
+por uma única *thread* de leitura.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+
+logger = logging.getLogger('satcfe')
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_CABECALHO = struct.Struct('iIII')
+
+_TAMANHO_LEITURA = 64 * 1024
+
+
+def _carregar_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+            ctypes.c_uint32]
+    return libc
+
+
+_libc = _carregar_libc()
+
+
+def disponivel():
+    """Indica se o ``inotify`` está disponível nesta plataforma."""
+    return _libc is not None
+
+
+def _erro_os(funcao):
+    numero = ctypes.get_errno()
+    return OSError(numero, '{}: {}'.format(funcao, os.strerror(numero)))
+
+
+class ObservadorInotify(object):
+    """Observa a pasta de *output* através do ``inotify``, notificando o
+    monitor apenas quando um arquivo ``.xml`` é fechado após ser escrito
+    (``IN_CLOSE_WRITE``) ou movido para a pasta (``IN_MOVED_TO``).
+
+    Se a fila de eventos do *kernel* transbordar (``IN_Q_OVERFLOW``), todos os
+    arquivos da pasta são submetidos ao monitor, que ignora os já processados.
+
+    Possui a mesma interface do ``Observer`` do *watchdog* usada pelo
+    :class:`~mfecfe.integrador.DespachanteIntegrador` (:meth:`start`,
+    :meth:`stop` e :meth:`join`).
+
+    :param monitor: O :class:`~mfecfe.integrador.MonitorIntegrador` que
+        processará os arquivos.
+
+    :param str caminho: Caminho completo para a pasta de *output*.
+
+    :raises OSError: Se o ``inotify`` não puder ser iniciado para a pasta.
+    """
+
+    def __init__(self, monitor, caminho):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify indisponivel')
+        self._monitor = monitor
+        self._caminho = caminho
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise _erro_os('inotify_init1')
+        caminho_bytes = caminho if isinstance(caminho, bytes) \
+                else caminho.encode(sys.getfilesystemencoding())
+        if _libc.inotify_add_watch(self._fd, caminho_bytes,
+                IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR) < 0:
+            erro = _erro_os('inotify_add_watch')
+            os.close(self._fd)
+            raise erro
+        self._leitura, self._escrita = os.pipe()
+        self._thread = threading.Thread(target=self._executar,
+                name='ObservadorInotify')
+        self._thread.daemon = True
+
+
+    def _notificar(self, nome):
+        self._monitor.processar_arquivo(os.path.join(self._caminho, nome))
+
+
+    def _ler_eventos(self):
+        try:
+            dados = os.read(self._fd, _TAMANHO_LEITURA)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        posicao = 0
+        while posicao + _CABECALHO.size <= len(dados):
+            _, mascara, _, tamanho = _CABECALHO.unpack_from(dados, posicao)
+            posicao += _CABECALHO.size
+            nome = dados[posicao:posicao + tamanho].split(b'\0', 1)[0]
+            posicao += tamanho
+            if mascara & IN_Q_OVERFLOW:
+                logger.warning('Fila do inotify transbordou: %s',
+                               self._caminho)
+                for existente in sorted(os.listdir(self._caminho)):
+                    if existente.endswith('.xml'):
+                        self._notificar(existente)
+            elif mascara & IN_IGNORED:
+                logger.error('Pasta deixou de ser observada: %s',
+                             self._caminho)
+                return False
+            elif nome:
+                if not isinstance(self._caminho, bytes):
+                    nome = nome.decode(sys.getfilesystemencoding())
+                if nome.endswith('.xml'):
+                    self._notificar(nome)
+        return True
+
+
+    def _executar(self):
+        try:
+            while True:
+                try:
+                    prontos, _, _ = select.select(
+                            [self._fd, self._leitura], [], [])
+                except (select.error, OSError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self._leitura in prontos or not self._ler_eventos():
+                    break
+        except Exception:
+            logger.exception('Falha no observador inotify: %s', self._caminho)
+        finally:
+            os.close(self._fd)
+            os.close(self._leitura)
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def stop(self):
+        if self._escrita is not None:
+            os.write(self._escrita, b'x')
+            os.close(self._escrita)
+            self._escrita = None
+
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
@@ -0,0 +1,1464 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/integrador.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implementa a troca de arquivos com o Integrador Fiscal. As remessas são
+escritas na pasta ``input`` e as respostas aparecem na pasta ``output``, onde
+são observadas por um único :class:`DespachanteIntegrador` por
+:class:`~mfecfe.base.BibliotecaSAT`.
+
+O despachante mantém uma tabela de respostas pendentes, indexada pelo número
+identificador da remessa (``Identificador/Valor``), e entrega cada resposta
+encontrada para quem a estiver aguardando. A tabela é protegida por um *lock*,
+de modo que várias *threads* podem ter remessas em andamento ao mesmo tempo,
+cada uma recebendo apenas a resposta com o seu próprio identificador:
+
+.. sourcecode:: python
+
+    despachante = DespachanteIntegrador('/opt/Integrador/output')
+    pendente = despachante.registrar(123456)
+    # ... escreve a remessa na pasta input ...
+    if pendente.aguardar(10):
+        print(pendente.resposta)
+    despachante.descartar(pendente)
+
+"""
+
+import collections
+import errno
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+
+import xmltodict
+
+from lxml import etree
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import PatternMatchingEventHandler
+except ImportError:
+    # o watchdog é opcional (veja OBSERVAR_EVENTOS)
+    Observer = None
+    PatternMatchingEventHandler = object
+
+from . import inotify
+from .transporte import nome_operacao
+
+
+logger = logging.getLogger('satcfe')
+
+
+relogio = getattr(time, 'perf_counter', time.time)
+"""Relógio usado para medir a duração das fases de um comando."""
+
+
+SINCRONIZAR_NUNCA = 0
+"""Os arquivos de remessa são publicados sem ``fsync``."""
+
+SINCRONIZAR_ARQUIVO = 1
+"""O conteúdo do arquivo de remessa é sincronizado antes de ser publicado."""
+
+SINCRONIZAR_DIRETORIO = 2
+"""Além do conteúdo, a entrada do diretório também é sincronizada após a
+publicação do arquivo de remessa.
+"""
+
+PASTA_TEMPORARIA = '.mfecfe-tmp'
+"""Pasta, ao lado da pasta de destino (por exemplo, ao lado de ``input``), em
+que os arquivos são escritos antes de serem publicados por
+:func:`publicar_arquivo`. Fica no mesmo sistema de arquivos do destino, de
+modo que a publicação é uma renomeação atômica.
+"""
+
+OBSERVAR_AUTOMATICO = 0
+"""A pasta de *output* é varrida periodicamente se estiver em um sistema de
+arquivos de rede (veja :func:`sistema_arquivos_remoto`), onde os eventos do
+sistema de arquivos não são confiáveis. Caso contrário, é observada pelo
+``inotify``, no Linux, ou pelo *watchdog*, se instalado.
+"""
+
+OBSERVAR_EVENTOS = 1
+"""A pasta de *output* é observada pelos eventos do sistema de arquivos
+através do *watchdog*, que precisa estar instalado.
+"""
+
+OBSERVAR_VARREDURA = 2
+"""A pasta de *output* é varrida periodicamente (:class:`ObservadorVarredura`).
+"""
+
+OBSERVAR_INOTIFY = 3
+"""A pasta de *output* é observada diretamente pelo ``inotify`` do Linux
+(:class:`~mfecfe.inotify.ObservadorInotify`).
+"""
+
+PRAZO_CONSUMO = 5.0
+"""Prazo de consumo sugerido (veja :class:`VigiaConsumo`): tempo máximo, em
+segundos, que uma remessa pode permanecer na pasta de *input* sem que o
+Integrador consuma nenhuma remessa nem produza nenhuma resposta, antes que o
+Integrador seja considerado parado. A detecção não é ativada por padrão.
+"""
+
+MENSAGEM_INTEGRADOR_PARADO = 'Integrador parado'
+"""Mensagem da resposta produzida para as remessas retiradas da pasta de
+*input* porque o Integrador parou de consumi-las (veja :class:`VigiaConsumo`).
+"""
+
+SISTEMAS_ARQUIVOS_REMOTOS = frozenset((
+        '9p', 'afs', 'cifs', 'davfs', 'fuse.sshfs', 'ncpfs', 'nfs', 'nfs4',
+        'smb3', 'smbfs', 'vboxsf',
+    ))
+"""Tipos de sistemas de arquivos (Linux) que não produzem eventos para as
+alterações feitas por outras máquinas.
+"""
+
+
+def publicar_arquivo(caminho, conteudo, sincronizar=SINCRONIZAR_NUNCA):
+    """Publica o conteúdo no caminho informado de forma atômica. O conteúdo é
+    escrito em um arquivo temporário, na :data:`PASTA_TEMPORARIA` ao lado do
+    diretório de destino, que é então renomeado para o nome definitivo, de
+    modo que o Integrador jamais encontre no diretório de destino um arquivo
+    escrito pela metade ou abandonado. O arquivo temporário é removido se a
+    publicação falhar.
+
+    :param str caminho: Caminho completo do arquivo a ser publicado. Um
+        arquivo existente com o mesmo nome será substituído.
+
+    :param bytes conteudo: Conteúdo completo do arquivo ou um iterável das
+        suas partes, que serão escritas à medida que forem produzidas.
+
+    :param int sincronizar: Política de sincronização, devendo ser uma das
+        constantes :attr:`SINCRONIZAR_NUNCA` (padrão),
+        :attr:`SINCRONIZAR_ARQUIVO` ou :attr:`SINCRONIZAR_DIRETORIO`.
+    """
+    diretorio, nome = os.path.split(os.path.abspath(caminho))
+    temporarios = os.path.join(os.path.dirname(diretorio), PASTA_TEMPORARIA)
+    try:
+        os.mkdir(temporarios)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    temporario = os.path.join(temporarios, '{}.{}.{}.tmp'.format(
+            os.path.basename(diretorio), nome, os.getpid()))
+    try:
+        with open(temporario, 'wb') as f:
+            if isinstance(conteudo, bytes):
+                f.write(conteudo)
+            else:
+                for parte in conteudo:
+                    f.write(parte)
+            if sincronizar >= SINCRONIZAR_ARQUIVO:
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            os.rename(temporario, caminho)
+        except OSError:
+            # no Windows a renomeação falha se o destino já existir
+            if not os.path.exists(caminho):
+                raise
+            os.remove(caminho)
+            os.rename(temporario, caminho)
+    except:
+        # as partes podem falhar ao serem produzidas
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+    if sincronizar >= SINCRONIZAR_DIRETORIO and hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(diretorio, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+_FECHAMENTO = b'</Integrador>'
+
+
+def assinatura_arquivo_completo(caminho):
+    """Verifica se o Integrador terminou de escrever o arquivo de resposta,
+    lendo apenas o seu final à procura do fechamento do elemento
+    ``Integrador``.
+
+    :param str caminho: Caminho completo para o arquivo de resposta.
+
+    :return: Uma assinatura do arquivo (caminho, tamanho e data de
+        modificação), que identifica esta versão do arquivo, ou ``None`` se o
+        arquivo estiver incompleto ou não existir.
+    :rtype: tuple
+    """
+    try:
+        with open(caminho, 'rb') as f:
+            estado = os.fstat(f.fileno())
+            f.seek(max(0, estado.st_size - 64))
+            if not f.read().rstrip().endswith(_FECHAMENTO):
+                return None
+    except (IOError, OSError):
+        return None
+    return (caminho, estado.st_size, estado.st_mtime)
+
+
+def ler_identificador(caminho):
+    """Obtém o número identificador (``Identificador/Valor``) de um arquivo de
+    resposta do Integrador sem analisar o arquivo inteiro. O arquivo é lido
+    incrementalmente apenas até o final do elemento ``Identificador``. O nome
+    do arquivo não é considerado, já que o Integrador não garante o seu
+    formato.
+
+    :param str caminho: Caminho completo para o arquivo de resposta.
+
+    :return: O número identificador ou ``None`` se não puder ser obtido.
+    :rtype: str
+    """
+    try:
+        with open(caminho, 'rb') as f:
+            for evento, elemento in etree.iterparse(f, events=('end',)):
+                if elemento.tag == 'Valor' and \
+                        elemento.getparent().tag == 'Identificador':
+                    return (elemento.text or '').strip()
+                if elemento.tag == 'Identificador':
+                    break
+    except (IOError, OSError, etree.XMLSyntaxError):
+        pass
+    return None
+
+
+def ler_resposta(caminho):
+    """Analisa completamente um arquivo de resposta do Integrador.
+
+    :param str caminho: Caminho completo para o arquivo de resposta.
+
+    :return: Uma tupla contendo o número identificador e a resposta.
+    :rtype: tuple
+    """
+    with open(caminho, 'r') as xml_source:
+        xml_string = xml_source.read()
+        parsed = xmltodict.parse(xml_string)
+        numero_identificador = parsed.get('Integrador', {}).get('Identificador', {}).get('Valor')
+        resposta = \
+            parsed.get('Integrador', {}).get('Resposta', {}).get('retorno') or \
+            parsed.get('Integrador', {}).get('Resposta', {}).get('IdPagamento') or \
+            parsed.get('Integrador', {}).get('Resposta', {})
+        if not isinstance(resposta, dict):
+            resposta += '|' + numero_identificador
+    return numero_identificador, resposta
+
+
+class MonitorIntegrador(PatternMatchingEventHandler):
+    patterns = ["*.xml"]
+
+    MEMORIA_PROCESSADOS = 1024
+    """Quantidade de arquivos processados dos quais o monitor se lembra, para
+    que cada resposta seja processada uma única vez.
+    """
+
+    def __init__(self, despachante):
+        super(MonitorIntegrador, self).__init__()
+        self.despachante = despachante
+        self._processados = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def process(self, event):
+        """ Realiza o processamento dos arquivos criados e modificados dentro da pasta de output do integrador
+
+        E ao ler o arquivo notifica o despachante do numero identificador do arquivo e seu caminho.
+        Apenas o número identificador é lido de cada arquivo; a análise completa é feita somente
+        para os arquivos que possuam uma remessa aguardando pela resposta.
+
+        Arquivos que ainda estejam sendo escritos pelo Integrador (sem o fechamento do elemento
+        ``Integrador``) são ignorados, já que serão notificados novamente quando modificados. Cada
+        arquivo completo é processado uma única vez, independente do número de eventos recebidos.
+
+        :param event:
+                event_type = None
+
+                    The type of the event as a string.
+
+                is_directory = False
+
+                    True if event was emitted for a directory; False otherwise.
+
+                src_path[source]
+
+                    Source path of the file system object that triggered this event.
+
+                dest_path
+
+                    Destination path, for ``moved`` events.
+
+        :return:
+        """
+        # arquivos publicados por renomeação aparecem com o nome definitivo
+        # apenas no destino do evento
+        self.processar_arquivo(getattr(event, 'dest_path', event.src_path))
+
+    def processar_arquivo(self, caminho):
+        """Processa o arquivo de resposta no caminho informado, como descrito
+        em :meth:`process`. Usado diretamente pelos observadores que não são
+        do *watchdog*.
+        """
+        if not caminho.endswith('.xml'):
+            return
+        try:
+            assinatura = assinatura_arquivo_completo(caminho)
+            if assinatura is None or not self._primeira_vez(assinatura):
+                # arquivo ainda sendo escrito pelo Integrador ou já processado
+                return
+            self.despachante.notificar_progresso()
+            numero_identificador = ler_identificador(caminho)
+            if not self.despachante.aguardando(numero_identificador):
+                # resposta de outra remessa (ou de outro processo); evita a
+                # análise completa do arquivo
+                return
+            numero_identificador, resposta = ler_resposta(caminho)
+            self.despachante.despachar(numero_identificador, resposta, caminho)
+        except Exception:
+            # o observador é compartilhado e não pode ser interrompido por
+            # um único arquivo problemático
+            logger.exception('Falha ao processar resposta do Integrador: %s',
+                             caminho)
+
+    def _primeira_vez(self, assinatura):
+        with self._lock:
+            if assinatura in self._processados:
+                return False
+            self._processados[assinatura] = True
+            while len(self._processados) > self.MEMORIA_PROCESSADOS:
+                self._processados.popitem(last=False)
+            return True
+
+    def on_modified(self, event):
+        self.process(event)
+
+    def on_created(self, event):
+        self.process(event)
+
+    def on_moved(self, event):
+        self.process(event)
+
+
+def sistema_arquivos_remoto(caminho):
+    """Indica se o caminho está em um sistema de arquivos de rede, como um
+    compartilhamento CIFS, no qual os eventos do sistema de arquivos não são
+    produzidos para os arquivos escritos pelo Integrador em outra máquina.
+
+    No Linux o tipo do sistema de arquivos é obtido de ``/proc/mounts``. No
+    Windows são considerados remotos os caminhos UNC e as unidades mapeadas.
+    """
+    caminho = os.path.realpath(caminho)
+    if os.name == 'nt':
+        if caminho.startswith('\\\\'):
+            return True
+        import ctypes
+        unidade = os.path.splitdrive(caminho)[0] + '\\'
+        return ctypes.windll.kernel32.GetDriveTypeW(
+                unidade.decode('mbcs') if isinstance(unidade, bytes)
+                else unidade) == 4  # DRIVE_REMOTE
+    try:
+        with open('/proc/mounts') as f:
+            montagens = [linha.split()[1:3] for linha in f]
+    except (IOError, OSError):
+        return False
+    tipo, ponto = None, ''
+    for ponto_montagem, tipo_montagem in montagens:
+        ponto_montagem = ponto_montagem.replace('\\040', ' ')
+        if len(ponto_montagem) >= len(ponto) and (caminho == ponto_montagem
+                or caminho.startswith(ponto_montagem.rstrip('/') + '/')):
+            tipo, ponto = tipo_montagem, ponto_montagem
+    return tipo in SISTEMAS_ARQUIVOS_REMOTOS
+
+
+def _listar(caminho):
+    # nome -> (tamanho, data de modificação) das respostas na pasta
+    if hasattr(os, 'scandir'):
+        instantaneo = {}
+        for entrada in os.scandir(caminho):
+            if entrada.name.endswith('.xml'):
+                try:
+                    estado = entrada.stat()
+                except OSError:
+                    continue
+                instantaneo[entrada.name] = (estado.st_size, estado.st_mtime)
+        return instantaneo
+    instantaneo = {}
+    for nome in os.listdir(caminho):
+        if nome.endswith('.xml'):
+            try:
+                estado = os.stat(os.path.join(caminho, nome))
+            except OSError:
+                continue
+            instantaneo[nome] = (estado.st_size, estado.st_mtime)
+    return instantaneo
+
+
+class ObservadorVarredura(object):
+    """Observa a pasta de *output* comparando instantâneos sucessivos do seu
+    conteúdo (nome, tamanho e data de modificação de cada arquivo), para os
+    sistemas de arquivos em que os eventos não são confiáveis.
+
+    O intervalo entre as varreduras é adaptativo: volta ao mínimo sempre que
+    uma remessa é escrita (:meth:`acordar`) ou que uma alteração é encontrada,
+    e cresce progressivamente até o máximo enquanto nada muda.
+
+    Possui a mesma interface do ``Observer`` do *watchdog* usada pelo
+    :class:`DespachanteIntegrador` (:meth:`start`, :meth:`stop` e
+    :meth:`join`).
+
+    :param monitor: O :class:`MonitorIntegrador` que processará os arquivos
+        novos ou modificados.
+
+    :param str caminho: Caminho completo para a pasta de *output*.
+
+    :param dict instantaneo: Opcional. O instantâneo inicial da pasta. Os
+        arquivos nele presentes só serão processados se forem modificados.
+    """
+
+    INTERVALO_MINIMO = 0.01
+
+    INTERVALO_MAXIMO = 0.5
+
+    FATOR = 1.5
+
+    def __init__(self, monitor, caminho, instantaneo=None):
+        self._monitor = monitor
+        self._caminho = caminho
+        self._instantaneo = instantaneo if instantaneo is not None else {}
+        self._intervalo = self.INTERVALO_MINIMO
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._executar,
+                name='ObservadorVarredura')
+        self._thread.daemon = True
+
+
+    def acordar(self):
+        """Retorna o intervalo entre as varreduras ao mínimo, antecipando a
+        próxima varredura.
+        """
+        self._acordar.set()
+
+
+    def varrer(self):
+        """Compara o conteúdo da pasta com o instantâneo anterior, processando
+        os arquivos novos ou modificados.
+
+        :return: Quantidade de arquivos novos ou modificados.
+        :rtype: int
+        """
+        try:
+            instantaneo = _listar(self._caminho)
+        except OSError:
+            logger.exception('Falha ao varrer a pasta: %s', self._caminho)
+            return 0
+        anterior, self._instantaneo = self._instantaneo, instantaneo
+        alterados = [nome for nome, estado in instantaneo.items()
+                if anterior.get(nome) != estado]
+        for nome in sorted(alterados):
+            self._monitor.processar_arquivo(os.path.join(self._caminho, nome))
+        return len(alterados)
+
+
+    def _executar(self):
+        while not self._parar.is_set():
+            if self._acordar.wait(self._intervalo):
+                self._acordar.clear()
+                self._intervalo = self.INTERVALO_MINIMO
+            if self._parar.is_set():
+                break
+            if self.varrer():
+                self._intervalo = self.INTERVALO_MINIMO
+            else:
+                self._intervalo = min(self.INTERVALO_MAXIMO,
+                        self._intervalo * self.FATOR)
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def stop(self):
+        self._parar.set()
+        self._acordar.set()
+
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+
+class RespostaPendente(object):
+    """Representa uma remessa que aguarda pela resposta do Integrador.
+
+    Além de aguardar pela resposta (:meth:`aguardar`), é possível registrar
+    funções que serão invocadas quando a resposta for entregue
+    (:meth:`adicionar_callback`), o que permite aguardar pela resposta sem
+    bloquear uma *thread*, como faz :func:`~mfecfe.base.comando_integrador_nowait`.
+
+    :param numero_identificador: Número identificador da remessa.
+    """
+
+    def __init__(self, numero_identificador):
+        self.numero_identificador = str(numero_identificador)
+        self.resposta = None
+        self.src_path = None
+        self.enviada_em = None
+        self.vista_em = None
+        self.consumida_em = None
+        self.parada = False
+        self._evento = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+
+    @property
+    def entregue(self):
+        """Indica se a resposta já foi entregue."""
+        return self._evento.is_set()
+
+
+    def entregar(self, resposta, src_path):
+        """Entrega a resposta e acorda quem a estiver aguardando."""
+        with self._lock:
+            self.resposta = resposta
+            self.src_path = src_path
+            self._evento.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+    def adicionar_callback(self, callback):
+        """Registra uma função que será invocada, recebendo esta resposta
+        pendente como argumento, quando a resposta for entregue. Se a resposta
+        já tiver sido entregue, a função é invocada imediatamente.
+
+        Note que a função será invocada pela *thread* do observador da pasta
+        de *output* e, portanto, deve retornar rapidamente.
+        """
+        with self._lock:
+            if not self._evento.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+    def aguardar(self, tempo_limite=None):
+        """Aguarda pela resposta até que o tempo limite se esgote.
+
+        :param float tempo_limite: Tempo máximo de espera, em segundos.
+
+        :return: ``True`` se a resposta foi entregue dentro do tempo limite.
+        :rtype: bool
+        """
+        return self._evento.wait(tempo_limite)
+
+
+class VigiaPrazos(object):
+    """Executa funções agendadas para um determinado prazo usando uma única
+    *thread*, iniciada sob demanda. Permite expirar respostas pendentes que
+    não são aguardadas por nenhuma *thread* (por exemplo, as que resultam em
+    :class:`concurrent.futures.Future`).
+
+    As funções agendadas são executadas pela *thread* da vigia e, portanto,
+    devem retornar rapidamente.
+    """
+
+    def __init__(self):
+        self._agenda = []
+        self._sequencia = itertools.count()
+        self._condicao = threading.Condition()
+        self._thread = None
+
+
+    def agendar(self, atraso, funcao):
+        """Agenda a execução da função após o atraso informado, em segundos.
+
+        :return: Uma referência ao agendamento, que pode ser informada para
+            :meth:`cancelar`.
+        """
+        agendamento = [time.time() + atraso, next(self._sequencia), funcao]
+        with self._condicao:
+            heapq.heappush(self._agenda, agendamento)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executar,
+                        name='VigiaPrazos')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condicao.notify()
+        return agendamento
+
+
+    def cancelar(self, agendamento):
+        """Cancela um agendamento que ainda não tenha sido executado."""
+        with self._condicao:
+            agendamento[2] = None
+
+
+    def _executar(self):
+        while True:
+            with self._condicao:
+                while True:
+                    while self._agenda and self._agenda[0][2] is None:
+                        heapq.heappop(self._agenda)
+                    if not self._agenda:
+                        self._condicao.wait()
+                        continue
+                    restante = self._agenda[0][0] - time.time()
+                    if restante <= 0:
+                        funcao = heapq.heappop(self._agenda)[2]
+                        break
+                    self._condicao.wait(restante)
+            try:
+                funcao()
+            except Exception:
+                logger.exception('Falha ao executar agendamento')
+
+
+def resposta_integrador_parado(numero_identificador):
+    """Resposta produzida para uma remessa retirada da pasta de *input*
+    porque o Integrador parou de consumir as remessas.
+    """
+    return '{0}|{0}|0|{1}|0|ERRO'.format(
+            numero_identificador, MENSAGEM_INTEGRADOR_PARADO)
+
+
+class VigiaConsumo(object):
+    """Acompanha, com uma única *thread* iniciada sob demanda, as remessas
+    escritas na pasta de *input*, registrando em cada
+    :class:`RespostaPendente` o momento em que a remessa foi consumida pelo
+    Integrador (``consumida_em``) e o último momento em que ainda estava na
+    pasta (``vista_em``). Assim, o tempo em que a remessa aguardou na fila do
+    Integrador pode ser separado do tempo de processamento.
+
+    A pasta de *input* pode estar em um compartilhamento de rede, onde cada
+    listagem é cara. Por isso as remessas só são acompanhadas se houver um
+    prazo de consumo ou se o consumo for medido (``medir``) e, como em
+    :class:`ObservadorVarredura`, o intervalo entre as verificações começa em
+    :attr:`INTERVALO_MINIMO` sempre que uma remessa é escrita ou consumida e
+    cresce por :attr:`FATOR` até :attr:`INTERVALO_MAXIMO` enquanto nada muda.
+
+    Se uma remessa não for consumida dentro do prazo de consumo e, no mesmo
+    período, o Integrador não tiver consumido nenhuma outra remessa, não tiver
+    produzido nenhuma resposta e não houver nenhuma remessa em processamento,
+    o Integrador é considerado parado: a remessa é retirada da pasta de
+    *input* e recebe imediatamente uma resposta de erro com a mensagem
+    :attr:`MENSAGEM_INTEGRADOR_PARADO`, em vez de esgotar todo o seu tempo
+    limite. Remessas que não puderem ser retiradas (porque o Integrador as
+    consumiu neste meio tempo) continuam aguardando normalmente.
+
+    Apenas o progresso observado por este processo é considerado. Se outros
+    processos, não coordenados, usam o mesmo Integrador, ou se o Integrador
+    demora a retomar o consumo após um período ocioso, uma venda retirada
+    pode já ter sido aberta pelo Integrador. Por isso a detecção só é ativada
+    se um prazo de consumo for informado (por exemplo,
+    :attr:`PRAZO_CONSUMO`).
+
+    :param despachante: O :class:`DespachanteIntegrador` das remessas.
+
+    :param float prazo_consumo: Opcional. Prazo de consumo, em segundos. Se
+        ``None`` (padrão), o Integrador nunca é considerado parado.
+
+    :param bool medir: Opcional. Se o momento do consumo das remessas deve ser
+        registrado mesmo sem um prazo de consumo (por exemplo, para as
+        métricas da :class:`~mfecfe.base.BibliotecaSAT`).
+    """
+
+    INTERVALO_MINIMO = 0.25
+    """Intervalo, em segundos, entre as verificações da pasta de *input* logo
+    após uma remessa ser escrita ou consumida.
+    """
+
+    INTERVALO_MAXIMO = 1.0
+    """Intervalo máximo, em segundos, entre as verificações da pasta de
+    *input*.
+    """
+
+    FATOR = 1.5
+    """Fator de crescimento do intervalo enquanto nenhuma remessa é escrita
+    ou consumida.
+    """
+
+    def __init__(self, despachante, prazo_consumo=None, medir=False):
+        self.prazo_consumo = prazo_consumo
+        self.medir = medir
+        self._intervalo = self.INTERVALO_MINIMO
+        self._despachante = despachante
+        self._remessas = collections.OrderedDict()
+        self._em_processamento = set()
+        self._ultimo_progresso = relogio()
+        self._parado = False
+        self._condicao = threading.Condition()
+        self._thread = None
+        self._parar = False
+
+
+    @property
+    def parado(self):
+        """Indica se o Integrador foi considerado parado e, desde então, não
+        consumiu nenhuma remessa nem produziu nenhuma resposta.
+        """
+        return self._parado
+
+
+    @property
+    def ativa(self):
+        """Indica se as remessas escritas são acompanhadas, isto é, se há um
+        prazo de consumo ou se o consumo é medido.
+        """
+        return self.prazo_consumo is not None or self.medir
+
+
+    def progresso(self):
+        """Registra um sinal de atividade do Integrador (uma remessa
+        consumida ou uma resposta produzida).
+        """
+        self._ultimo_progresso = relogio()
+        self._parado = False
+
+
+    def acompanhar(self, pendente, caminho):
+        """Passa a acompanhar o consumo da remessa recém-escrita no caminho
+        informado.
+        """
+        pendente.enviada_em = relogio()
+        if not self.ativa:
+            return
+        with self._condicao:
+            self._remessas[pendente] = caminho
+            self._intervalo = self.INTERVALO_MINIMO
+            if self._thread is None:
+                self._parar = False
+                self._thread = threading.Thread(target=self._executar,
+                        name='VigiaConsumo')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condicao.notify()
+
+
+    def parar(self):
+        with self._condicao:
+            thread, self._thread = self._thread, None
+            self._parar = True
+            self._condicao.notify()
+        if thread is not None:
+            thread.join()
+
+
+    def verificar(self):
+        """Verifica o consumo das remessas acompanhadas, retirando-as da pasta
+        de *input* se o Integrador estiver parado.
+        """
+        with self._condicao:
+            remessas = list(self._remessas.items())
+        if not remessas:
+            return
+        aguardando = self._despachante.pendente
+        pastas = {}
+        agora = relogio()
+        for pendente, caminho in remessas:
+            if not aguardando(pendente):
+                self._esquecer(pendente)
+                continue
+            pasta, nome = os.path.split(caminho)
+            if pasta not in pastas:
+                try:
+                    pastas[pasta] = set(os.listdir(pasta))
+                except OSError:
+                    pastas[pasta] = None
+            if pastas[pasta] is None:
+                continue
+            if nome in pastas[pasta]:
+                pendente.vista_em = agora
+            else:
+                pendente.consumida_em = agora
+                self.progresso()
+                with self._condicao:
+                    self._remessas.pop(pendente, None)
+                    self._em_processamento.add(pendente)
+                    self._intervalo = self.INTERVALO_MINIMO
+
+        with self._condicao:
+            self._em_processamento = set(
+                    p for p in self._em_processamento if aguardando(p))
+            em_processamento = bool(self._em_processamento)
+            remessas = list(self._remessas.items())
+        if self.prazo_consumo is None or em_processamento or \
+                agora - self._ultimo_progresso < self.prazo_consumo:
+            return
+        for pendente, caminho in remessas:
+            if agora - pendente.enviada_em >= self.prazo_consumo:
+                self._retirar(pendente, caminho)
+
+
+    def _esquecer(self, pendente):
+        with self._condicao:
+            self._remessas.pop(pendente, None)
+
+
+    def _retirar(self, pendente, caminho):
+        retirada = caminho + '.retirada'
+        try:
+            os.rename(caminho, retirada)
+        except OSError:
+            # consumida pelo Integrador enquanto o prazo se esgotava
+            return
+        try:
+            os.remove(retirada)
+        except OSError:
+            pass
+        self._esquecer(pendente)
+        self._parado = True
+        logger.warning('Integrador parado; remessa retirada da pasta de '
+                       'input: %s', caminho)
+        pendente.parada = True
+        self._despachante.descartar(pendente)
+        pendente.entregar(
+                resposta_integrador_parado(pendente.numero_identificador),
+                None)
+
+
+    def _executar(self):
+        while True:
+            with self._condicao:
+                while not self._remessas and not self._parar:
+                    self._condicao.wait()
+                if self._parar:
+                    return
+            try:
+                self.verificar()
+            except Exception:
+                logger.exception('Falha ao verificar o consumo das remessas')
+            with self._condicao:
+                if not self._parar:
+                    intervalo = self._intervalo
+                    self._intervalo = min(intervalo * self.FATOR,
+                            self.INTERVALO_MAXIMO)
+                    self._condicao.wait(intervalo)
+
+
+PRIORIDADE_CANCELAMENTO = 0
+PRIORIDADE_PAGAMENTO = 1
+PRIORIDADE_VENDA = 2
+PRIORIDADE_DIAGNOSTICO = 3
+
+
+class Vaga(object):
+    """Uma solicitação de vaga na janela de remessas em andamento de um
+    :class:`AgendadorRemessas`.
+    """
+
+    def __init__(self, prioridade, sequencia, iniciar):
+        self.prioridade = prioridade
+        self.sequencia = sequencia
+        self.iniciar = iniciar
+        self.iniciada = False
+        self.cancelada = False
+        self.liberada = False
+
+    def __lt__(self, outra):
+        return (self.prioridade, self.sequencia) < \
+                (outra.prioridade, outra.sequencia)
+
+
+class AgendadorRemessas(object):
+    """Limita a quantidade de remessas em andamento em um mesmo equipamento
+    (a janela), colocando as demais em uma fila ordenada por prioridade e, em
+    seguida, pela ordem de chegada. Assim, um cancelamento solicitado durante
+    uma rajada de vendas é o próximo a ser escrito na pasta de *input*, em vez
+    de aguardar atrás de todas as vendas.
+
+    As prioridades, da maior para a menor, são :attr:`PRIORIDADE_CANCELAMENTO`,
+    :attr:`PRIORIDADE_PAGAMENTO`, :attr:`PRIORIDADE_VENDA` e
+    :attr:`PRIORIDADE_DIAGNOSTICO` (também a das operações sem regra
+    específica).
+
+    .. sourcecode:: python
+
+        >>> agendador = AgendadorRemessas(janela=1)
+        >>> iniciadas = []
+        >>> venda = agendador.solicitar('EnviarDadosVenda.xml',
+        ...         lambda vaga: iniciadas.append('venda'))
+        >>> consulta = agendador.solicitar('ConsultarSAT.xml',
+        ...         lambda vaga: iniciadas.append('consulta'))
+        >>> cancelamento = agendador.solicitar('CancelarUltimaVenda.xml',
+        ...         lambda vaga: iniciadas.append('cancelamento'))
+        >>> agendador.liberar(venda)
+        >>> agendador.liberar(cancelamento)
+        >>> iniciadas
+        ['venda', 'cancelamento', 'consulta']
+
+    :param int janela: Opcional. Quantidade máxima de remessas em andamento.
+        Se ``None``, as remessas nunca aguardam na fila.
+
+    :param prioridades: Opcional. Prioridades específicas, por nome da
+        operação, que complementam ou substituem as de :attr:`PRIORIDADES`.
+    """
+
+    PRIORIDADES = {
+            'CancelarUltimaVenda': PRIORIDADE_CANCELAMENTO,
+            'EnviarPagamento': PRIORIDADE_PAGAMENTO,
+            'EnviarStatusPagamento': PRIORIDADE_PAGAMENTO,
+            'VerificarStatusValidador': PRIORIDADE_PAGAMENTO,
+            'RespostaFiscal': PRIORIDADE_PAGAMENTO,
+            'EnviarDadosVenda': PRIORIDADE_VENDA,
+            'ConsultarNumeroSessao': PRIORIDADE_VENDA,
+        }
+    """Prioridades padrão, por operação."""
+
+    def __init__(self, janela=None, **prioridades):
+        self.janela = janela
+        self._prioridades = dict((k.lower(), v) for k, v in
+                itertools.chain(self.PRIORIDADES.items(), prioridades.items()))
+        self._fila = []
+        self._sequencia = itertools.count()
+        self._em_andamento = 0
+        self._lock = threading.Lock()
+
+
+    @property
+    def em_andamento(self):
+        """Quantidade de remessas ocupando a janela."""
+        return self._em_andamento
+
+
+    @property
+    def na_fila(self):
+        """Quantidade de remessas aguardando por uma vaga."""
+        with self._lock:
+            return sum(1 for vaga in self._fila if not vaga.cancelada)
+
+
+    def prioridade(self, template):
+        """Prioridade da operação do template informado."""
+        return self._prioridades.get(nome_operacao(template).lower(),
+                                     PRIORIDADE_DIAGNOSTICO)
+
+
+    def solicitar(self, template, iniciar):
+        """Solicita uma vaga para a remessa do template informado. A função
+        ``iniciar`` é invocada, recebendo a :class:`Vaga`, quando a vaga for
+        concedida:
+        imediatamente, pela própria *thread*, se houver vaga, ou mais tarde,
+        pela *thread* que liberar uma vaga. Por isso, deve apenas sinalizar
+        quem irá escrever a remessa e retornar rapidamente.
+
+        :return: A :class:`Vaga`, que deve ser liberada (:meth:`liberar`)
+            quando a remessa não estiver mais em andamento, ou cancelada
+            (:meth:`cancelar`) se não for mais necessária.
+        :rtype: Vaga
+        """
+        vaga = Vaga(self.prioridade(template), next(self._sequencia), iniciar)
+        with self._lock:
+            if self.janela is None or (not self._fila and
+                    self._em_andamento < self.janela):
+                self._em_andamento += 1
+                vaga.iniciada = True
+            else:
+                heapq.heappush(self._fila, vaga)
+        if vaga.iniciada:
+            self._iniciar(vaga)
+        return vaga
+
+
+    def cancelar(self, vaga):
+        """Cancela uma solicitação que ainda esteja na fila.
+
+        :return: ``True`` se a solicitação foi cancelada ou ``False`` se a
+            vaga já havia sido concedida (e, portanto, deve ser liberada).
+        :rtype: bool
+        """
+        with self._lock:
+            if vaga.iniciada:
+                return False
+            vaga.cancelada = True
+            return True
+
+
+    def liberar(self, vaga):
+        """Libera a vaga concedida, concedendo-a à próxima solicitação da
+        fila. Liberar a mesma vaga mais de uma vez não tem efeito.
+        """
+        proxima = None
+        with self._lock:
+            if not vaga.iniciada or vaga.liberada:
+                return
+            vaga.liberada = True
+            self._em_andamento -= 1
+            while self._fila and (self.janela is None or
+                    self._em_andamento < self.janela):
+                candidata = heapq.heappop(self._fila)
+                if not candidata.cancelada:
+                    candidata.iniciada = True
+                    self._em_andamento += 1
+                    proxima = candidata
+                    break
+        if proxima is not None:
+            self._iniciar(proxima)
+
+
+    def _iniciar(self, vaga):
+        try:
+            vaga.iniciar(vaga)
+        except Exception:
+            logger.exception('Falha ao iniciar remessa agendada')
+
+
+_PADRAO_CHAVE_CFE = re.compile(r'^CFe\d{44}$')
+
+
+def extrair_chave(resposta):
+    """Obtém a chave do CF-e (prefixada com ``CFe``) presente em uma resposta
+    *verbatim* do Integrador, como as respostas de ``EnviarDadosVenda`` e
+    ``CancelarUltimaVenda``.
+
+    .. sourcecode:: python
+
+        >>> extrair_chave('1|06000|0000|Emitido com sucesso|||arq|20150709|'
+        ...     'CFe35150708723218000186599000040190000241143484|5.75|||1')
+        'CFe35150708723218000186599000040190000241143484'
+        >>> assert extrair_chave('1|08000|SAT em operacao|||1') is None
+
+    :return: A chave do CF-e ou ``None`` se a resposta não contiver uma chave.
+    """
+    if not isinstance(resposta, basestring):
+        return None
+    for campo in resposta.split('|'):
+        if _PADRAO_CHAVE_CFE.match(campo):
+            return campo
+    return None
+
+
+RespostaTardia = collections.namedtuple('RespostaTardia',
+        'numero_identificador resposta src_path chave recebida_em')
+"""Uma resposta encontrada na pasta de *output* para a qual não havia remessa
+aguardando, seja porque o tempo limite se esgotou antes de a resposta chegar,
+seja porque a resposta já estava lá quando o despachante foi iniciado.
+"""
+
+
+class RespostasTardias(object):
+    """Mantém as respostas tardias (:class:`RespostaTardia`) mais recentes,
+    permitindo reconciliar comandos cujo tempo limite se esgotou (por exemplo,
+    para descobrir se uma venda foi emitida antes de enviá-la novamente).
+
+    :param int capacidade: Quantidade máxima de respostas mantidas. As
+        respostas mais antigas são descartadas primeiro.
+    """
+
+    def __init__(self, capacidade=1000):
+        self._capacidade = capacidade
+        self._respostas = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._respostas)
+
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._respostas.values()))
+
+
+    def registrar(self, numero_identificador, resposta, src_path):
+        tardia = RespostaTardia(str(numero_identificador), resposta, src_path,
+                extrair_chave(resposta), time.time())
+        with self._lock:
+            self._respostas.pop(tardia.numero_identificador, None)
+            self._respostas[tardia.numero_identificador] = tardia
+            while len(self._respostas) > self._capacidade:
+                self._respostas.popitem(last=False)
+        return tardia
+
+
+    def por_identificador(self, numero_identificador, desde=None):
+        """Obtém a resposta tardia pelo número identificador da remessa.
+
+        :param float desde: Opcional. Se informado, considera apenas uma
+            resposta recebida a partir deste momento (como em
+            :func:`time.time`).
+
+        :rtype: RespostaTardia
+        """
+        with self._lock:
+            tardia = self._respostas.get(str(numero_identificador))
+        if tardia is not None and desde is not None \
+                and tardia.recebida_em < desde:
+            return None
+        return tardia
+
+
+    def por_chave(self, chave):
+        """Obtém a resposta tardia pela chave do CF-e, com ou sem o prefixo
+        ``CFe``.
+
+        :rtype: RespostaTardia
+        """
+        if not chave.startswith('CFe'):
+            chave = 'CFe' + chave
+        with self._lock:
+            for tardia in reversed(self._respostas.values()):
+                if tardia.chave == chave:
+                    return tardia
+        return None
+
+
+class DespachanteIntegrador(object):
+    """Observa, com um único observador de longa duração, a pasta de
+    *output* do Integrador, encaminhando cada resposta para a
+    :class:`RespostaPendente` registrada sob o mesmo número identificador.
+
+    O observador é iniciado na primeira vez em que uma resposta for registrada
+    e permanece ativo até que :meth:`parar` seja invocado.
+
+    Remessas cujo tempo limite se esgotou são marcadas como expiradas
+    (:meth:`expirar`). Se a resposta de uma remessa expirada chegar mais tarde,
+    ela é guardada em :attr:`respostas_tardias`, assim como as respostas que
+    já estavam na pasta de *output* quando o observador foi iniciado.
+
+    :param str caminho: Caminho completo para a pasta de *output*.
+
+    :param bool varrer_orfaos: Se as respostas já existentes na pasta de
+        *output* devem ser guardadas em :attr:`respostas_tardias` quando o
+        observador for iniciado. A varredura é feita em segundo plano.
+
+    :param int observacao: Opcional. Como a pasta de *output* é observada,
+        devendo ser uma das constantes :attr:`OBSERVAR_AUTOMATICO` (padrão),
+        :attr:`OBSERVAR_EVENTOS`, :attr:`OBSERVAR_VARREDURA` ou
+        :attr:`OBSERVAR_INOTIFY`.
+
+    :param float prazo_consumo: Opcional. Prazo para que as remessas sejam
+        consumidas da pasta de *input* (veja :class:`VigiaConsumo`). Se
+        ``None`` (padrão), o Integrador nunca é considerado parado.
+
+    :param bool medir_consumo: Opcional. Se o momento do consumo das remessas
+        deve ser registrado mesmo sem um prazo de consumo (veja
+        :class:`VigiaConsumo`).
+
+    :param int janela: Opcional. Quantidade máxima de remessas em andamento
+        ao mesmo tempo (veja :class:`AgendadorRemessas`). Se ``None``, as
+        remessas são escritas imediatamente.
+
+    :param coordenador: Opcional. Um
+        :class:`~mfecfe.coordenacao.CoordenadorIntegrador`, quando vários
+        processos compartilham a mesma pasta do Integrador. Apenas o processo
+        dono observa a pasta de *output*; os demais recebem dele as suas
+        respostas e as suas vagas no agendador.
+    """
+
+    MEMORIA_EXPIRADOS = 1000
+    """Quantidade máxima de remessas expiradas cujas respostas tardias ainda
+    são aguardadas.
+    """
+
+    def __init__(self, caminho, varrer_orfaos=True,
+                 observacao=OBSERVAR_AUTOMATICO, prazo_consumo=None,
+                 janela=None, coordenador=None, medir_consumo=False):
+        self._caminho = caminho
+        self._observacao = observacao
+        self._pendentes = {}
+        self._expirados = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._observer = None
+        self._vigia = VigiaPrazos()
+        self._consumo = VigiaConsumo(self, prazo_consumo=prazo_consumo,
+                medir=medir_consumo)
+        self._agendador = AgendadorRemessas(janela=janela)
+        self._coordenador = coordenador
+        self._respostas_tardias = RespostasTardias()
+        self._varrer_orfaos = varrer_orfaos
+
+
+    @property
+    def caminho(self):
+        return self._caminho
+
+
+    @property
+    def vigia(self):
+        """A :class:`VigiaPrazos` usada para expirar respostas pendentes."""
+        return self._vigia
+
+
+    @property
+    def agendador(self):
+        """O :class:`AgendadorRemessas` das remessas deste equipamento (ou,
+        em um processo coordenado que não é o dono, o
+        :class:`~mfecfe.coordenacao.AgendadorRemoto`).
+        """
+        if self._coordenador is None:
+            return self._agendador
+        self.iniciar()
+        return self._coordenador.agendador(self._agendador)
+
+
+    @property
+    def coordenador(self):
+        return self._coordenador
+
+
+    @property
+    def consumo(self):
+        """A :class:`VigiaConsumo` das remessas escritas na pasta de
+        *input*.
+        """
+        return self._consumo
+
+
+    @property
+    def integrador_parado(self):
+        """Indica se o Integrador parou de consumir as remessas (veja
+        :class:`VigiaConsumo`). Enquanto for ``True``, novas operações podem
+        ser desviadas para a contingência.
+        """
+        return self._consumo.parado
+
+
+    @property
+    def respostas_tardias(self):
+        """As :class:`RespostasTardias` encontradas por este despachante."""
+        return self._respostas_tardias
+
+
+    @property
+    def observacao(self):
+        """Como a pasta de *output* é observada: :attr:`OBSERVAR_EVENTOS`,
+        :attr:`OBSERVAR_VARREDURA` ou :attr:`OBSERVAR_INOTIFY`. No modo
+        :attr:`OBSERVAR_AUTOMATICO`, a decisão é tomada na primeira consulta.
+        """
+        if self._observacao == OBSERVAR_AUTOMATICO:
+            if sistema_arquivos_remoto(self._caminho):
+                logger.info('Pasta de output em sistema de arquivos remoto, '
+                            'observada por varredura: %s', self._caminho)
+                self._observacao = OBSERVAR_VARREDURA
+            elif inotify.disponivel():
+                self._observacao = OBSERVAR_INOTIFY
+            elif Observer is not None:
+                self._observacao = OBSERVAR_EVENTOS
+            else:
+                self._observacao = OBSERVAR_VARREDURA
+        return self._observacao
+
+
+    @property
+    def ativo(self):
+        return self._observer is not None
+
+
+    def iniciar(self):
+        """Inicia o observador da pasta de *output*, se ainda não iniciado.
+        Em um processo coordenado, apenas o processo dono observa a pasta.
+        """
+        if self._coordenador is not None and \
+                not self._coordenador.iniciar(self):
+            return
+        with self._lock:
+            if self._observer is None:
+                monitor = MonitorIntegrador(self)
+                if self.observacao == OBSERVAR_VARREDURA:
+                    instantaneo = _listar(self._caminho)
+                    orfaos = list(instantaneo)
+                    observer = ObservadorVarredura(monitor, self._caminho,
+                            instantaneo=instantaneo)
+                elif self.observacao == OBSERVAR_INOTIFY:
+                    observer = inotify.ObservadorInotify(monitor,
+                            self._caminho)
+                    orfaos = os.listdir(self._caminho)
+                else:
+                    if Observer is None:
+                        raise RuntimeError('O watchdog nao esta instalado; '
+                                'use outra forma de observacao')
+                    orfaos = os.listdir(self._caminho)
+                    observer = Observer()
+                    observer.schedule(monitor, path=self._caminho)
+                if not self._varrer_orfaos:
+                    orfaos = []
+                observer.start()
+                self._observer = observer
+                if orfaos:
+                    varredura = threading.Thread(target=self.varrer_orfaos,
+                            args=(orfaos,), name='VarreduraOrfaos')
+                    varredura.daemon = True
+                    varredura.start()
+
+
+    def varrer_orfaos(self, nomes=None):
+        """Guarda em :attr:`respostas_tardias` as respostas encontradas na
+        pasta de *output*. As respostas nunca são entregues a remessas
+        pendentes, já que pertencem a execuções anteriores.
+
+        :param list nomes: Opcional. Nomes dos arquivos a considerar. Se não
+            informado, todos os arquivos da pasta de *output* são considerados.
+
+        :return: Quantidade de respostas guardadas.
+        :rtype: int
+        """
+        quantidade = 0
+        for nome in sorted(nomes if nomes is not None else os.listdir(self._caminho)):
+            caminho = os.path.join(self._caminho, nome)
+            if not nome.endswith('.xml') or \
+                    assinatura_arquivo_completo(caminho) is None:
+                continue
+            try:
+                numero_identificador, resposta = ler_resposta(caminho)
+            except Exception:
+                logger.exception('Falha ao ler resposta orfa: %s', caminho)
+                continue
+            if numero_identificador is not None:
+                self._respostas_tardias.registrar(
+                        numero_identificador, resposta, caminho)
+                quantidade += 1
+        return quantidade
+
+
+    def parar(self):
+        """Para o observador da pasta de *output*."""
+        with self._lock:
+            observer, self._observer = self._observer, None
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        self._consumo.parar()
+        if self._coordenador is not None:
+            self._coordenador.parar()
+
+
+    def registrar(self, numero_identificador):
+        """Registra uma remessa que irá aguardar pela resposta do Integrador.
+        A remessa deve ser registrada *antes* de ser escrita na pasta de
+        *input*, para que a resposta não seja perdida.
+
+        :return: A resposta pendente registrada.
+        :rtype: RespostaPendente
+
+        :raises ValueError: Se já houver uma remessa em andamento com o mesmo
+            número identificador.
+        """
+        self.iniciar()
+        pendente = RespostaPendente(numero_identificador)
+        with self._lock:
+            if pendente.numero_identificador in self._pendentes:
+                raise ValueError('Numero identificador ja possui remessa '
+                        'em andamento: {!r}'.format(numero_identificador))
+            self._pendentes[pendente.numero_identificador] = pendente
+            self._expirados.pop(pendente.numero_identificador, None)
+            observer = self._observer
+        if self._coordenador is not None:
+            self._coordenador.aguardar(pendente.numero_identificador)
+        if isinstance(observer, ObservadorVarredura):
+            # a resposta tende a chegar logo após a remessa ser escrita
+            observer.acordar()
+        return pendente
+
+
+    def acompanhar(self, pendente, caminho):
+        """Acompanha o consumo da remessa escrita na pasta de *input* (veja
+        :class:`VigiaConsumo`).
+        """
+        self._consumo.acompanhar(pendente, caminho)
+
+
+    def pendente(self, pendente):
+        """Indica se a resposta pendente ainda aguarda pela resposta."""
+        with self._lock:
+            return self._pendentes.get(pendente.numero_identificador) \
+                    is pendente and not pendente.entregue
+
+
+    def aguardados(self):
+        """Números identificadores das remessas pendentes e expiradas."""
+        with self._lock:
+            return list(self._pendentes) + list(self._expirados)
+
+
+    def aguardando(self, numero_identificador):
+        """Indica se há uma remessa aguardando pela resposta com o número
+        identificador informado, neste ou, se coordenado, em outro processo.
+        """
+        if numero_identificador is None:
+            return False
+        with self._lock:
+            if str(numero_identificador) in self._pendentes or \
+                    str(numero_identificador) in self._expirados:
+                return True
+        return self._coordenador is not None and \
+                self._coordenador.aguardando_remoto(numero_identificador)
+
+
+    def notificar_progresso(self):
+        """Registra um sinal de atividade do Integrador (veja
+        :meth:`VigiaConsumo.progresso`), repassando-o aos demais processos
+        coordenados.
+        """
+        self._consumo.progresso()
+        if self._coordenador is not None:
+            self._coordenador.progresso()
+
+
+    def expirar(self, pendente):
+        """Remove a resposta pendente da tabela de despacho, marcando o seu
+        número identificador como expirado. Se a resposta chegar mais tarde,
+        será guardada em :attr:`respostas_tardias`.
+        """
+        with self._lock:
+            if self._pendentes.get(pendente.numero_identificador) is pendente:
+                del self._pendentes[pendente.numero_identificador]
+            self._expirados[pendente.numero_identificador] = time.time()
+            while len(self._expirados) > self.MEMORIA_EXPIRADOS:
+                self._expirados.popitem(last=False)
+        if pendente.entregue:
+            # a resposta chegou enquanto o tempo limite se esgotava
+            self._respostas_tardias.registrar(pendente.numero_identificador,
+                    pendente.resposta, pendente.src_path)
+
+
+    def descartar(self, pendente):
+        """Remove a resposta pendente da tabela de despacho. Apenas a própria
+        :class:`RespostaPendente` é removida, mesmo que o seu número
+        identificador já tenha sido registrado novamente por outra *thread*.
+        """
+        with self._lock:
+            if self._pendentes.get(pendente.numero_identificador) is pendente:
+                del self._pendentes[pendente.numero_identificador]
+
+
+    def despachar(self, numero_identificador, resposta, src_path):
+        """Entrega a resposta para a remessa registrada sob o número
+        identificador, se houver.
+
+        :return: ``True`` se havia uma remessa aguardando pela resposta.
+        :rtype: bool
+        """
+        with self._lock:
+            pendente = self._pendentes.pop(str(numero_identificador), None)
+            expirado = self._expirados.pop(str(numero_identificador), None)
+        if pendente is None:
+            if expirado is None and self._coordenador is not None and \
+                    self._coordenador.encaminhar(
+                            numero_identificador, resposta, src_path):
+                return True
+            if expirado is not None:
+                logger.warning('Resposta tardia: %s (%s)',
+                               numero_identificador, src_path)
+                self._respostas_tardias.registrar(
+                        numero_identificador, resposta, src_path)
+            return False
+        pendente.entregar(resposta, src_path)
+        return True
@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/roteador.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Roteia as operações entre vários equipamentos MF-e, cada um com a sua própria
+pasta do Integrador, a partir de um único processo.
+
+.. sourcecode:: python
+
+    roteador = RoteadorSAT()
+    roteador.adicionar('mfe-1', ClienteSATLocal(BibliotecaSAT('/mnt/mfe1'),
+            codigo_ativacao='12345678'), caixas=[1, 2, 3])
+    roteador.adicionar('mfe-2', ClienteSATLocal(BibliotecaSAT('/mnt/mfe2'),
+            codigo_ativacao='12345678'), caixas=[4, 5])
+
+    resposta = roteador.enviar_dados_venda(cfe_venda)  # pelo numeroCaixa
+    roteador.cancelar_ultima_venda(resposta.chaveConsulta, cfe_canc)
+
+As vendas são enviadas ao equipamento ao qual o caixa está vinculado ou, se o
+caixa não estiver vinculado, ao equipamento disponível com menos operações em
+andamento. Operações que alteram o estado do equipamento nunca são repetidas
+em outro equipamento, pois a remessa pode ter sido processada mesmo sem
+resposta; apenas as consultas são repetidas no próximo equipamento quando o
+Integrador não responde.
+"""
+
+import collections
+import logging
+import re
+import threading
+
+import requests
+
+from .base import MENSAGEM_ERRO_INTERNO
+from .clientelocal import LOTE_SIMULTANEAS
+from .clientelocal import analisar_quando_concluido
+from .clientelocal import enviar_lote
+from .excecoes import ErroEquipamentoIndisponivel
+from .excecoes import ExcecaoRespostaSAT
+from .integrador import MENSAGEM_INTEGRADOR_PARADO
+from .integrador import relogio
+
+
+logger = logging.getLogger('satcfe')
+
+
+LIMITE_FALHAS = 3
+"""Falhas de comunicação consecutivas a partir das quais um equipamento é
+considerado indisponível.
+"""
+
+QUARENTENA = 30.0
+"""Tempo, em segundos, após a última falha, durante o qual um equipamento
+indisponível deixa de receber operações. Esgotada a quarentena, a próxima
+operação é enviada ao equipamento para verificar se voltou a responder.
+"""
+
+FALHAS_DE_TRANSPORTE = (OSError, IOError, requests.RequestException)
+"""Exceções que indicam uma falha na comunicação com o equipamento. As demais,
+como as produzidas por dados inválidos do chamador, não afetam a saúde do
+equipamento.
+"""
+
+MEMORIA_VENDAS = 10000
+"""Quantidade de chaves de CF-e de venda cujos equipamentos emissores o
+roteador se lembra, para encaminhar os cancelamentos.
+"""
+
+_NUMERO_CAIXA = re.compile(r'<numeroCaixa>\s*(\d+)\s*</numeroCaixa>')
+
+
+SaudeEquipamento = collections.namedtuple('SaudeEquipamento',
+        'nome disponivel em_andamento falhas integrador_parado')
+"""Situação de um equipamento do :class:`RoteadorSAT` (veja
+:meth:`RoteadorSAT.saude`).
+"""
+
+
+def numero_caixa(dados):
+    """Obtém o número do caixa (atributo ``numeroCaixa``) de uma instância de
+    :class:`~satcfe.entidades.CFeVenda` ou
+    :class:`~satcfe.entidades.CFeCancelamento`, ou do seu XML.
+
+    .. sourcecode:: python
+
+        >>> numero_caixa('<ide><numeroCaixa>007</numeroCaixa></ide>')
+        7
+        >>> numero_caixa('<ide></ide>') is None
+        True
+
+    """
+    numero = getattr(dados, 'numeroCaixa', None)
+    if numero is None and isinstance(dados, (bytes, type(u''))):
+        if isinstance(dados, bytes):
+            dados = dados.decode('utf-8', 'replace')
+        encontrado = _NUMERO_CAIXA.search(dados)
+        numero = encontrado and encontrado.group(1)
+    return None if numero is None else int(numero)
+
+
+def numero_serie(chave_cfe):
+    """Obtém o número de série do equipamento SAT a partir da chave de acesso
+    do CF-e (com ou sem o prefixo ``CFe``).
+
+    .. sourcecode:: python
+
+        >>> numero_serie('CFe35150708723218000186599000040190000241143484')
+        '900004019'
+
+    """
+    digitos = re.sub(r'\D', '', chave_cfe or '')
+    return digitos[22:31] if len(digitos) == 44 else None
+
+
+def falha_de_comunicacao(erro):
+    """Indica se a exceção resulta de uma falha de comunicação com o
+    equipamento (falha de E/S ou de rede, o Integrador não respondeu ou parou
+    de consumir as remessas), e não de uma resposta do equipamento ou de dados
+    inválidos informados pelo chamador.
+    """
+    if isinstance(erro, FALHAS_DE_TRANSPORTE):
+        return True
+    if not isinstance(erro, ExcecaoRespostaSAT):
+        return False
+    valores = vars(erro.resposta).values()
+    return MENSAGEM_ERRO_INTERNO in valores or \
+            MENSAGEM_INTEGRADOR_PARADO in valores
+
+
+class Equipamento(object):
+    """Um equipamento gerenciado pelo :class:`RoteadorSAT`, cuja saúde é
+    acompanhada a partir do resultado das operações enviadas a ele.
+    """
+
+    def __init__(self, nome, cliente, caixas=(), numero_serie=None,
+                 limite_falhas=LIMITE_FALHAS, quarentena=QUARENTENA):
+        self._nome = nome
+        self._cliente = cliente
+        self._caixas = frozenset(int(c) for c in caixas)
+        self._numero_serie = numero_serie
+        self._limite_falhas = limite_falhas
+        self._quarentena = quarentena
+        self._em_andamento = 0
+        self._falhas = 0
+        self._ultima_falha = None
+        self._sondando = False
+        self._lock = threading.Lock()
+
+
+    @property
+    def nome(self):
+        return self._nome
+
+
+    @property
+    def cliente(self):
+        """O :class:`~satcfe.clientelocal.ClienteSATLocal` do equipamento."""
+        return self._cliente
+
+
+    @property
+    def caixas(self):
+        return self._caixas
+
+
+    @property
+    def numero_serie(self):
+        return self._numero_serie
+
+
+    @property
+    def em_andamento(self):
+        return self._em_andamento
+
+
+    @property
+    def integrador_parado(self):
+        despachante = getattr(self._cliente.biblioteca, 'despachante', None)
+        return despachante is not None and despachante.integrador_parado
+
+
+    @property
+    def disponivel(self):
+        """Indica se o equipamento deve receber novas operações. Um equipamento
+        com :data:`LIMITE_FALHAS` falhas consecutivas recebe uma única
+        operação, a sondagem, quando a quarentena se esgota, e continua
+        indisponível até que a sondagem seja concluída.
+        """
+        if self.integrador_parado:
+            return False
+        with self._lock:
+            return self._falhas < self._limite_falhas or \
+                    not self._sondando and \
+                    relogio() - self._ultima_falha >= self._quarentena
+
+
+    def iniciar(self):
+        """Registra o início de uma operação. Se o equipamento estiver
+        indisponível e a quarentena tiver se esgotado, a operação é a
+        sondagem do equipamento, até que seja concluída.
+
+        :return: ``True`` se a operação for a sondagem, a ser informado a
+            :meth:`concluir`.
+        :rtype: bool
+
+        :raises ErroEquipamentoIndisponivel: Se o equipamento estiver em
+            quarentena ou outra operação já o estiver sondando.
+        """
+        with self._lock:
+            sondagem = self._falhas >= self._limite_falhas
+            if sondagem:
+                if self._sondando or \
+                        relogio() - self._ultima_falha < self._quarentena:
+                    raise ErroEquipamentoIndisponivel(
+                            'Equipamento {!r} indisponivel'.format(self._nome))
+                self._sondando = True
+            self._em_andamento += 1
+        return sondagem
+
+
+    def concluir(self, erro=None, sondagem=False):
+        """Registra a conclusão de uma operação iniciada através de
+        :meth:`iniciar`, com a exceção resultante, se houver. Uma sondagem
+        bem sucedida torna o equipamento disponível; se falhar, o equipamento
+        volta à quarentena.
+        """
+        with self._lock:
+            self._em_andamento -= 1
+            if sondagem:
+                self._sondando = False
+            if erro is not None and falha_de_comunicacao(erro):
+                self._falhas += 1
+                self._ultima_falha = relogio()
+                falhas = self._falhas
+            else:
+                self._falhas = 0
+                falhas = 0
+        if falhas == self._limite_falhas:
+            logger.warning('Equipamento indisponivel: %s (%s)',
+                           self._nome, erro)
+
+
+    def saude(self):
+        return SaudeEquipamento(self._nome, self.disponivel,
+                self._em_andamento, self._falhas, self.integrador_parado)
+
+
+class RoteadorSAT(object):
+    """Distribui as operações entre vários equipamentos, cada um representado
+    por um :class:`~satcfe.clientelocal.ClienteSATLocal` com a sua própria
+    :class:`~satcfe.base.BibliotecaSAT` (veja :meth:`adicionar`).
+
+    :param int limite_falhas: Falhas de comunicação consecutivas a partir das
+        quais um equipamento é considerado indisponível.
+
+    :param float quarentena: Tempo, em segundos, durante o qual um
+        equipamento indisponível deixa de receber operações.
+    """
+
+    def __init__(self, limite_falhas=LIMITE_FALHAS, quarentena=QUARENTENA):
+        self._limite_falhas = limite_falhas
+        self._quarentena = quarentena
+        self._equipamentos = collections.OrderedDict()
+        self._caixas = {}
+        self._vendas = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    @property
+    def equipamentos(self):
+        return list(self._equipamentos.values())
+
+
+    def adicionar(self, nome, cliente, caixas=(), numero_serie=None):
+        """Adiciona um equipamento ao roteador.
+
+        :param str nome: Nome único do equipamento.
+
+        :param cliente: O :class:`~satcfe.clientelocal.ClienteSATLocal` do
+            equipamento.
+
+        :param caixas: Números dos caixas vinculados ao equipamento, cujas
+            vendas serão enviadas sempre a ele.
+
+        :param str numero_serie: Opcional. Número de série do equipamento,
+            usado para encaminhar o cancelamento de vendas emitidas antes do
+            roteador ser iniciado.
+
+        :rtype: Equipamento
+        """
+        if nome in self._equipamentos:
+            raise ValueError('Equipamento ja adicionado: {!r}'.format(nome))
+        equipamento = Equipamento(nome, cliente, caixas=caixas,
+                numero_serie=numero_serie, limite_falhas=self._limite_falhas,
+                quarentena=self._quarentena)
+        for caixa in equipamento.caixas:
+            if caixa in self._caixas:
+                raise ValueError('Caixa {} ja vinculado ao equipamento '
+                        '{!r}'.format(caixa, self._caixas[caixa].nome))
+        for caixa in equipamento.caixas:
+            self._caixas[caixa] = equipamento
+        self._equipamentos[nome] = equipamento
+        return equipamento
+
+
+    def equipamento(self, nome):
+        """O :class:`Equipamento` com o nome informado. As operações
+        específicas de um equipamento (por exemplo,
+        ``consultar_numero_sessao``) são feitas diretamente através do seu
+        :attr:`~Equipamento.cliente`.
+        """
+        return self._equipamentos[nome]
+
+
+    def saude(self):
+        """Lista a :class:`SaudeEquipamento` de cada equipamento."""
+        return [e.saude() for e in self._equipamentos.values()]
+
+
+    def parar(self):
+        """Para os observadores das pastas de todos os equipamentos."""
+        for equipamento in self._equipamentos.values():
+            despachante = getattr(equipamento.cliente.biblioteca,
+                                  'despachante', None)
+            if despachante is not None:
+                despachante.parar()
+
+
+    def escolher(self, numero_caixa=None):
+        """Escolhe o equipamento para uma venda do caixa informado: aquele ao
+        qual o caixa está vinculado ou, se não houver, o equipamento
+        disponível com menos operações em andamento.
+
+        :raises ErroEquipamentoIndisponivel: Se o equipamento escolhido não
+            estiver disponível.
+        """
+        equipamento = self._caixas.get(numero_caixa)
+        if equipamento is not None:
+            if not equipamento.disponivel:
+                raise ErroEquipamentoIndisponivel('Equipamento {!r} do caixa '
+                        '{} indisponivel'.format(equipamento.nome,
+                                                 numero_caixa))
+            return equipamento
+        disponiveis = [e for e in self._equipamentos.values() if e.disponivel]
+        if not disponiveis:
+            raise ErroEquipamentoIndisponivel('Nenhum equipamento disponivel')
+        return min(disponiveis, key=lambda e: e.em_andamento)
+
+
+    def emissor(self, chave_cfe, dados_cancelamento=None):
+        """Determina o equipamento que emitiu o CF-e da chave informada, a
+        partir das vendas enviadas pelo roteador, do número de série contido
+        na chave ou do caixa do cancelamento, nesta ordem.
+
+        :raises ErroEquipamentoIndisponivel: Se o equipamento emissor não
+            puder ser determinado.
+        """
+        chave = re.sub(r'\D', '', chave_cfe or '')
+        with self._lock:
+            equipamento = self._vendas.get(chave)
+        if equipamento is None:
+            serie = numero_serie(chave)
+            for candidato in self._equipamentos.values():
+                if serie is not None and candidato.numero_serie == serie:
+                    equipamento = candidato
+                    break
+            else:
+                equipamento = self._caixas.get(numero_caixa(dados_cancelamento))
+        if equipamento is None and len(self._equipamentos) == 1:
+            equipamento = self.equipamentos[0]
+        if equipamento is None:
+            raise ErroEquipamentoIndisponivel('Equipamento emissor do CF-e '
+                    'desconhecido: {}'.format(chave_cfe))
+        return equipamento
+
+
+    def _lembrar_venda(self, equipamento, resposta):
+        chave = re.sub(r'\D', '', getattr(resposta, 'chaveConsulta', '') or '')
+        if chave:
+            with self._lock:
+                self._vendas[chave] = equipamento
+                while len(self._vendas) > MEMORIA_VENDAS:
+                    self._vendas.popitem(last=False)
+        return resposta
+
+
+    def _executar(self, equipamento, operacao, *args, **kwargs):
+        sondagem = equipamento.iniciar()
+        try:
+            resposta = getattr(equipamento.cliente, operacao)(*args, **kwargs)
+        except Exception as erro:
+            equipamento.concluir(erro, sondagem)
+            raise
+        equipamento.concluir(sondagem=sondagem)
+        return resposta
+
+
+    def _executar_nowait(self, equipamento, operacao, *args, **kwargs):
+        sondagem = equipamento.iniciar()
+        try:
+            futuro = getattr(equipamento.cliente, operacao)(*args, **kwargs)
+        except Exception as erro:
+            equipamento.concluir(erro, sondagem)
+            raise
+
+        def _concluir(f):
+            equipamento.concluir(None if f.cancelled() else f.exception(),
+                                 sondagem)
+
+        futuro.add_done_callback(_concluir)
+        return futuro
+
+
+    def _consultar(self, operacao, nome=None):
+        # consultas não alteram o estado do equipamento e, por isso, podem ser
+        # repetidas no próximo equipamento se o Integrador não responder
+        if nome is not None:
+            return self._executar(self._equipamentos[nome], operacao)
+        candidatos = sorted(self._equipamentos.values(),
+                key=lambda e: (not e.disponivel, e.em_andamento))
+        if not candidatos:
+            raise ErroEquipamentoIndisponivel('Nenhum equipamento adicionado')
+        for equipamento in candidatos:
+            try:
+                return self._executar(equipamento, operacao)
+            except Exception as erro:
+                if not falha_de_comunicacao(erro) or \
+                        equipamento is candidatos[-1]:
+                    raise
+                logger.warning('%s falhou no equipamento %s: %s', operacao,
+                               equipamento.nome, erro)
+
+
+    def enviar_dados_venda(self, dados_venda, numero_identificador='False'):
+        """Envia a venda ao equipamento escolhido por :meth:`escolher`, a
+        partir do ``numeroCaixa`` da venda.
+
+        :rtype: satcfe.resposta.enviardadosvenda.RespostaEnviarDadosVenda
+        """
+        equipamento = self.escolher(numero_caixa(dados_venda))
+        resposta = self._executar(equipamento, 'enviar_dados_venda',
+                                  dados_venda, numero_identificador)
+        return self._lembrar_venda(equipamento, resposta)
+
+
+    def enviar_dados_venda_nowait(self, dados_venda,
+                                  numero_identificador='False'):
+        """Variante de :meth:`enviar_dados_venda` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        equipamento = self.escolher(numero_caixa(dados_venda))
+        futuro = self._executar_nowait(equipamento,
+                'enviar_dados_venda_nowait', dados_venda, numero_identificador)
+        return analisar_quando_concluido(futuro,
+                lambda resposta: self._lembrar_venda(equipamento, resposta))
+
+
+    def enviar_lote_vendas(self, vendas, simultaneas=LOTE_SIMULTANEAS):
+        """Envia um lote de vendas, distribuídas entre os equipamentos, como
+        em :meth:`~satcfe.clientelocal.ClienteSATLocal.enviar_lote_vendas`.
+        Uma venda que não possa ser enviada (por exemplo, porque o equipamento
+        do seu caixa está indisponível) resulta em um
+        :class:`~satcfe.clientelocal.ResultadoLote` com o erro.
+        """
+        return enviar_lote(self.enviar_dados_venda_nowait, vendas,
+                           simultaneas=simultaneas)
+
+
+    def cancelar_ultima_venda(self, chave_cfe, dados_cancelamento):
+        """Cancela a venda no equipamento que a emitiu (veja :meth:`emissor`).
+
+        :rtype: satcfe.resposta.cancelarultimavenda.RespostaCancelarUltimaVenda
+        """
+        equipamento = self.emissor(chave_cfe, dados_cancelamento)
+        return self._executar(equipamento, 'cancelar_ultima_venda',
+                              chave_cfe, dados_cancelamento)
+
+
+    def cancelar_ultima_venda_nowait(self, chave_cfe, dados_cancelamento):
+        """Variante de :meth:`cancelar_ultima_venda` que não aguarda pela
+        resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        equipamento = self.emissor(chave_cfe, dados_cancelamento)
+        return self._executar_nowait(equipamento,
+                'cancelar_ultima_venda_nowait', chave_cfe, dados_cancelamento)
+
+
+    def consultar_sat(self, equipamento=None):
+        """Consulta o equipamento informado (pelo nome) ou, se não informado,
+        o equipamento disponível com menos operações em andamento, passando
+        ao próximo se o Integrador não responder.
+
+        :rtype: satcfe.resposta.padrao.RespostaSAT
+        """
+        return self._consultar('consultar_sat', equipamento)
+
+
+    def consultar_status_operacional(self, equipamento=None):
+        """Consulta o status operacional, como em :meth:`consultar_sat`.
+
+        :rtype: satcfe.resposta.consultarstatusoperacional.RespostaConsultarStatusOperacional
+        """
+        return self._consultar('consultar_status_operacional', equipamento)
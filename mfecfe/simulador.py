@@ -0,0 +1,625 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/simulador.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Simulador do Integrador Fiscal, para testes de carga sem um equipamento SAT.
+O simulador observa a pasta ``input``, consome cada remessa e escreve na pasta
+``output`` uma resposta no mesmo formato do Integrador (nome do arquivo,
+*BOM*, ``Identificador`` e ``Resposta/retorno``), para todas as operações de
+``mfecfe/templates``, inclusive com os arquivos de CF-e em base64 e as chaves
+de consulta com dígito verificador válido.
+
+Pode ser usado a partir do código:
+
+.. sourcecode:: python
+
+    with SimuladorIntegrador('/tmp/Integrador', latencia=0.2, variacao=0.1):
+        cliente = ClienteSATLocal(BibliotecaSAT('/tmp/Integrador'))
+        cliente.consultar_sat()
+
+Ou como um processo independente:
+
+.. sourcecode:: shell
+
+    $ python -m mfecfe.simulador /tmp/Integrador --latencia 0.2 \\
+            --variacao 0.1 --taxa-erro 0.01 --trabalhadores 2
+
+"""
+
+import argparse
+import base64
+import codecs
+import collections
+import logging
+import os
+import random
+import threading
+import uuid
+
+from datetime import datetime
+from decimal import Decimal
+
+from lxml import etree
+from satcomum.util import modulo11
+
+from .integrador import publicar_arquivo
+
+
+logger = logging.getLogger('satcfe')
+
+
+SUCESSO = {
+        'AtivarSAT': ('04000', 'Ativado corretamente'),
+        'ComunicarCertificadoICPBRASIL': (
+                '05000', 'Certificado transmitido com sucesso'),
+        'EnviarDadosVenda': (
+                '06000', 'Emitido com sucesso + conteudo notas.'),
+        'CancelarUltimaVenda': (
+                '07000', 'Cupom cancelado com sucesso + conteudo CF-e-SAT '
+                'cancelado.'),
+        'ConsultarSAT': ('08000', 'SAT em operacao'),
+        'TesteFimAFim': ('09000', 'Emitido com sucesso'),
+        'ConsultarStatusOperacional': ('10000', 'Resposta com sucesso'),
+        'ConsultarNumeroSessao': ('11000', 'Sessao consultada'),
+        'ConfigurarInterfaceDeRede': ('12000', 'Rede Configurada com Sucesso'),
+        'AssociarAssinatura': ('13000', 'Assinatura do AC Registrada'),
+        'AtualizarSoftwareSAT': ('14000', 'Software Atualizado com Sucesso'),
+        'ExtrairLogs': ('15000', 'Transferencia completa'),
+        'BloquearSAT': ('16000', 'Equipamento SAT bloqueado com sucesso.'),
+        'DesbloquearSAT': (
+                '17000', 'Equipamento SAT desbloqueado com sucesso.'),
+        'TrocarCodigoDeAtivacao': (
+                '18000', 'Codigo de ativacao alterado com sucesso.'),
+    }
+"""Código ``EEEEE`` e mensagem de sucesso de cada função SAT."""
+
+
+ERRO_EM_PROCESSAMENTO = '098'
+ERRO_CODIGO_ATIVACAO = '001'
+MENSAGENS_ERRO = {
+        ERRO_EM_PROCESSAMENTO: 'SAT em processamento. Tente novamente.',
+        ERRO_CODIGO_ATIVACAO: 'Codigo de ativacao invalido',
+    }
+
+
+Remessa = collections.namedtuple('Remessa',
+        'numero_identificador componente metodo parametros')
+"""Uma remessa lida da pasta de *input*."""
+
+
+def ler_remessa(caminho):
+    """Lê uma remessa escrita na pasta de *input* do Integrador.
+
+    :rtype: Remessa
+    """
+    raiz = etree.parse(caminho).getroot()
+    componente = raiz.find('Componente')
+    metodo = componente.find('Metodo')
+    parametros = {}
+    for parametro in metodo.iter('Parametro'):
+        parametros[parametro.findtext('Nome')] = parametro.findtext('Valor')
+    return Remessa(raiz.findtext('Identificador/Valor'),
+            componente.get('Nome'), metodo.get('Nome'), parametros)
+
+
+def xml_resposta(numero_identificador, resposta):
+    """Produz o conteúdo de um arquivo de resposta do Integrador, com *BOM*.
+
+    :param resposta: O ``retorno`` *verbatim* (uma string) ou um dicionário
+        com os elementos de ``Resposta``, como nas respostas do VFP-e.
+
+    :rtype: bytes
+    """
+    raiz = etree.Element('Integrador')
+    etree.SubElement(etree.SubElement(raiz, 'Identificador'),
+            'Valor').text = str(numero_identificador)
+    situacao = etree.SubElement(raiz, 'IntegradorResposta')
+    etree.SubElement(situacao, 'Codigo').text = 'AP'
+    etree.SubElement(situacao, 'Valor').text = 'Arquivo processado'
+    elemento = etree.SubElement(raiz, 'Resposta')
+    if isinstance(resposta, dict):
+        for nome, valor in resposta.items():
+            etree.SubElement(elemento, nome).text = valor
+    else:
+        etree.SubElement(elemento, 'retorno').text = resposta
+    return codecs.BOM_UTF8 + etree.tostring(raiz,
+            xml_declaration=True, encoding='utf-8', pretty_print=True)
+
+
+def nome_resposta():
+    """Nome de um arquivo de resposta, como os produzidos pelo Integrador
+    (um UUID seguido da data e hora).
+    """
+    return '{}{}.xml'.format(uuid.uuid4().hex,
+            datetime.now().strftime('%Y%m%d%H%M%S'))
+
+
+class EquipamentoSimulado(object):
+    """Produz as respostas *verbatim* de um equipamento SAT (e do validador
+    fiscal) para as remessas do Integrador, mantendo o estado necessário para
+    respostas coerentes entre si: numeração dos CF-e, última venda (para
+    ``CancelarUltimaVenda``) e as respostas por número de sessão (para
+    ``ConsultarNumeroSessao``).
+
+    :param float taxa_erro: Probabilidade de uma função SAT resultar no erro
+        ``SAT em processamento``.
+
+    :param str codigo_ativacao: Opcional. Se informado, as funções que exigem
+        o código de ativação resultarão em erro caso o código não confira.
+
+    :param random: Opcional. Uma instância de :class:`random.Random`.
+    """
+
+    NUMERO_SERIE = '900004019'
+    CNPJ_EMITENTE = '08723218000186'
+    SESSOES = 100
+
+    def __init__(self, taxa_erro=0.0, codigo_ativacao=None, random=random):
+        self._taxa_erro = taxa_erro
+        self._codigo_ativacao = codigo_ativacao
+        self._random = random
+        self._lock = threading.Lock()
+        self._numero_cfe = 0
+        self._ultima_venda = None
+        self._sessoes = collections.OrderedDict()
+
+
+    def responder(self, remessa):
+        """Produz a resposta para a remessa.
+
+        :param Remessa remessa: A remessa lida da pasta de *input*.
+
+        :return: O ``retorno`` *verbatim* ou, para as funções do VFP-e, um
+            dicionário com os elementos da resposta.
+        """
+        if remessa.componente == 'VFP-e':
+            return self._responder_vfpe(remessa)
+
+        parametros = remessa.parametros
+        sessao = parametros.get('numeroSessao') or remessa.numero_identificador
+        metodo = remessa.metodo
+
+        codigo_ativacao = parametros.get('codigoDeAtivacao')
+        if self._codigo_ativacao and codigo_ativacao is not None \
+                and codigo_ativacao != self._codigo_ativacao:
+            retorno = self._erro(metodo, sessao, ERRO_CODIGO_ATIVACAO)
+        elif self._random.random() < self._taxa_erro:
+            retorno = self._erro(metodo, sessao, ERRO_EM_PROCESSAMENTO)
+        else:
+            retorno = getattr(self, '_' + metodo.lower(),
+                    self._padrao)(metodo, sessao, parametros)
+
+        if metodo != 'ConsultarNumeroSessao':
+            with self._lock:
+                self._sessoes[str(sessao)] = retorno
+                while len(self._sessoes) > self.SESSOES:
+                    self._sessoes.popitem(last=False)
+        return retorno
+
+
+    def _erro(self, metodo, sessao, erro):
+        prefixo = SUCESSO.get(metodo, ('99000',))[0][:2]
+        if metodo in ('EnviarDadosVenda', 'CancelarUltimaVenda'):
+            campos = [sessao, prefixo + erro, '0000', MENSAGENS_ERRO[erro],
+                    '', '']
+        else:
+            campos = [sessao, prefixo + erro, MENSAGENS_ERRO[erro], '', '']
+        return '|'.join(campos)
+
+
+    def _sucesso(self, metodo, sessao, *adicionais):
+        codigo, mensagem = SUCESSO.get(metodo, ('99000', 'Processado'))
+        return '|'.join((sessao, codigo, mensagem, '', '') + adicionais)
+
+
+    def _padrao(self, metodo, sessao, parametros):
+        return self._sucesso(metodo, sessao)
+
+
+    def _ativarsat(self, metodo, sessao, parametros):
+        return self._sucesso(metodo, sessao, '')
+
+
+    def _extrairlogs(self, metodo, sessao, parametros):
+        linhas = ['{} | info | simulador | sessao {}'.format(
+                datetime.now().strftime('%Y%m%d%H%M%S'), sessao)]
+        return self._sucesso(metodo, sessao,
+                base64.b64encode('\n'.join(linhas).encode('utf-8')).decode('ascii'))
+
+
+    def _consultarnumerosessao(self, metodo, sessao, parametros):
+        consultada = str(parametros.get('cNumeroDeSessao'))
+        with self._lock:
+            retorno = self._sessoes.get(consultada)
+        if retorno is None:
+            return '|'.join((sessao, '11003', 'Sessao nao existe', '', ''))
+        return retorno
+
+
+    def _consultarstatusoperacional(self, metodo, sessao, parametros):
+        agora = datetime.now().strftime('%Y%m%d%H%M%S')
+        with self._lock:
+            ultima = self._ultima_venda
+        ultimo_cfe = ultima[0][3:] if ultima else '0' * 44
+        return self._sucesso(metodo, sessao, self.NUMERO_SERIE, 'DHCP',
+                '010.042.000.133', '40:44:84:33:55:25', '255.255.255.000',
+                '010.042.000.001', '010.042.000.001', '010.042.000.001',
+                'CONECTADO', 'ALTO', '1 GB', '5 MB', agora, '01.00.00',
+                '00.07', ultimo_cfe, ultimo_cfe, ultimo_cfe, agora, agora,
+                '20170622', '20220622', '0')
+
+
+    def _emitir(self, dados_venda, cancelamento=None):
+        """Produz o CF-e autorizado (em base64), a chave de consulta, o valor
+        total e o CPF/CNPJ do destinatário.
+        """
+        try:
+            cfe = etree.fromstring(dados_venda.encode('utf-8')
+                    if not isinstance(dados_venda, bytes) else dados_venda)
+        except (etree.XMLSyntaxError, AttributeError, ValueError):
+            cfe = etree.Element('CFe' if cancelamento is None else 'CFeCanc')
+            etree.SubElement(cfe, 'infCFe')
+
+        inf = cfe.find('infCFe')
+        if inf is None:
+            inf = etree.SubElement(cfe, 'infCFe')
+
+        with self._lock:
+            self._numero_cfe = self._numero_cfe % 999999 + 1
+            numero_cfe = self._numero_cfe
+
+        agora = datetime.now()
+        cnpj = (inf.findtext('emit/CNPJ') or self.CNPJ_EMITENTE).zfill(14)
+        base = '35{}{}59{}{:06d}{:06d}'.format(agora.strftime('%y%m'), cnpj,
+                self.NUMERO_SERIE, numero_cfe, self._random.randint(0, 999999))
+        chave = 'CFe{}{}'.format(base, modulo11(base))
+
+        total = Decimal('0.00')
+        for prod in inf.iter('prod'):
+            try:
+                total += Decimal(prod.findtext('qCom') or '0') * \
+                        Decimal(prod.findtext('vUnCom') or '0')
+            except ArithmeticError:
+                pass
+        total = total.quantize(Decimal('0.01'))
+        destinatario = inf.findtext('dest/CPF') or \
+                inf.findtext('dest/CNPJ') or ''
+
+        inf.set('Id', chave)
+        ide = inf.find('ide')
+        if ide is None:
+            ide = etree.SubElement(inf, 'ide')
+        for nome, valor in (
+                ('cUF', '35'), ('cNF', base[-6:]), ('mod', '59'),
+                ('nserieSAT', self.NUMERO_SERIE),
+                ('nCFe', '{:06d}'.format(numero_cfe)),
+                ('dEmi', agora.strftime('%Y%m%d')),
+                ('hEmi', agora.strftime('%H%M%S')),
+                ('cDV', chave[-1])):
+            etree.SubElement(ide, nome).text = valor
+        if cancelamento is not None:
+            inf.set('chCanc', cancelamento)
+        etree.SubElement(etree.SubElement(inf, 'total'), 'vCFe').text = \
+                str(total)
+
+        arquivo = base64.b64encode(etree.tostring(cfe, encoding='utf-8'))
+        return arquivo.decode('ascii'), agora.strftime('%Y%m%d%H%M%S'), \
+                chave, total, destinatario, numero_cfe
+
+
+    def _assinatura_qrcode(self):
+        return base64.b64encode(bytearray(
+                self._random.getrandbits(8) for _ in range(256))).decode('ascii')
+
+
+    def _enviardadosvenda(self, metodo, sessao, parametros):
+        arquivo, momento, chave, total, destinatario, _ = \
+                self._emitir(parametros.get('dadosVenda'))
+        with self._lock:
+            self._ultima_venda = (chave, total, destinatario)
+        return '|'.join((sessao, '06000', '0000', SUCESSO[metodo][1], '', '',
+                arquivo, momento, chave, str(total), destinatario,
+                self._assinatura_qrcode()))
+
+
+    def _cancelarultimavenda(self, metodo, sessao, parametros):
+        chave_cancelada = parametros.get('chave') or ''
+        with self._lock:
+            ultima, self._ultima_venda = self._ultima_venda, None
+        if ultima is None or (chave_cancelada and ultima[0] != chave_cancelada):
+            return '|'.join((sessao, '07007', '0000',
+                    'Cupom a ser cancelado nao e o ultimo', '', ''))
+        arquivo, momento, chave, _, _, _ = self._emitir(
+                parametros.get('dadosCancelamento'), cancelamento=ultima[0])
+        return '|'.join((sessao, '07000', '0000', SUCESSO[metodo][1], '', '',
+                arquivo, momento, chave, str(ultima[1]), ultima[2],
+                self._assinatura_qrcode()))
+
+
+    def _testefimafim(self, metodo, sessao, parametros):
+        arquivo, momento, chave, _, _, numero_cfe = \
+                self._emitir(parametros.get('dadosVenda'))
+        return self._sucesso(metodo, sessao, arquivo, momento,
+                str(numero_cfe), chave)
+
+
+    def _responder_vfpe(self, remessa):
+        numero = str(self._random.randint(100000, 999999))
+        if remessa.metodo == 'VerificarStatusValidador':
+            return collections.OrderedDict((
+                    ('CodigoAutorizacao', numero),
+                    ('Bin', '123456'),
+                    ('DonoCartao', 'TESTE'),
+                    ('DataExpiracao', '01/30'),
+                    ('InstituicaoFinanceira', 'STONE'),
+                    ('Parcelas', '1'),
+                    ('UltimosQuatroDigitos', '1234'),
+                    ('CodigoPagamento', numero),
+                    ('ValorPagamento', '10.00'),
+                    ('IdFila', remessa.parametros.get('idFila') or numero),
+                    ('Tipo', '1'),
+                ))
+        if remessa.metodo == 'EnviarPagamento':
+            return collections.OrderedDict((
+                    ('IdPagamento', numero),
+                    ('Mensagem', 'Pagamento enviado'),
+                    ('StatusPagamento', 'EnviadoAoValidador'),
+                ))
+        return collections.OrderedDict((
+                ('retorno', '{}|{}|Processado'.format(
+                        remessa.numero_identificador, remessa.metodo)),
+            ))
+
+
+class SimuladorIntegrador(object):
+    """Simula o Integrador Fiscal sobre as pastas ``input`` e ``output`` do
+    caminho informado (que são criadas, se necessário).
+
+    :param str caminho: Caminho da pasta do Integrador.
+
+    :param float latencia: Tempo médio, em segundos, para responder a cada
+        remessa.
+
+    :param float variacao: Variação máxima, para mais ou para menos, da
+        latência. Com mais de um trabalhador, faz com que as respostas sejam
+        escritas fora de ordem.
+
+    :param float taxa_erro: Probabilidade de uma função SAT resultar em erro.
+
+    :param float taxa_perda: Probabilidade de uma remessa ser consumida sem
+        que qualquer resposta seja escrita (para exercitar o tempo limite).
+
+    :param int trabalhadores: Quantidade de remessas processadas ao mesmo
+        tempo. O Integrador real processa uma remessa por vez.
+
+    :param float intervalo: Intervalo, em segundos, entre as verificações da
+        pasta de *input*.
+
+    :param str codigo_ativacao: Opcional. Código de ativação esperado.
+
+    :param semente: Opcional. Semente para os números aleatórios, para que
+        uma simulação possa ser repetida.
+    """
+
+    def __init__(self, caminho, latencia=0.05, variacao=0.0, taxa_erro=0.0,
+                 taxa_perda=0.0, trabalhadores=1, intervalo=0.01,
+                 codigo_ativacao=None, semente=None):
+        self._input = os.path.join(caminho, 'input')
+        self._output = os.path.join(caminho, 'output')
+        self._latencia = latencia
+        self._variacao = variacao
+        self._taxa_perda = taxa_perda
+        self._trabalhadores = trabalhadores
+        self._intervalo = intervalo
+        self._random = random.Random(semente)
+        self._equipamento = EquipamentoSimulado(taxa_erro=taxa_erro,
+                codigo_ativacao=codigo_ativacao, random=self._random)
+        self._parar = threading.Event()
+        self._ativo = threading.Event()
+        self._ativo.set()
+        self._fila = collections.deque()
+        self._condicao = threading.Condition()
+        self._vistas = set()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.respondidas = 0
+        self.perdidas = 0
+
+
+    @property
+    def equipamento(self):
+        return self._equipamento
+
+
+    def __enter__(self):
+        self.iniciar()
+        return self
+
+
+    def __exit__(self, *args):
+        self.parar()
+
+
+    def iniciar(self):
+        for pasta in (self._input, self._output):
+            if not os.path.isdir(pasta):
+                os.makedirs(pasta)
+        self._parar.clear()
+        alvos = [self._observar] + [self._trabalhar] * self._trabalhadores
+        for n, alvo in enumerate(alvos):
+            thread = threading.Thread(target=alvo,
+                    name='SimuladorIntegrador-{}'.format(n))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+
+    def parar(self):
+        self._parar.set()
+        with self._condicao:
+            self._condicao.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+    def congelar(self):
+        """Simula um Integrador travado: as remessas deixam de ser consumidas
+        da pasta de *input* até que :meth:`descongelar` seja invocado. As
+        remessas já consumidas ainda são respondidas.
+        """
+        self._ativo.clear()
+
+
+    def descongelar(self):
+        self._ativo.set()
+        with self._condicao:
+            self._condicao.notify_all()
+
+
+    def aguardar(self):
+        """Mantém o simulador em execução até que :meth:`parar` seja invocado
+        (por outra *thread*) ou até uma interrupção pelo teclado.
+        """
+        try:
+            while not self._parar.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+
+
+    def processar(self, caminho):
+        """Consome a remessa, escrevendo a resposta na pasta de *output*.
+
+        :return: O caminho do arquivo de resposta, ou ``None`` se a remessa
+            foi perdida (veja ``taxa_perda``).
+        """
+        return self._responder(self._consumir(caminho))
+
+
+    def _consumir(self, caminho):
+        remessa = ler_remessa(caminho)
+        os.remove(caminho)
+        return remessa
+
+
+    def _responder(self, remessa):
+        if self._random.random() < self._taxa_perda:
+            with self._lock:
+                self.perdidas += 1
+            return None
+        resposta = self._equipamento.responder(remessa)
+        destino = os.path.join(self._output, nome_resposta())
+        publicar_arquivo(destino,
+                xml_resposta(remessa.numero_identificador, resposta))
+        with self._lock:
+            self.respondidas += 1
+        return destino
+
+
+    def _observar(self):
+        while not self._parar.is_set():
+            novas = []
+            for nome in sorted(os.listdir(self._input)):
+                if nome.endswith('.xml') and not nome.startswith('.') \
+                        and nome not in self._vistas:
+                    self._vistas.add(nome)
+                    novas.append(nome)
+            if novas:
+                with self._condicao:
+                    self._fila.extend(novas)
+                    self._condicao.notify_all()
+            self._parar.wait(self._intervalo)
+
+
+    def _trabalhar(self):
+        while True:
+            with self._condicao:
+                while not (self._fila and self._ativo.is_set()) and \
+                        not self._parar.is_set():
+                    self._condicao.wait(self._intervalo)
+                if self._parar.is_set():
+                    return
+                nome = self._fila.popleft()
+
+            # como o Integrador, a remessa é consumida da pasta de input
+            # antes de ser processada
+            caminho = os.path.join(self._input, nome)
+            try:
+                remessa = self._consumir(caminho)
+            except Exception:
+                logger.exception('Falha ao consumir remessa: %s', caminho)
+                continue
+            finally:
+                self._vistas.discard(nome)
+
+            atraso = self._latencia + self._random.uniform(
+                    -self._variacao, self._variacao)
+            if atraso > 0 and self._parar.wait(atraso):
+                return
+
+            try:
+                self._responder(remessa)
+            except Exception:
+                logger.exception('Falha ao processar remessa: %s', caminho)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mfecfe.simulador',
+            description='Simula o Integrador Fiscal, respondendo as remessas '
+                    'escritas na pasta input.')
+    parser.add_argument('caminho',
+            help='Pasta do Integrador (contendo input e output)')
+    parser.add_argument('--latencia', type=float, default=0.05,
+            help='Tempo medio de resposta, em segundos (padrao: %(default)s)')
+    parser.add_argument('--variacao', type=float, default=0.0,
+            help='Variacao maxima da latencia, em segundos')
+    parser.add_argument('--taxa-erro', type=float, default=0.0,
+            help='Probabilidade de uma funcao SAT resultar em erro')
+    parser.add_argument('--taxa-perda', type=float, default=0.0,
+            help='Probabilidade de uma remessa ficar sem resposta')
+    parser.add_argument('--trabalhadores', type=int, default=1,
+            help='Remessas processadas ao mesmo tempo (padrao: %(default)s)')
+    parser.add_argument('--codigo-ativacao',
+            help='Codigo de ativacao esperado')
+    parser.add_argument('--semente', type=int,
+            help='Semente para os numeros aleatorios')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='Exibe as mensagens de log')
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    simulador = SimuladorIntegrador(args.caminho,
+            latencia=args.latencia,
+            variacao=args.variacao,
+            taxa_erro=args.taxa_erro,
+            taxa_perda=args.taxa_perda,
+            trabalhadores=args.trabalhadores,
+            codigo_ativacao=args.codigo_ativacao,
+            semente=args.semente)
+    with simulador:
+        simulador.aguardar()
+    logger.info('Remessas respondidas: %d, perdidas: %d',
+            simulador.respondidas, simulador.perdidas)
+
+
+if __name__ == '__main__':
+    main()
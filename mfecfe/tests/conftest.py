@@ -40,6 +40,10 @@ from satcfe.entidades import PISSN
 from satcfe.entidades import COFINSSN
 from satcfe.entidades import MeioPagamento
 
+import mfecfe
+
+from mfecfe.simulador import SimuladorIntegrador
+
 
 def pytest_addoption(parser):
 
@@ -199,6 +203,18 @@ def clientesatlocal(request):
     return funcoes
 
 
+@pytest.fixture
+def integrador(tmpdir):
+    """Simula um Integrador que responde às remessas fora de ordem."""
+    simulador = SimuladorIntegrador(str(tmpdir), latencia=0.01,
+            variacao=0.01, trabalhadores=4)
+    simulador.iniciar()
+    biblioteca = mfecfe.BibliotecaSAT(str(tmpdir))
+    yield biblioteca
+    simulador.parar()
+    biblioteca.despachante.parar()
+
+
 @pytest.fixture(scope='module')
 def cfevenda(request):
     _opcao = request.config.getoption
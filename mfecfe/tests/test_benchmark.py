@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_benchmark.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import copy
+import json
+
+import pytest
+
+from lxml import etree
+
+from mfecfe.benchmark import FASES
+from mfecfe.benchmark import Metricas
+from mfecfe.benchmark import executar
+from mfecfe.benchmark import main
+from mfecfe.benchmark import medir_poda
+from mfecfe.benchmark import poda_anterior
+from mfecfe.simulador import SimuladorIntegrador
+from mfecfe.xml import prune_empty
+
+
+def test_metricas_resumo():
+    metricas = Metricas()
+    for n in range(1, 101):
+        metricas.registrar('wait', n / 1000.0)
+    resumo = metricas.resumo()
+    assert list(resumo) == ['wait']
+    assert resumo['wait']['n'] == 100
+    assert resumo['wait']['p50'] == pytest.approx(50)
+    assert resumo['wait']['p95'] == pytest.approx(95)
+    assert resumo['wait']['p99'] == pytest.approx(99)
+    assert resumo['wait']['max'] == pytest.approx(100)
+
+
+@pytest.mark.parametrize('operacao', ['venda', 'consulta', 'vfpe'])
+def test_executar(tmpdir, operacao):
+    with SimuladorIntegrador(str(tmpdir), latencia=0.01, trabalhadores=2):
+        resultado = executar(str(tmpdir), operacao=operacao, operacoes=6,
+                simultaneas=3, itens=2)
+    assert resultado['erros'] == {}
+    assert tuple(resultado['fases']) == FASES
+    for fase in FASES:
+        assert resultado['fases'][fase]['n'] == 6
+    assert resultado['operacoes_por_segundo'] > 0
+
+
+def test_main_grava_json(tmpdir):
+    saida = tmpdir.join('resultado.json')
+    main(['--operacoes', '2', '--simultaneas', '2', '--saida', str(saida)])
+    resultado = json.loads(saida.read())
+    assert resultado['parametros']['operacoes'] == 2
+    assert resultado['parametros']['simulador']['trabalhadores'] == 1
+    assert resultado['fases']['total']['n'] == 2
+
+
+def test_medir_poda(tmpdir):
+    resultado = medir_poda(20, repeticoes=1)
+    assert resultado['itens'] == 20
+    assert resultado['elementos'] > 20 * 20
+    assert resultado['ms'] >= 0
+    assert resultado['ms_anterior'] >= 0
+
+    saida = tmpdir.join('poda.json')
+    main(['--poda', '5', '10', '--saida', str(saida)])
+    assert [r['itens'] for r in json.loads(saida.read())] == [5, 10]
+
+
+def test_poda_anterior_igual_a_prune_empty():
+    venda = etree.fromstring('<A><B><C/></B><D>1<E/></D><F> </F></A>')
+    esperado = copy.deepcopy(venda)
+    poda_anterior(venda)
+    prune_empty(esperado)
+    assert etree.tostring(venda) == etree.tostring(esperado) == \
+            b'<A><D>1</D><F> </F></A>'
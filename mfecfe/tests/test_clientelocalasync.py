@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_clientelocalasync.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import sys
+import threading
+
+import pytest
+
+from concurrent.futures import wait
+
+from mfecfe import base as modulo_base
+from mfecfe import clientelocalasync
+from mfecfe.base import BibliotecaSAT
+from mfecfe.base import MENSAGEM_ERRO_INTERNO
+from mfecfe.base import PoliticaPrazos
+from mfecfe.base import Prazo
+from mfecfe.clientelocalasync import ClienteSATLocalAsync
+from mfecfe.simulador import SimuladorIntegrador
+
+
+VENDA = (
+        '<CFe><infCFe versaoDadosEnt="0.07">'
+        '<ide><CNPJ>16716114000172</CNPJ><numeroCaixa>001</numeroCaixa></ide>'
+        '<emit><CNPJ>08723218000186</CNPJ></emit>'
+        '<det nItem="1"><prod><qCom>1.0000</qCom><vUnCom>{}.00</vUnCom></prod>'
+        '</det></infCFe></CFe>')
+
+
+def _consultar(cliente, numero):
+    return cliente.comando_sat('ConsultarSAT.xml',
+            consulta={'numero_sessao': numero, 'numero_identificador': numero})
+
+
+def test_consultar_sat(integrador):
+    cliente = ClienteSATLocalAsync(integrador, codigo_ativacao='12345678',
+            tempo_limite=5)
+    assert cliente.consultar_sat().result(5).EEEEE == u'08000'
+
+
+def test_adaptador(integrador):
+    adaptados = []
+
+    def _adaptador(futuro):
+        adaptados.append(futuro)
+        return 'adaptado'
+
+    cliente = ClienteSATLocalAsync(integrador, codigo_ativacao='12345678',
+            tempo_limite=5, adaptador=_adaptador)
+    assert cliente.consultar_sat() == 'adaptado'
+    assert adaptados[0].result(5).EEEEE == u'08000'
+
+
+def test_remessa_escrita_pelo_executor(integrador, monkeypatch):
+    threads = []
+    enviar_remessa = modulo_base.enviar_remessa
+
+    def _enviar_remessa(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return enviar_remessa(*args, **kwargs)
+
+    monkeypatch.setattr(modulo_base, 'enviar_remessa', _enviar_remessa)
+    cliente = ClienteSATLocalAsync(integrador, codigo_ativacao='12345678',
+            tempo_limite=5)
+    resposta = cliente.enviar_dados_venda(VENDA.format(1)).result(5)
+    assert resposta.EEEEE == u'06000'
+    assert threads and threading.current_thread() not in threads
+
+
+def test_tempo_limite_esgotado(tmpdir):
+    with SimuladorIntegrador(str(tmpdir), latencia=0.01) as simulador:
+        simulador.congelar()
+        cliente = ClienteSATLocalAsync(BibliotecaSAT(str(tmpdir)),
+                tempo_limite=0.2)
+        assert MENSAGEM_ERRO_INTERNO in _consultar(cliente, 1).result(5)
+        simulador.descongelar()
+        cliente.biblioteca.despachante.parar()
+
+
+def test_reenvio_apos_tempo_limite(tmpdir):
+    politica = PoliticaPrazos(ConsultarSAT=Prazo(0.3, tentativas=3,
+            espera=0.1))
+    with SimuladorIntegrador(str(tmpdir), latencia=0.01) as simulador:
+        simulador.congelar()
+        cliente = ClienteSATLocalAsync(BibliotecaSAT(str(tmpdir)),
+                politica=politica)
+        futuro = _consultar(cliente, 2)
+        threading.Timer(0.5, simulador.descongelar).start()
+        assert futuro.result(5).split('|')[:2] == ['2', '08000']
+        cliente.biblioteca.despachante.parar()
+
+
+def test_cancelar_antes_da_escrita(integrador, monkeypatch):
+    escritas = []
+    monkeypatch.setattr(modulo_base, 'enviar_remessa',
+            lambda *args, **kwargs: escritas.append(args))
+    bloqueio = threading.Event()
+    executor = clientelocalasync.ThreadPoolExecutor(max_workers=1)
+    executor.submit(bloqueio.wait, 5)
+    cliente = ClienteSATLocalAsync(integrador, codigo_ativacao='12345678',
+            tempo_limite=5, executor=executor)
+    futuro = _consultar(cliente, 3)
+    assert futuro.cancel()
+    bloqueio.set()
+    executor.shutdown()
+    assert futuro.cancelled()
+    assert escritas == []
+
+
+def test_vendas_simultaneas(integrador):
+    cliente = ClienteSATLocalAsync(integrador, codigo_ativacao='12345678',
+            tempo_limite=5)
+    futuros = [cliente.enviar_dados_venda(VENDA.format(n))
+               for n in range(1, 9)]
+    concluidos, pendentes = wait(futuros, timeout=10)
+    assert not pendentes
+    respostas = [f.result() for f in futuros]
+    assert [r.EEEEE for r in respostas] == [u'06000'] * 8
+    assert len(set(r.chaveConsulta for r in respostas)) == 8
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='requer asyncio')
+def test_asyncio_wrap_future(integrador):
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        cliente = ClienteSATLocalAsync(integrador, codigo_ativacao='12345678',
+                tempo_limite=5,
+                adaptador=lambda f: asyncio.wrap_future(f, loop=loop))
+        respostas = loop.run_until_complete(asyncio.gather(
+                *[cliente.enviar_dados_venda(VENDA.format(n))
+                  for n in range(1, 5)]))
+    finally:
+        loop.close()
+    assert [r.EEEEE for r in respostas] == [u'06000'] * 4
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_coordenacao.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from mfecfe import coordenacao
+from mfecfe.base import BibliotecaSAT
+from mfecfe.base import FuncoesSAT
+from mfecfe.base import FuncoesSATNowait
+from mfecfe.excecoes import ErroCoordenacao
+from mfecfe.simulador import SimuladorIntegrador
+
+
+pytestmark = pytest.mark.skipif(not coordenacao.disponivel(),
+        reason='coordenacao entre processos indisponivel')
+
+
+def _aguardar(condicao, tempo_limite=5):
+    limite = time.time() + tempo_limite
+    while not condicao():
+        assert time.time() < limite
+        time.sleep(0.01)
+
+
+def _consultar(funcoes, numero):
+    return funcoes.comando_sat('ConsultarSAT.xml',
+            consulta={'numero_sessao': numero, 'numero_identificador': numero})
+
+
+@pytest.fixture
+def processos(tmpdir):
+    # os coordenadores se comportam da mesma forma no mesmo processo, pois o
+    # flock é obtido para cada arquivo aberto
+    tmpdir.mkdir('input')
+    tmpdir.mkdir('output')
+    dono = BibliotecaSAT(str(tmpdir), janela=1, coordenar=True)
+    dono.despachante.iniciar()
+    outro = BibliotecaSAT(str(tmpdir), janela=1, coordenar=True)
+    outro.despachante.iniciar()
+    yield dono, outro
+    outro.despachante.parar()
+    dono.despachante.parar()
+
+
+def test_apenas_o_dono_observa(tmpdir, processos):
+    dono, outro = processos
+    assert dono.despachante.coordenador.dono
+    assert not outro.despachante.coordenador.dono
+    assert outro.despachante._observer is None
+    with SimuladorIntegrador(str(tmpdir), latencia=0.01):
+        assert _consultar(FuncoesSAT(outro, tempo_limite=5), 1) == \
+                '1|08000|SAT em operacao|||1'
+        assert _consultar(FuncoesSAT(dono, tempo_limite=5), 2) == \
+                '2|08000|SAT em operacao|||2'
+    assert not dono.despachante.aguardando(1)
+
+
+def test_numeros_identificadores_unicos(processos):
+    dono, outro = processos
+    assert outro.numerador_sessao is not None
+    numeros = set()
+    for _ in range(50):
+        numeros.add(FuncoesSAT(dono).gerar_numero_sessao())
+        numeros.add(FuncoesSAT(outro).gerar_numero_sessao())
+    assert len(numeros) == 100
+
+
+def test_janela_compartilhada(tmpdir, processos):
+    dono, outro = processos
+    simulador = SimuladorIntegrador(str(tmpdir), latencia=0.01)
+    with simulador:
+        simulador.congelar()
+        primeira = _consultar(FuncoesSATNowait(dono, tempo_limite=5), 1)
+        segunda = _consultar(FuncoesSATNowait(outro, tempo_limite=5), 2)
+        agendador = dono.despachante.agendador
+        _aguardar(lambda: agendador.na_fila == 1)
+        assert os.listdir(str(tmpdir.join('input'))) == ['1-consultarsat.xml']
+        simulador.descongelar()
+        assert primeira.result(5).split('|')[0] == '1'
+        assert segunda.result(5).split('|')[0] == '2'
+    assert agendador.em_andamento == 0
+
+
+def test_assume_quando_o_dono_termina(tmpdir, processos):
+    dono, outro = processos
+    dono.despachante.parar()
+    _aguardar(lambda: outro.despachante.coordenador.dono)
+    with SimuladorIntegrador(str(tmpdir), latencia=0.01):
+        assert _consultar(FuncoesSAT(outro, tempo_limite=5), 3) == \
+                '3|08000|SAT em operacao|||3'
+    assert outro.despachante._observer is not None
+
+
+def test_numero_sem_resposta_do_dono(processos, monkeypatch):
+    dono, outro = processos
+    monkeypatch.setattr(coordenacao, 'TEMPO_LIMITE_CHAMADA', 0.2)
+    bloqueio = threading.Event()
+    gerados = []
+    monkeypatch.setattr(dono.despachante.coordenador, '_numerador',
+            lambda: bloqueio.wait(5) and 1)
+    monkeypatch.setattr(outro.despachante.coordenador, '_numerador',
+            lambda: gerados.append(2) or 2)
+    try:
+        with pytest.raises(ErroCoordenacao):
+            outro.despachante.coordenador.numero()
+    finally:
+        bloqueio.set()
+    assert gerados == []
+
+
+def test_numero_repetido_ao_novo_dono(processos):
+    dono, outro = processos
+    coordenador = outro.despachante.coordenador
+    dono.despachante.parar()
+    assert coordenador.numero() is not None
+    assert coordenador.dono
+
+
+def test_arquivos_na_pasta_do_usuario(processos):
+    dono, _ = processos
+    coordenador = dono.despachante.coordenador
+    pasta = os.path.dirname(coordenador._caminho_socket)
+    assert pasta == coordenacao.diretorio_privado()
+    assert stat.S_IMODE(os.stat(pasta).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(coordenador._caminho_socket).st_mode) & \
+            0o077 == 0
+
+
+def test_pasta_do_usuario_insegura(tmpdir, monkeypatch):
+    monkeypatch.setattr(coordenacao.tempfile, 'gettempdir',
+            lambda: str(tmpdir))
+    pasta = tmpdir.mkdir('mfecfe-{}'.format(os.getuid()))
+    pasta.chmod(0o777)
+    with pytest.raises(ErroCoordenacao):
+        coordenacao.diretorio_privado()
+    pasta.chmod(0o700)
+    assert coordenacao.diretorio_privado() == str(pasta)
+
+
+def test_eleicao_sem_socket_do_dono(tmpdir, processos, monkeypatch):
+    dono, _ = processos
+    monkeypatch.setattr(coordenacao, 'TEMPO_LIMITE_ELEICAO', 0.2)
+    os.remove(dono.despachante.coordenador._caminho_socket)
+    terceiro = BibliotecaSAT(str(tmpdir), coordenar=True)
+    with pytest.raises(ErroCoordenacao):
+        terceiro.despachante.iniciar()
+    terceiro.despachante.parar()
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_integrador.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import os
+import threading
+
+import pytest
+
+from concurrent.futures import Future
+
+from mfecfe.base import BibliotecaSAT
+from mfecfe.base import FuncoesSAT
+from mfecfe.base import FuncoesSATNowait
+from mfecfe.base import FuncoesVFPE
+from mfecfe.base import PoliticaPrazos
+from mfecfe.base import Prazo
+from mfecfe.clientelocal import ClienteSATLocal
+from mfecfe.integrador import OBSERVAR_EVENTOS
+from mfecfe.integrador import OBSERVAR_INOTIFY
+from mfecfe.integrador import OBSERVAR_VARREDURA
+from mfecfe.integrador import MENSAGEM_INTEGRADOR_PARADO
+from mfecfe.integrador import DespachanteIntegrador
+from mfecfe.integrador import ObservadorVarredura
+from mfecfe.integrador import RespostasTardias
+from mfecfe.integrador import VigiaConsumo
+from mfecfe import integrador as modulo_integrador
+from mfecfe.integrador import SINCRONIZAR_DIRETORIO
+from mfecfe.integrador import ler_identificador
+from mfecfe.integrador import PASTA_TEMPORARIA
+from mfecfe.integrador import publicar_arquivo
+from mfecfe.integrador import sistema_arquivos_remoto
+from mfecfe import inotify
+from mfecfe.simulador import SimuladorIntegrador
+
+
+RESPOSTA_CONSULTAR_SAT = (
+        u'<?xml version="1.0" encoding="utf-8"?>'
+        u'<Integrador>'
+        u'<Identificador><Valor>{0}</Valor></Identificador>'
+        u'<IntegradorResposta>'
+        u'<Codigo>AP</Codigo><Valor>Arquivo processado</Valor>'
+        u'</IntegradorResposta>'
+        u'<Resposta><retorno>{0}|08000|SAT em operacao||</retorno></Resposta>'
+        u'</Integrador>')
+
+
+@pytest.fixture(params=[
+        OBSERVAR_EVENTOS, OBSERVAR_VARREDURA, OBSERVAR_INOTIFY])
+def despachante(request, tmpdir):
+    if request.param == OBSERVAR_EVENTOS and modulo_integrador.Observer is None:
+        pytest.skip('watchdog nao instalado')
+    if request.param == OBSERVAR_INOTIFY and not inotify.disponivel():
+        pytest.skip('inotify indisponivel')
+    tmpdir.mkdir('input')
+    output = tmpdir.mkdir('output')
+    despachante = DespachanteIntegrador(str(output), observacao=request.param)
+    yield despachante
+    despachante.parar()
+
+
+def _responder(despachante, numero_identificador, nome=None):
+    nome = nome or '{}.xml'.format(numero_identificador)
+    with open('{}/{}'.format(despachante.caminho, nome), 'w') as f:
+        f.write(RESPOSTA_CONSULTAR_SAT.format(numero_identificador))
+
+
+def test_despacha_resposta_para_remessa_pendente(despachante):
+    pendente = despachante.registrar(123456)
+    _responder(despachante, 123456)
+    assert pendente.aguardar(5)
+    assert pendente.resposta == '123456|08000|SAT em operacao|||123456'
+    assert pendente.src_path.endswith('123456.xml')
+
+
+def test_ignora_respostas_de_outras_remessas(despachante):
+    pendente = despachante.registrar(111111)
+    _responder(despachante, 222222)
+    assert not pendente.aguardar(0.5)
+    assert not pendente.entregue
+    _responder(despachante, 111111)
+    assert pendente.aguardar(5)
+
+
+def test_observador_unico(despachante):
+    despachante.registrar(333333)
+    observador = despachante._observer
+    despachante.registrar(444444)
+    assert despachante._observer is observador
+
+
+def test_recusa_identificador_em_andamento(despachante):
+    pendente = despachante.registrar(555555)
+    with pytest.raises(ValueError):
+        despachante.registrar(555555)
+    despachante.descartar(pendente)
+    despachante.registrar(555555)
+
+
+def test_comandos_simultaneos(integrador):
+    funcoes = FuncoesSAT(integrador, tempo_limite=5)
+    respostas = {}
+
+    def _consultar():
+        numero_identificador = funcoes.gerar_numero_sessao()
+        resposta = funcoes.comando_sat('ConsultarSAT.xml', consulta={'numero_sessao': numero_identificador,
+                        'numero_identificador': numero_identificador})
+        respostas[numero_identificador] = resposta
+
+    threads = [threading.Thread(target=_consultar) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(respostas) == 16
+    for numero_identificador, resposta in respostas.items():
+        assert resposta.split('|')[0] == str(numero_identificador)
+        assert resposta.split('|')[-1] == str(numero_identificador)
+
+
+def test_comando_nowait(integrador):
+    funcoes = FuncoesSATNowait(integrador, tempo_limite=5)
+    futuro = funcoes.comando_sat('ConsultarSAT.xml',
+            consulta={'numero_sessao': 123456, 'numero_identificador': 123456})
+    assert futuro.result(5) == '123456|08000|SAT em operacao|||123456'
+    assert not integrador.despachante._pendentes
+
+
+def test_comando_nowait_tempo_limite(tmpdir):
+    tmpdir.mkdir('input')
+    tmpdir.mkdir('output')
+    funcoes = FuncoesSATNowait(BibliotecaSAT(str(tmpdir)), tempo_limite=0.2)
+    futuro = funcoes.comando_sat('ConsultarSAT.xml',
+            consulta={'numero_sessao': 123456, 'numero_identificador': 123456})
+    assert futuro.result(5).split('|')[3] == 'Erro interno'
+    funcoes.biblioteca.despachante.parar()
+
+
+def test_cliente_nowait_analisa_resposta(integrador):
+    cliente = ClienteSATLocal(integrador, tempo_limite=5)
+    futuros = [cliente.consultar_sat_nowait() for _ in range(4)]
+    for futuro in futuros:
+        resposta = futuro.result(5)
+        assert resposta.EEEEE == u'08000'
+        assert resposta.atributos.funcao == 'ConsultarSAT'
+
+
+@pytest.mark.parametrize('sincronizar', [0, SINCRONIZAR_DIRETORIO])
+def test_publicar_arquivo(tmpdir, sincronizar):
+    entrada = tmpdir.mkdir('input')
+    destino = entrada.join('123456-consultarsat.xml')
+    destino.write('conteudo anterior')
+    publicar_arquivo(str(destino), b'<Integrador/>', sincronizar)
+    assert destino.read() == '<Integrador/>'
+    assert entrada.listdir() == [destino]
+    assert tmpdir.join(PASTA_TEMPORARIA).listdir() == []
+
+
+def test_publicar_arquivo_em_partes(tmpdir):
+    entrada = tmpdir.mkdir('input')
+    destino = entrada.join('123456-enviardadosvenda.xml')
+    escritos = []
+
+    def partes():
+        yield b'<Integrador>'
+        # enquanto é escrito, o arquivo não aparece na pasta de destino
+        escritos.extend(entrada.listdir())
+        escritos.extend(tmpdir.join(PASTA_TEMPORARIA).listdir())
+        yield b'</Integrador>'
+
+    publicar_arquivo(str(destino), partes())
+    assert destino.read() == '<Integrador></Integrador>'
+    assert [e.basename for e in escritos] == \
+            ['input.123456-enviardadosvenda.xml.{}.tmp'.format(os.getpid())]
+
+    def falhar():
+        yield b'<Integrador>'
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        publicar_arquivo(str(entrada.join('654321-enviardadosvenda.xml')),
+                         falhar())
+    assert entrada.listdir() == [destino]
+    assert tmpdir.join(PASTA_TEMPORARIA).listdir() == []
+
+
+def test_ler_identificador_pelo_cabecalho():
+    caminho = os.path.join(os.path.dirname(modulo_integrador.__file__),
+            'resposta', 'template', 'consultar_sat',
+            'a1e20f1ec8424ab39dd7ee1810cf5e2d20171113165242.xml')
+    assert ler_identificador(caminho) == '999999'
+
+
+def test_ler_identificador_ignora_nome(tmpdir):
+    arquivo = tmpdir.join('654321-consultarsat.xml')
+    arquivo.write('<Integrador><Identificador><Valor>123</Valor>'
+                  '</Identificador></Integrador>')
+    assert ler_identificador(str(arquivo)) == '123'
+    arquivo.write('')
+    assert ler_identificador(str(arquivo)) is None
+    assert ler_identificador(str(tmpdir.join('inexistente.xml'))) is None
+
+
+def test_analisa_apenas_respostas_aguardadas(despachante, monkeypatch):
+    analisados = []
+    ler_resposta = modulo_integrador.ler_resposta
+
+    def _ler_resposta(caminho):
+        analisados.append(caminho)
+        return ler_resposta(caminho)
+
+    monkeypatch.setattr(modulo_integrador, 'ler_resposta', _ler_resposta)
+    pendente = despachante.registrar(777777)
+    _responder(despachante, 888888)
+    _responder(despachante, 777777)
+    assert pendente.aguardar(5)
+    assert [os.path.basename(c) for c in set(analisados)] == ['777777.xml']
+
+
+def test_ignora_resposta_incompleta(despachante, monkeypatch):
+    analisados = []
+    ler_resposta = modulo_integrador.ler_resposta
+
+    def _ler_resposta(caminho):
+        analisados.append(caminho)
+        return ler_resposta(caminho)
+
+    monkeypatch.setattr(modulo_integrador, 'ler_resposta', _ler_resposta)
+    pendente = despachante.registrar(246810)
+    conteudo = RESPOSTA_CONSULTAR_SAT.format(246810)
+    with open('{}/246810.xml'.format(despachante.caminho), 'w') as f:
+        f.write(conteudo[:80])
+        f.flush()
+        assert not pendente.aguardar(0.7)
+        f.write(conteudo[80:])
+    assert pendente.aguardar(5)
+    assert pendente.resposta == '246810|08000|SAT em operacao|||246810'
+    assert len(analisados) == 1
+
+
+def test_guarda_resposta_tardia(tmpdir):
+    tmpdir.mkdir('input')
+    tmpdir.mkdir('output')
+    biblioteca = BibliotecaSAT(str(tmpdir))
+    funcoes = FuncoesSAT(biblioteca, tempo_limite=0.2)
+    resposta = funcoes.comando_sat('ConsultarSAT.xml',
+            consulta={'numero_sessao': 135791, 'numero_identificador': 135791})
+    assert resposta.split('|')[3] == 'Erro interno'
+    despachante = biblioteca.despachante
+    _responder(despachante, 135791)
+    for _ in range(50):
+        tardia = despachante.respostas_tardias.por_identificador(135791)
+        if tardia is not None:
+            break
+        threading.Event().wait(0.1)
+    despachante.parar()
+    assert tardia.resposta == '135791|08000|SAT em operacao|||135791'
+    assert tardia.chave is None
+
+
+def test_varre_respostas_orfas(tmpdir):
+    tmpdir.mkdir('input')
+    output = tmpdir.mkdir('output')
+    output.join('orfa.xml').write(RESPOSTA_CONSULTAR_SAT.format(975310))
+    output.join('incompleta.xml').write(RESPOSTA_CONSULTAR_SAT.format(1)[:80])
+    despachante = DespachanteIntegrador(str(output))
+    assert despachante.varrer_orfaos() == 1
+    tardia = despachante.respostas_tardias.por_identificador('975310')
+    assert tardia.src_path.endswith('orfa.xml')
+
+
+def test_varredura_adaptativa(despachante):
+    if despachante.observacao != OBSERVAR_VARREDURA:
+        pytest.skip('apenas para a observacao por varredura')
+    despachante.registrar(13579)
+    observador = despachante._observer
+    assert isinstance(observador, ObservadorVarredura)
+    threading.Event().wait(0.5)
+    assert observador._intervalo > ObservadorVarredura.INTERVALO_MINIMO
+    pendente = despachante.registrar(24680)
+    assert observador._acordar.is_set() or \
+            observador._intervalo == ObservadorVarredura.INTERVALO_MINIMO
+    _responder(despachante, 24680)
+    assert pendente.aguardar(0.5)
+
+
+def test_inotify_notifica_apenas_arquivos_completos(despachante, monkeypatch):
+    if despachante.observacao != OBSERVAR_INOTIFY:
+        pytest.skip('apenas para a observacao por inotify')
+    processados = []
+    monitor = modulo_integrador.MonitorIntegrador
+    original = monitor.processar_arquivo
+    monkeypatch.setattr(monitor, 'processar_arquivo',
+            lambda self, caminho: (processados.append(caminho),
+                    original(self, caminho)))
+    pendente = despachante.registrar(97531)
+    conteudo = RESPOSTA_CONSULTAR_SAT.format(97531)
+    with open(os.path.join(despachante.caminho, '97531.xml'), 'w') as f:
+        f.write(conteudo[:80])
+        f.flush()
+        assert not pendente.aguardar(0.3)
+        f.write(conteudo[80:])
+    assert pendente.aguardar(5)
+    pendente = despachante.registrar(86420)
+    temporario = os.path.join(despachante.caminho, '.86420.tmp')
+    with open(temporario, 'w') as f:
+        f.write(RESPOSTA_CONSULTAR_SAT.format(86420))
+    os.rename(temporario, os.path.join(despachante.caminho, '86420.xml'))
+    assert pendente.aguardar(5)
+    assert [os.path.basename(c) for c in processados] == \
+            ['97531.xml', '86420.xml']
+
+
+def test_sistema_arquivos_remoto(monkeypatch):
+    montagens = (
+            u'/dev/sda1 / ext4 rw 0 0\n'
+            u'//loja/integrador /mnt/integrador cifs rw 0 0\n'
+            u'/dev/sdb1 /mnt/integrador/local ext4 rw 0 0\n')
+    monkeypatch.setattr(os, 'name', 'posix')
+    monkeypatch.setattr(modulo_integrador, 'open',
+            lambda caminho: io.StringIO(montagens), raising=False)
+    assert sistema_arquivos_remoto('/mnt/integrador/output')
+    assert sistema_arquivos_remoto('/mnt/integrador')
+    assert not sistema_arquivos_remoto('/mnt/integrador/local/output')
+    assert not sistema_arquivos_remoto('/mnt/integrador2')
+    assert not sistema_arquivos_remoto('/opt/Integrador/output')
+
+
+def test_detecta_integrador_parado(tmpdir):
+    simulador = SimuladorIntegrador(str(tmpdir), latencia=0.01)
+    with simulador:
+        assert BibliotecaSAT(str(tmpdir)).despachante.consumo.prazo_consumo \
+                is None
+        biblioteca = BibliotecaSAT(str(tmpdir), prazo_consumo=0.3)
+        funcoes = FuncoesSAT(biblioteca, tempo_limite=10)
+        simulador.congelar()
+        resposta = funcoes.comando_sat('ConsultarSAT.xml',
+                consulta={'numero_sessao': 1, 'numero_identificador': 1})
+        assert MENSAGEM_INTEGRADOR_PARADO in resposta
+        assert biblioteca.despachante.integrador_parado
+        assert os.listdir(str(tmpdir.join('input'))) == []
+        simulador.descongelar()
+        resposta = funcoes.comando_sat('ConsultarSAT.xml',
+                consulta={'numero_sessao': 2, 'numero_identificador': 2})
+        assert resposta.split('|')[1] == '08000'
+        assert not biblioteca.despachante.integrador_parado
+        biblioteca.despachante.parar()
+
+
+def test_consumo_acompanhado_sob_demanda(tmpdir):
+    with SimuladorIntegrador(str(tmpdir), latencia=0.01):
+        biblioteca = BibliotecaSAT(str(tmpdir))
+        funcoes = FuncoesSAT(biblioteca, tempo_limite=5)
+        funcoes.comando_sat('ConsultarSAT.xml',
+                consulta={'numero_sessao': 1, 'numero_identificador': 1})
+        consumo = biblioteca.despachante.consumo
+        assert not consumo.ativa
+        assert consumo._thread is None
+        biblioteca.metricas = object()
+        assert consumo.ativa
+        biblioteca.metricas = None
+        biblioteca.despachante.parar()
+    medida = BibliotecaSAT(str(tmpdir), metricas=object())
+    assert medida.despachante.consumo.ativa
+    assert VigiaConsumo.INTERVALO_MINIMO >= 0.25
+
+
+def test_integrador_ocupado_nao_esta_parado(tmpdir):
+    simulador = SimuladorIntegrador(str(tmpdir), latencia=0.5)
+    with simulador:
+        biblioteca = BibliotecaSAT(str(tmpdir), prazo_consumo=0.3)
+        funcoes = FuncoesSATNowait(biblioteca, tempo_limite=10)
+        futuros = [funcoes.comando_sat('ConsultarSAT.xml',
+                consulta={'numero_sessao': n, 'numero_identificador': n})
+                for n in (1, 2, 3)]
+        respostas = [f.result(10) for f in futuros]
+        biblioteca.despachante.parar()
+    assert [r.split('|')[1] for r in respostas] == ['08000'] * 3
+    assert not biblioteca.despachante.integrador_parado
+
+
+def test_janela_de_remessas(tmpdir):
+    with SimuladorIntegrador(str(tmpdir), latencia=0.05):
+        biblioteca = BibliotecaSAT(str(tmpdir), janela=1)
+        agendador = biblioteca.despachante.agendador
+        funcoes = FuncoesSATNowait(biblioteca, tempo_limite=5)
+        futuros = [funcoes.comando_sat('ConsultarSAT.xml',
+                consulta={'numero_sessao': n, 'numero_identificador': n})
+                for n in range(1, 5)]
+        assert agendador.em_andamento == 1
+        assert agendador.na_fila == 3
+        respostas = [f.result(5) for f in futuros]
+        biblioteca.despachante.parar()
+    assert [r.split('|')[0] for r in respostas] == ['1', '2', '3', '4']
+    assert agendador.em_andamento == 0
+
+
+def test_prioridade_de_remessas(tmpdir):
+    simulador = SimuladorIntegrador(str(tmpdir), latencia=0.01)
+    with simulador:
+        simulador.congelar()
+        biblioteca = BibliotecaSAT(str(tmpdir), janela=1)
+        agendador = biblioteca.despachante.agendador
+        ocupada = agendador.solicitar('EnviarDadosVenda.xml', lambda v: None)
+        funcoes = FuncoesSATNowait(biblioteca, tempo_limite=5)
+        consulta = funcoes.comando_sat('ConsultarSAT.xml',
+                consulta={'numero_sessao': 1, 'numero_identificador': 1})
+        sessao = funcoes.comando_sat('ConsultarNumeroSessao.xml',
+                consulta={'numero_sessao': 2, 'numero_identificador': 2})
+        agendador.liberar(ocupada)
+        assert os.listdir(str(tmpdir.join('input'))) == \
+                ['2-consultarnumerosessao.xml']
+        simulador.descongelar()
+        assert sessao.result(5).split('|')[0] == '2'
+        assert consulta.result(5).split('|')[0] == '1'
+        biblioteca.despachante.parar()
+
+
+def test_respostas_tardias_por_chave():
+    chave = '35150708723218000186599000040190000241143484'
+    tardias = RespostasTardias(capacidade=2)
+    tardias.registrar(1, '1|06000|0000|Emitido com sucesso|||arq|20150709|'
+            'CFe{}|5.75|||1'.format(chave), None)
+    assert tardias.por_chave(chave).numero_identificador == '1'
+    assert tardias.por_chave('CFe' + chave).numero_identificador == '1'
+    tardias.registrar(2, '2|08000|SAT em operacao|||2', None)
+    tardias.registrar(3, '3|08000|SAT em operacao|||3', None)
+    assert len(tardias) == 2
+    assert tardias.por_chave(chave) is None
+
+
+def test_prazos_por_operacao(tmpdir):
+    funcoes = FuncoesSAT(BibliotecaSAT(str(tmpdir)))
+    assert funcoes.prazo('ConsultarSAT.xml').tentativas == 2
+    assert funcoes.prazo('AtualizarSoftwareSAT.xml').tempo_limite == 300
+    assert funcoes.prazo('ConsultarSAT.xml', tempo_limite=1).tempo_limite == 1
+    assert funcoes.prazo('ExtrairLogs.xml', prazo=7) == Prazo(7)
+
+    uniforme = FuncoesSAT(BibliotecaSAT(str(tmpdir)), tempo_limite=5)
+    assert uniforme.prazo('ConsultarSAT.xml') == Prazo(5)
+    assert uniforme.prazo('ExtrairLogs.xml') == Prazo(5)
+
+    politica = PoliticaPrazos(padrao=20, consultarsat=Prazo(1))
+    assert politica.prazo('ConsultarSAT.xml') == Prazo(1)
+    assert politica.prazo('BloquearSAT.xml') == Prazo(20)
+
+
+def test_numero_identificador_vfpe(tmpdir):
+    funcoes = FuncoesVFPE(BibliotecaSAT(str(tmpdir)),
+            numerador_sessao=lambda: 4321)
+    # sem o argumento, um novo número é gerado em vez de KeyError
+    assert funcoes.obter_numero_identificador(consulta={}) == 4321
+    assert funcoes.obter_numero_identificador(
+            numero_identificador='False') == 4321
+    assert funcoes.obter_numero_identificador(
+            numero_identificador=1234) == 1234
+    assert funcoes.obter_numero_identificador(
+            numero_identificador=1234, numero_sessao=5678) == 5678
+
+
+def _responder_depois(biblioteca, numero_identificador, atraso):
+    despachante = biblioteca.despachante
+    timer = threading.Timer(atraso, _responder,
+            args=(despachante, numero_identificador))
+    timer.start()
+    return timer
+
+
+@pytest.mark.parametrize('classe', [FuncoesSAT, FuncoesSATNowait])
+def test_reenvia_remessa_apos_tempo_limite(tmpdir, classe):
+    tmpdir.mkdir('input')
+    tmpdir.mkdir('output')
+    biblioteca = BibliotecaSAT(str(tmpdir))
+    funcoes = classe(biblioteca)
+    timer = _responder_depois(biblioteca, 192837, 0.5)
+    resposta = funcoes.comando_sat('ConsultarSAT.xml',
+            prazo=Prazo(0.2, tentativas=3, espera=0.1),
+            consulta={'numero_sessao': 192837, 'numero_identificador': 192837})
+    if classe is FuncoesSATNowait:
+        resposta = resposta.result(5)
+    timer.join()
+    biblioteca.despachante.parar()
+    assert resposta == '192837|08000|SAT em operacao|||192837'
+
+
+def test_enviar_lote_vendas(tmpdir, monkeypatch):
+    cliente = ClienteSATLocal(BibliotecaSAT(str(tmpdir)))
+    em_andamento = []
+    maximo = [0]
+    lock = threading.Lock()
+
+    def _enviar_dados_venda_nowait(dados_venda):
+        if dados_venda == 'recusada':
+            raise IOError('falha ao escrever a remessa')
+        futuro = Future()
+        with lock:
+            em_andamento.append(futuro)
+            maximo[0] = max(maximo[0], len(em_andamento))
+
+        def _concluir():
+            with lock:
+                em_andamento.remove(futuro)
+            if dados_venda == 'rejeitada':
+                futuro.set_exception(ValueError(dados_venda))
+            else:
+                futuro.set_result(dados_venda.upper())
+
+        threading.Timer(0.01 * (len(dados_venda) % 4), _concluir).start()
+        return futuro
+
+    monkeypatch.setattr(cliente, 'enviar_dados_venda_nowait',
+            _enviar_dados_venda_nowait)
+    vendas = ['venda{}'.format(n) for n in range(20)]
+    vendas[3] = 'rejeitada'
+    vendas[7] = 'recusada'
+    resultados = list(cliente.enviar_lote_vendas(vendas, simultaneas=4))
+
+    assert sorted(r.indice for r in resultados) == list(range(20))
+    assert maximo[0] <= 4
+    for resultado in resultados:
+        if resultado.indice in (3, 7):
+            assert resultado.resposta is None
+            assert resultado.erro is not None
+        else:
+            assert resultado.erro is None
+            assert resultado.resposta == vendas[resultado.indice].upper()
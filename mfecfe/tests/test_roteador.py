@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_roteador.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+
+import pytest
+
+from mfecfe.base import BibliotecaSAT
+from mfecfe.clientelocal import ClienteSATLocal
+from mfecfe.excecoes import ErroEquipamentoIndisponivel
+from mfecfe.roteador import RoteadorSAT
+from mfecfe.simulador import SimuladorIntegrador
+
+
+VENDA = (
+        '<CFe><infCFe versaoDadosEnt="0.07">'
+        '<ide><CNPJ>16716114000172</CNPJ><numeroCaixa>{}</numeroCaixa></ide>'
+        '<emit><CNPJ>08723218000186</CNPJ></emit>'
+        '<det nItem="1"><prod><qCom>2.0000</qCom><vUnCom>5.75</vUnCom></prod>'
+        '</det></infCFe></CFe>')
+
+CANCELAMENTO = '<CFeCanc><infCFe/></CFeCanc>'
+
+
+@pytest.fixture
+def equipamentos(tmpdir):
+    simuladores = {}
+    roteador = RoteadorSAT(limite_falhas=1, quarentena=60)
+    for nome, caixa in (('a', 1), ('b', 2)):
+        caminho = str(tmpdir.mkdir(nome))
+        simuladores[nome] = SimuladorIntegrador(caminho, latencia=0.01,
+                codigo_ativacao='12345678')
+        simuladores[nome].iniciar()
+        cliente = ClienteSATLocal(BibliotecaSAT(caminho),
+                codigo_ativacao='12345678', tempo_limite=0.5)
+        roteador.adicionar(nome, cliente, caixas=[caixa])
+    yield roteador, simuladores
+    for simulador in simuladores.values():
+        simulador.parar()
+    roteador.parar()
+
+
+def test_roteia_vendas_pelo_caixa(equipamentos):
+    roteador, _ = equipamentos
+    for caixa, nome in ((1, 'a'), (2, 'b'), (1, 'a')):
+        resposta = roteador.enviar_dados_venda(VENDA.format(caixa))
+        assert resposta.EEEEE == u'06000'
+        assert roteador.emissor(resposta.chaveConsulta).nome == nome
+
+
+def test_venda_de_caixa_sem_vinculo_vai_ao_menos_ocupado(equipamentos):
+    roteador, _ = equipamentos
+    roteador.equipamento('a').iniciar()
+    futuro = roteador.enviar_dados_venda_nowait(VENDA.format(9))
+    resposta = futuro.result(5)
+    assert roteador.emissor(resposta.chaveConsulta).nome == 'b'
+
+
+def test_cancela_no_equipamento_emissor(equipamentos):
+    roteador, _ = equipamentos
+    venda = roteador.enviar_dados_venda(VENDA.format(2))
+    resposta = roteador.cancelar_ultima_venda(venda.chaveConsulta,
+                                              CANCELAMENTO)
+    assert resposta.EEEEE == u'07000'
+
+
+def test_consulta_passa_ao_proximo_equipamento(equipamentos):
+    roteador, simuladores = equipamentos
+    simuladores['a'].parar()
+    assert roteador.consultar_sat().EEEEE == u'08000'
+    saude = dict((s.nome, s) for s in roteador.saude())
+    assert saude['a'].falhas == 1
+    assert not saude['a'].disponivel
+    assert saude['b'].disponivel
+
+    # vendas não são desviadas do equipamento do caixa
+    with pytest.raises(ErroEquipamentoIndisponivel):
+        roteador.enviar_dados_venda(VENDA.format(1))
+    resposta = roteador.enviar_dados_venda(VENDA.format(9))
+    assert roteador.emissor(resposta.chaveConsulta).nome == 'b'
+
+
+class _VendaInvalida(object):
+
+    numeroCaixa = 1
+
+    def documento(self):
+        raise ValueError('valor unitario invalido')
+
+
+def test_venda_invalida_nao_indisponibiliza_equipamento(equipamentos):
+    roteador, _ = equipamentos
+    with pytest.raises(ValueError):
+        roteador.enviar_dados_venda(_VendaInvalida())
+    saude = dict((s.nome, s) for s in roteador.saude())
+    assert saude['a'].falhas == 0
+    assert saude['a'].disponivel
+    resposta = roteador.enviar_dados_venda(VENDA.format(1))
+    assert roteador.emissor(resposta.chaveConsulta).nome == 'a'
+
+
+def test_emissor_pelo_numero_de_serie(tmpdir):
+    roteador = RoteadorSAT()
+    roteador.adicionar('a', ClienteSATLocal(BibliotecaSAT(str(tmpdir))),
+            caixas=[1])
+    roteador.adicionar('b', ClienteSATLocal(BibliotecaSAT(str(tmpdir))),
+            numero_serie='900004019')
+    chave = 'CFe35150708723218000186599000040190000241143484'
+    assert roteador.emissor(chave).nome == 'b'
+    with pytest.raises(ErroEquipamentoIndisponivel):
+        roteador.emissor('CFe' + '0' * 44, CANCELAMENTO)
+    assert roteador.emissor('CFe' + '0' * 44,
+            '<CFeCanc><ide><numeroCaixa>001</numeroCaixa></ide></CFeCanc>'
+            ).nome == 'a'
+    with pytest.raises(ValueError):
+        roteador.adicionar('c', None, caixas=[1])
+
+
+class _ClienteLento(object):
+    # responde à consulta apenas quando liberado, ou falha com ``erro``
+
+    biblioteca = None
+
+    def __init__(self):
+        self.liberar = threading.Event()
+        self.chamadas = 0
+        self.erro = None
+
+    def consultar_sat(self):
+        self.chamadas += 1
+        if self.erro is not None:
+            raise self.erro
+        self.liberar.wait(5)
+        return 'ok'
+
+
+def test_uma_unica_sondagem_apos_quarentena():
+    roteador = RoteadorSAT(limite_falhas=1, quarentena=0.1)
+    cliente = _ClienteLento()
+    equipamento = roteador.adicionar('a', cliente)
+    cliente.erro = IOError('Integrador nao respondeu')
+    with pytest.raises(IOError):
+        roteador.consultar_sat()
+    assert not equipamento.disponivel
+    time.sleep(0.15)
+    assert equipamento.disponivel
+
+    cliente.erro = None
+    respostas = []
+    sondagem = threading.Thread(
+            target=lambda: respostas.append(roteador.consultar_sat()))
+    sondagem.start()
+    limite = time.time() + 5
+    while cliente.chamadas < 2:
+        assert time.time() < limite
+        time.sleep(0.01)
+    assert not equipamento.disponivel
+    with pytest.raises(ErroEquipamentoIndisponivel):
+        roteador.consultar_sat()
+    cliente.liberar.set()
+    sondagem.join(5)
+    assert respostas == ['ok']
+    assert cliente.chamadas == 2
+    assert equipamento.disponivel
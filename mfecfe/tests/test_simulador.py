@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_simulador.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from satcomum.util import modulo11
+
+from mfecfe.base import BibliotecaSAT
+from mfecfe.base import Prazo
+from mfecfe.clientelocal import ClienteSATLocal
+from mfecfe.excecoes import ExcecaoRespostaSAT
+from mfecfe.integrador import ler_resposta
+from mfecfe.simulador import SimuladorIntegrador
+
+
+VENDA = (
+        '<CFe><infCFe versaoDadosEnt="0.07">'
+        '<ide><CNPJ>16716114000172</CNPJ><numeroCaixa>1</numeroCaixa></ide>'
+        '<emit><CNPJ>08723218000186</CNPJ></emit>'
+        '<dest><CPF>11122233396</CPF></dest>'
+        '<det nItem="1"><prod><qCom>2.0000</qCom><vUnCom>5.75</vUnCom></prod>'
+        '</det></infCFe></CFe>')
+
+
+@pytest.fixture
+def cliente(tmpdir):
+    simulador = SimuladorIntegrador(str(tmpdir), latencia=0,
+            codigo_ativacao='12345678', semente=1)
+    simulador.iniciar()
+    biblioteca = BibliotecaSAT(str(tmpdir))
+    yield ClienteSATLocal(biblioteca, codigo_ativacao='12345678',
+            tempo_limite=5)
+    simulador.parar()
+    biblioteca.despachante.parar()
+
+
+def test_responde_no_formato_do_integrador(tmpdir):
+    simulador = SimuladorIntegrador(str(tmpdir))
+    simulador.iniciar()
+    simulador.parar()
+    remessa = tmpdir.join('input', '123-consultarsat.xml')
+    remessa.write('<Integrador><Identificador><Valor>123</Valor>'
+            '</Identificador><Componente Nome="MF-e">'
+            '<Metodo Nome="ConsultarSAT"><Parametros><Parametro>'
+            '<Nome>numeroSessao</Nome><Valor>456</Valor>'
+            '</Parametro></Parametros></Metodo></Componente></Integrador>')
+    resposta = simulador.processar(str(remessa))
+    assert not remessa.check()
+    assert open(resposta, 'rb').read().startswith(b'\xef\xbb\xbf')
+    assert ler_resposta(resposta) == ('123', '456|08000|SAT em operacao|||123')
+
+
+def test_enviar_e_cancelar_venda(cliente):
+    venda = cliente.enviar_dados_venda(VENDA)
+    chave = venda.chaveConsulta[3:]
+    assert venda.EEEEE == u'06000'
+    assert int(chave[-1]) == modulo11(chave[:-1])
+    assert str(venda.valorTotalCFe) == '11.50'
+    assert venda.CPFCNPJValue == u'11122233396'
+
+    retorno = cliente.comando_sat('CancelarUltimaVenda.xml', consulta={
+            'numero_sessao': cliente.gerar_numero_sessao(),
+            'codigo_ativacao': '12345678',
+            'chave_cfe': venda.chaveConsulta,
+            'cfe_canc': '<CFeCanc><infCFe/></CFeCanc>'})
+    assert retorno.split('|')[1] == '07000'
+    assert retorno.split('|')[8] != venda.chaveConsulta
+
+
+def test_consultar_numero_sessao(cliente):
+    cliente.comando_sat('ConsultarSAT.xml', consulta={'numero_sessao': 111222})
+    resposta = cliente.consultar_numero_sessao(111222)
+    assert resposta.EEEEE == u'08000'
+    assert resposta.numeroSessao == 111222
+    inexistente = cliente.comando_sat('ConsultarNumeroSessao.xml',
+            consulta={'numero_sessao': 333444, 'codigo_ativacao': '12345678'})
+    assert inexistente.split('|')[1] == '11003'
+
+
+def test_codigo_ativacao_invalido(cliente):
+    cliente._codigo_ativacao = '87654321'
+    with pytest.raises(ExcecaoRespostaSAT) as excinfo:
+        cliente.bloquear_sat()
+    assert excinfo.value.resposta.EEEEE == u'16001'
+
+
+def test_remessa_perdida(tmpdir):
+    with SimuladorIntegrador(str(tmpdir), latencia=0, taxa_perda=1) as simulador:
+        biblioteca = BibliotecaSAT(str(tmpdir))
+        retorno = ClienteSATLocal(biblioteca).comando_sat('ConsultarSAT.xml',
+                prazo=Prazo(0.3), consulta={'numero_sessao': 1})
+        biblioteca.despachante.parar()
+    assert retorno.split('|')[3] == 'Erro interno'
+    assert simulador.perdidas == 1
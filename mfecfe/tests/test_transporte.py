@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_transporte.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+import requests
+
+from mfecfe.base import BibliotecaSAT
+from mfecfe.base import FuncoesSAT
+from mfecfe.base import TransporteIntegrador
+from mfecfe.clientelocal import ClienteSATLocal
+from mfecfe.clientesathub import ClienteSATHub
+from mfecfe.excecoes import ErroRespostaSATInvalida
+from mfecfe.excecoes import ExcecaoRespostaSAT
+from mfecfe.simulador import SimuladorIntegrador
+from mfecfe.transporte import TransporteDLL
+from mfecfe.transporte import TransporteMemoria
+from mfecfe.transporte import TransporteSATHub
+
+
+RESPOSTAS = {
+        'ConsultarSAT': '{numero_identificador}|08000|SAT em operacao|||'
+                        '{numero_identificador}',
+    }
+
+
+def test_transporte_padrao(tmpdir):
+    cliente = ClienteSATLocal(BibliotecaSAT(str(tmpdir)))
+    assert isinstance(cliente.transporte, TransporteIntegrador)
+    assert cliente.transporte.biblioteca is cliente.biblioteca
+
+
+def test_cliente_sobre_transporte_memoria():
+    transporte = TransporteMemoria(RESPOSTAS)
+    cliente = ClienteSATLocal(None, transporte=transporte)
+    resposta = cliente.consultar_sat()
+    assert resposta.EEEEE == u'08000'
+    assert cliente.consultar_sat_nowait().result(1).EEEEE == u'08000'
+    assert [r[0] for r in transporte.remessas] == ['ConsultarSAT'] * 2
+
+
+def test_transporte_memoria_operacao_desconhecida():
+    cliente = ClienteSATLocal(None, transporte=TransporteMemoria())
+    with pytest.raises(ValueError):
+        cliente.bloquear_sat()
+
+
+class _VendaEmPartes(object):
+    # como satcfe.entidades.CFeVenda, produz o XML inteiro ou em partes
+
+    def __init__(self, itens):
+        self.itens = itens
+        self.produzidas = 0
+
+    def iterar_documento(self):
+        yield ('<CFe><infCFe versaoDadosEnt="0.07"><ide><CNPJ>16716114000172'
+               '</CNPJ><numeroCaixa>001</numeroCaixa></ide><emit><CNPJ>'
+               '08723218000186</CNPJ></emit>')
+        for n in range(self.itens):
+            self.produzidas += 1
+            yield ('<det nItem="{}"><prod><qCom>1.0000</qCom><vUnCom>1.00'
+                   '</vUnCom></prod></det>'.format(n + 1))
+        yield '</infCFe></CFe>'
+
+    def documento(self):
+        return ''.join(self.iterar_documento())
+
+
+def test_venda_em_partes(tmpdir):
+    venda = _VendaEmPartes(itens=2000)
+    with SimuladorIntegrador(str(tmpdir), latencia=0.01,
+                             codigo_ativacao='12345678'):
+        cliente = ClienteSATLocal(BibliotecaSAT(str(tmpdir)),
+                codigo_ativacao='12345678', tempo_limite=5)
+        resposta = cliente.enviar_dados_venda(venda)
+    assert resposta.EEEEE == u'06000'
+    assert venda.produzidas == 2000
+
+    # transportes que não aceitam partes recebem o documento inteiro
+    transporte = TransporteMemoria({'EnviarDadosVenda': '|'.join(
+            ['{numero_identificador}', '06000', '0000', 'Emitido'])})
+    FuncoesSAT(None, transporte=transporte).enviar_dados_venda(venda)
+    assert transporte.remessas[0][2]['cfe_venda'] == venda.documento()
+
+
+class _FuncaoSAT(object):
+
+    def __init__(self, nome, chamadas):
+        self._nome = nome
+        self._chamadas = chamadas
+
+    def __call__(self, *args):
+        self._chamadas.append((self._nome, args))
+        return '{}|08000|SAT em operacao||'.format(args[0])
+
+
+class _BibliotecaFalsa(object):
+
+    def __init__(self):
+        self.chamadas = []
+
+    def __getattr__(self, nome):
+        return _FuncaoSAT(nome, self.chamadas)
+
+
+def test_transporte_dll_ordena_argumentos():
+    transporte = TransporteDLL('libsat.so')
+    biblioteca = _BibliotecaFalsa()
+    transporte._libsat = biblioteca
+    funcoes = FuncoesSAT(None, codigo_ativacao=u'12345678',
+            transporte=transporte)
+    resposta = funcoes.consultar_numero_sessao(123)
+    nome, args = biblioteca.chamadas[0]
+    assert nome == 'ConsultarNumeroSessao'
+    assert args[1:] == (b'12345678', 123)
+    assert resposta == '{}|08000|SAT em operacao||'.format(args[0])
+
+
+class _RespostaHTTP(object):
+
+    def __init__(self, retorno):
+        self._retorno = retorno
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'retorno': self._retorno}
+
+
+class _Documento(object):
+
+    def __init__(self, xml):
+        self._xml = xml
+
+    def documento(self):
+        return self._xml
+
+
+def _postar(metodo, *args, **kwargs):
+    # apenas os dados enviados interessam, não a análise da resposta
+    try:
+        metodo(*args, **kwargs)
+    except (ErroRespostaSATInvalida, ExcecaoRespostaSAT):
+        pass
+
+
+def test_transporte_sathub(monkeypatch):
+    # o transporte deve enviar o mesmo que o ClienteSATHub
+    chamadas = []
+
+    def post(url, data=None, headers=None, timeout=None):
+        chamadas.append((url, dict((k, v) for k, v in data.items()
+                                   if v is not None)))
+        return _RespostaHTTP('1|08000|SAT em operacao||')
+
+    monkeypatch.setattr(requests, 'post', post)
+    monkeypatch.setattr(requests.Session, 'post',
+            lambda sessao, url, **kwargs: post(url, **kwargs))
+    cliente = ClienteSATHub('localhost', 5000, numero_caixa=2)
+    funcoes = FuncoesSAT(None, codigo_ativacao=u'12345678',
+            numerador_sessao=lambda: 77,
+            transporte=TransporteSATHub('localhost', 5000, numero_caixa=2,
+                                        caminho_integrador='/opt/Integrador',
+                                        codigo_ativacao=u'12345678'))
+
+    _postar(cliente.consultar_numero_sessao, 123)
+    _postar(funcoes.consultar_numero_sessao, 123)
+    _postar(cliente.enviar_dados_venda, _Documento('<CFe/>'), u'12345678',
+            integrador='/opt/Integrador', numero_identificador=77)
+    _postar(funcoes.enviar_dados_venda, '<CFe/>')
+    _postar(cliente.cancelar_ultima_venda, 'CFe123',
+            _Documento('<CFeCanc/>'), u'12345678', '/opt/Integrador')
+    _postar(funcoes.cancelar_ultima_venda, 'CFe123', '<CFeCanc/>')
+    _postar(cliente.consultar_sat, 2, u'12345678',
+            integrador='/opt/Integrador')
+    _postar(funcoes.consultar_sat)
+    _postar(cliente.ativar_sat, 1, '08723218000186', 35)
+    _postar(funcoes.ativar_sat, 1, '08723218000186', 35)
+
+    assert len(chamadas) == 10
+    for esperada, enviada in zip(chamadas[::2], chamadas[1::2]):
+        assert enviada == esperada
+    assert chamadas[1] == ('http://localhost:5000/hub/v1/consultarnumerosessao',
+                           {'numero_caixa': 2, 'numero_sessao': 123})
+    assert chamadas[3][1]['dados_venda'] == '<CFe/>'
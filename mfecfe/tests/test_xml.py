@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/tests/test_xml.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import os
+import re
+
+import pytest
+
+from jinja2 import Environment
+from lxml import etree
+
+from mfecfe import filters
+from mfecfe import xml
+
+
+@pytest.fixture
+def compilacoes(monkeypatch):
+    compilados = []
+    compilar = Environment.compile
+
+    def _compile(self, source, name=None, *args, **kwargs):
+        compilados.append(name)
+        return compilar(self, source, name, *args, **kwargs)
+
+    monkeypatch.setattr(Environment, 'compile', _compile)
+    xml.set_bytecode_cache(None)
+    yield compilados
+    xml.set_bytecode_cache(None)
+
+
+def _consultar(numero):
+    return xml.render_bytes(xml.TEMPLATES_PATH, 'ConsultarSAT.xml',
+            numero_identificador=numero, consulta={'numero_sessao': numero})
+
+
+def test_compila_template_uma_unica_vez(compilacoes):
+    primeira = _consultar(1)
+    segunda = _consultar(2)
+    assert compilacoes == ['ConsultarSAT.xml']
+    assert b'<Identificador><Valor>1</Valor>' in primeira
+    assert b'<Identificador><Valor>2</Valor>' in segunda
+    assert xml.get_environment(xml.TEMPLATES_PATH + os.sep, compact=True) \
+            is xml.get_environment(xml.TEMPLATES_PATH, compact=True)
+
+
+def test_warm_up(compilacoes):
+    quantidade = xml.warm_up()
+    assert quantidade == len(compilacoes)
+    assert 'EnviarDadosVenda.xml' in compilacoes
+    _consultar(1)
+    assert len(compilacoes) == quantidade
+
+
+@pytest.mark.parametrize('template,consulta', [
+        ('EnviarDadosVenda.xml', {'numero_sessao': 1, 'codigo_ativacao': '',
+            'cfe_venda': u'<CFe><infCFe><dest/></infCFe>\xe7</CFe>'}),
+        ('TesteFimAFim.xml', {'numero_sessao': 2, 'codigo_ativacao': 'x',
+            'cfe_venda': '<CFe><infCFe versao="0.07">'
+                         '<ide>1</ide><dest/></infCFe></CFe>'}),
+        ('ConsultarSAT.xml', {}),
+    ])
+def test_render_bytes(template, consulta):
+    esperado = etree.tostring(xml.render_xml(xml.TEMPLATES_PATH, template,
+            True, numero_identificador=3, consulta=dict(consulta)),
+            xml_declaration=True, encoding='UTF-8')
+    assert xml.render_bytes(xml.TEMPLATES_PATH, template,
+            numero_identificador=3, consulta=dict(consulta)) == esperado
+
+
+def test_compact_template():
+    assert xml.compact_template(
+            '<?xml version="1.0"?>\n<A>\n  <!-- x -->\n'
+            '  <B Nome="b">{{ b }}</B>\n  <C><D/></C>\n</A>') == (
+            '{% set _v0 %}{{ b }}{% endset %}'
+            '{% set _v0 = _v0|compact_markup %}'
+            '{% if not (_v0) %}<A/>{% endif %}'
+            '{% if _v0 %}<A>{% if _v0 %}<B Nome="b">{{ _v0 }}</B>{% endif %}'
+            '</A>{% endif %}')
+
+
+def _renderizar_e_podar(caminho, template, **dados):
+    # o caminho anterior: renderiza, analisa o documento e remove os vazios
+    texto = xml.get_environment(caminho).get_template(template).render(
+            **xml.recursively_normalize(dados))
+    arvore = etree.fromstring(texto.encode('utf-8'), parser=xml._parser())
+    xml.prune_empty(arvore)
+    return etree.tostring(arvore, xml_declaration=True, encoding='UTF-8')
+
+
+def _templates():
+    for pasta, _, nomes in os.walk(xml.TEMPLATES_PATH):
+        for nome in sorted(nomes):
+            if nome.endswith('.xml'):
+                yield os.path.relpath(os.path.join(pasta, nome),
+                        xml.TEMPLATES_PATH).replace(os.sep, '/')
+
+
+_VALORES = (u'<CFe><dest/><x></x>\xe7</CFe>', 'a &amp; b > c', '7', '')
+
+
+def _dados(template, modo):
+    # preenche as variáveis do template, conforme o modo, com texto simples,
+    # marcação, entidades ou vazio
+    with open(os.path.join(xml.TEMPLATES_PATH, template)) as f:
+        nomes = sorted(set(re.findall(r'\{\{\s*([\w.]+)', f.read())))
+    dados = {}
+    for i, nome in enumerate(nomes):
+        alvo = dados
+        partes = nome.split('.')
+        for parte in partes[:-1]:
+            alvo = alvo.setdefault(parte, {})
+        alvo[partes[-1]] = _VALORES[(i + modo) % len(_VALORES)]
+    return dados
+
+
+@pytest.mark.parametrize('template', list(_templates()))
+@pytest.mark.parametrize('modo', range(len(_VALORES)))
+def test_render_bytes_igual_ao_documento_podado(template, modo):
+    dados = _dados(template, modo)
+    assert xml.render_bytes(xml.TEMPLATES_PATH, template, **dados) == \
+            _renderizar_e_podar(xml.TEMPLATES_PATH, template, **dados)
+
+
+CASOS_LIMITE = {
+        'comentarios.xml': '<A><!-- {{ x }} <B/> --><B>{{ x }}</B>'
+                           '<C>1<!-- c -->2</C><!-- fim --></A>',
+        'cdata.xml': '<A><B><![CDATA[<bruto> & {{ x }}]]></B>'
+                     '<C><![CDATA[{{ x }}]]></C><D><![CDATA[]]></D></A>',
+        'atributos.xml': '<A k=\'1 > 0\'  j="&#233;&amp;"><B t="{}">{{ x }}</B>'
+                         '<C t="x"/></A>',
+        'entidades.xml': '<A><B>1 &gt; 0 &#233; &quot;{{ x }}&quot;</B>'
+                         '<C> </C><D>&lt;</D></A>',
+        'jinja.xml': '<A><B>{% if x > 1 %}grande{% endif %}</B>'
+                     '<C>{{ "<D/>" if x < 2 else "<E>1</E>" }}</C>'
+                     '<F>{# comentario #}</F>{# entre elementos #}</A>',
+    }
+
+
+@pytest.mark.parametrize('template', sorted(CASOS_LIMITE))
+@pytest.mark.parametrize('x', [0, 1, 5])
+def test_render_bytes_casos_limite(tmpdir, template, x):
+    tmpdir.join(template).write(CASOS_LIMITE[template])
+    if template == 'jinja.xml':
+        # comentários entre elementos não são aceitos
+        with pytest.raises(ValueError):
+            xml.render_bytes(str(tmpdir), template, x=x)
+        tmpdir.join(template).write(
+                CASOS_LIMITE[template].replace('{# entre elementos #}', ''))
+        xml.get_environment(str(tmpdir), compact=True).cache.clear()
+    assert xml.render_bytes(str(tmpdir), template, x=x) == \
+            _renderizar_e_podar(str(tmpdir), template, x=x)
+
+
+@pytest.mark.parametrize('fonte', [
+        '<A>{% if x %}<B>1</B>{% endif %}</A>',
+        '<A><B>{% if x %}1</B><C>2{% endif %}</C></A>',
+        '<A>texto<B>1</B></A>',
+        '<A>{{ x }}<B>1</B></A>',
+        '<A><![CDATA[x]]><B>1</B></A>',
+        '<A><?pi x?></A>',
+        '<!DOCTYPE A><A/>',
+        '<A k="{{ x }}"/>',
+        '<A xmlns="urn:x"/>',
+        '<A/><B/>',
+        '{{ x }}<A/>',
+        '<A>{{ x</A>',
+        '<A k="1" k="2"/>',
+        '<A>&desconhecida;</A>',
+    ])
+def test_compact_template_rejeita(fonte):
+    with pytest.raises(ValueError):
+        xml.compact_template(fonte)
+
+
+def test_cache_de_bytecode(tmpdir, compilacoes):
+    xml.set_bytecode_cache(str(tmpdir))
+    xml.warm_up()
+    assert len(tmpdir.listdir()) == len(compilacoes)
+    del compilacoes[:]
+    xml.set_bytecode_cache(str(tmpdir))
+    xml.warm_up()
+    _consultar(1)
+    assert compilacoes == []
+
+
+def test_prune_empty():
+    arvore = etree.fromstring(
+            '<CFe><a/><b><c><d/></c><e>1</e></b><f x="1"><g></g></f>'
+            '<h>2<i/></h></CFe>')
+    xml.prune_empty(arvore)
+    assert etree.tostring(arvore) == b'<CFe><b><e>1</e></b><h>2</h></CFe>'
+
+
+def test_recursively_normalize_nao_altera_os_dados():
+    acucar = u'A\xe7\xfacar'
+    if str is bytes:
+        acucar = acucar.encode('utf-8')
+    itens = [{'xProd': acucar}, {'xProd': 'Sal'}]
+    dados = {'numero_identificador': 7,
+             'consulta': {'cnpj': '08723218000186', 'itens': itens}}
+    normalizados = xml.recursively_normalize(dados)
+    assert normalizados['consulta']['itens'][0]['xProd'] == u'Acucar'
+    assert dados['consulta']['itens'][0]['xProd'] is acucar
+    # apenas o caminho até o valor alterado é copiado
+    assert normalizados['consulta']['itens'][1] is itens[1]
+    assert xml.recursively_normalize(itens[1:])[0] is itens[1]
+    constantes = {'consulta': {'cnpj': '08723218000186'}}
+    assert xml.recursively_normalize(constantes) is constantes
+
+
+def test_normalize_str_memoriza_valores_curtos(monkeypatch):
+    monkeypatch.setattr(filters, '_normalized', collections.OrderedDict())
+    chamadas = []
+    normalizar = filters._normalize_non_ascii
+    monkeypatch.setattr(filters, '_normalize_non_ascii',
+            lambda valor: chamadas.append(valor) or normalizar(valor))
+    ascii = str('35150708723218000186599000040190000241143484')
+    assert filters.normalize_str(ascii) is ascii
+    assert filters.normalize_str(u'Jos\xe9 \xc1vila') == u'Jose Avila'
+    assert filters.normalize_str(u'Jos\xe9 \xc1vila') == u'Jose Avila'
+    longo = u'\xe7' * (filters.NORMALIZE_CACHE_MAX_LENGTH + 1)
+    assert filters.normalize_str(longo) == u'c' * len(longo)
+    assert filters.normalize_str(longo) == u'c' * len(longo)
+    assert chamadas == [u'Jos\xe9 \xc1vila', longo, longo]
+
+
+def test_render_parts():
+    partes = [u'<CFe><infCFe versaoDadosEnt="0.07"><det nItem="1">',
+              u'<prod><xProd>A\xe7\xfacar</xProd></prod>', u'</det></infCFe>',
+              u'</CFe>']
+    produzidas = []
+
+    def produzir():
+        for parte in partes:
+            produzidas.append(parte)
+            yield parte
+
+    consulta = {'numero_sessao': 1, 'codigo_ativacao': '12345678',
+                'numero_documento': 10}
+    documento = xml.render_bytes(xml.TEMPLATES_PATH, 'EnviarDadosVenda.xml',
+            numero_identificador=1,
+            consulta=dict(consulta, cfe_venda=u''.join(partes)))
+    consulta['cfe_venda'] = xml.Chunks(produzir)
+    renderizadas = xml.render_parts(xml.TEMPLATES_PATH, 'EnviarDadosVenda.xml',
+            numero_identificador=1, consulta=consulta)
+    assert len(renderizadas) == 3
+    assert produzidas == []
+
+    # cada parte é produzida apenas quando chega a vez de escrevê-la
+    escritas = xml.iter_bytes(renderizadas)
+    inicio = [next(escritas)]
+    assert produzidas == []
+    inicio.append(next(escritas))
+    assert produzidas == partes[:1]
+    assert b''.join(inicio + list(escritas)) == documento
+    # as partes são produzidas novamente a cada renderização
+    assert b''.join(xml.iter_bytes(renderizadas)) == documento
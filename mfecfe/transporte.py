@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+#
+# mfecfe/transporte.py
+#
+# Copyright 2015 Base4 Sistemas Ltda ME
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Transportes através dos quais :class:`~mfecfe.base.FuncoesSAT` e
+:class:`~mfecfe.base.FuncoesVFPE` entregam os comandos e obtêm as respostas
+*verbatim*. O transporte padrão é a troca de arquivos com o Integrador Fiscal
+(:class:`~mfecfe.base.TransporteIntegrador`), mas o mesmo cliente, e a mesma
+análise das respostas, funcionam sobre qualquer transporte:
+
+.. sourcecode:: python
+
+    cliente = ClienteSATLocal(None,
+            codigo_ativacao='12345678',
+            transporte=TransporteDLL('/usr/lib/libsat.so'))
+
+    resposta = cliente.consultar_sat()
+
+"""
+
+import ctypes
+import os
+import threading
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from ctypes import c_int
+from ctypes import c_char_p
+
+import requests
+
+from satcomum import constantes
+
+import satcfe
+
+
+class _Prototype(object):
+    def __init__(self, argtypes, restype=c_char_p):
+        self.argtypes = argtypes
+        self.restype = restype
+
+
+FUNCTION_PROTOTYPES = dict(
+        AtivarSAT=_Prototype([c_int, c_int, c_char_p, c_char_p, c_int]),
+        ComunicarCertificadoICPBRASIL=_Prototype([c_int, c_char_p, c_char_p]),
+        EnviarDadosVenda=_Prototype([c_int, c_char_p, c_char_p]),
+        CancelarUltimaVenda=_Prototype([c_int, c_char_p, c_char_p, c_char_p]),
+        ConsultarSAT=_Prototype([c_int,]),
+        TesteFimAFim=_Prototype([c_int, c_char_p, c_char_p]),
+        ConsultarStatusOperacional=_Prototype([c_int, c_char_p]),
+        ConsultarNumeroSessao=_Prototype([c_int, c_char_p, c_int]),
+        ConfigurarInterfaceDeRede=_Prototype([c_int, c_char_p, c_char_p]),
+        AssociarAssinatura=_Prototype([c_int, c_char_p, c_char_p, c_char_p]),
+        AtualizarSoftwareSAT=_Prototype([c_int, c_char_p]),
+        ExtrairLogs=_Prototype([c_int, c_char_p]),
+        BloquearSAT=_Prototype([c_int, c_char_p]),
+        DesbloquearSAT=_Prototype([c_int, c_char_p]),
+        TrocarCodigoDeAtivacao=_Prototype([c_int, c_char_p, c_int, c_char_p, c_char_p])
+    )
+
+
+ARGUMENTOS_DLL = dict(
+        AtivarSAT=('tipo_certificado', 'codigo_ativacao', 'cnpj', 'codigo_uf'),
+        ComunicarCertificadoICPBRASIL=('codigo_ativacao', 'certificado'),
+        EnviarDadosVenda=('codigo_ativacao', 'cfe_venda'),
+        CancelarUltimaVenda=('codigo_ativacao', 'chave_cfe', 'cfe_canc'),
+        ConsultarSAT=(),
+        TesteFimAFim=('codigo_ativacao', 'cfe_venda'),
+        ConsultarStatusOperacional=('codigo_ativacao',),
+        ConsultarNumeroSessao=('codigo_ativacao', 'numero_sessao'),
+        ConfigurarInterfaceDeRede=('codigo_ativacao', 'configuracao'),
+        AssociarAssinatura=('codigo_ativacao', 'sequencia_cnpj', 'assinatura_ac'),
+        AtualizarSoftwareSAT=('codigo_ativacao',),
+        ExtrairLogs=('codigo_ativacao',),
+        BloquearSAT=('codigo_ativacao',),
+        DesbloquearSAT=('codigo_ativacao',),
+        TrocarCodigoDeAtivacao=('codigo_ativacao', 'opcao',
+                'novo_codigo_ativacao', 'novo_codigo_ativacao'),
+    )
+"""Argumentos das funções da biblioteca SAT, após o número de sessão, na
+ordem em que são informados, conforme as chaves da consulta montada pelos
+métodos de :class:`~mfecfe.base.FuncoesSAT`.
+"""
+
+
+def nome_operacao(template):
+    """Obtém o nome da operação a partir do nome do template da remessa.
+
+    .. sourcecode:: python
+
+        >>> nome_operacao('ConsultarSAT.xml')
+        'ConsultarSAT'
+    """
+    return os.path.splitext(os.path.basename(template))[0]
+
+
+class Transporte(object):
+    """Interface dos transportes. Cada transporte deve implementar
+    :meth:`comando`, que recebe o nome do template da remessa (que identifica
+    a operação), o número identificador, o :class:`~mfecfe.base.Prazo` e os
+    argumentos do comando (normalmente, apenas ``consulta``), resultando na
+    resposta *verbatim*.
+
+    A implementação padrão de :meth:`comando_nowait` executa :meth:`comando`
+    em um *pool* de :attr:`TRABALHADORES` *threads*, criado apenas quando
+    necessário.
+
+    Os transportes que aceitam documentos produzidos aos poucos
+    (:class:`~mfecfe.xml.Chunks`) nos argumentos do comando indicam isso
+    em :attr:`DOCUMENTOS_EM_PARTES`; os demais recebem apenas strings.
+    """
+
+    TRABALHADORES = 4
+
+    DOCUMENTOS_EM_PARTES = False
+
+    def __init__(self):
+        self._executor = None
+        self._lock_executor = threading.Lock()
+
+
+    def comando(self, template, numero_identificador, prazo, **kwargs):
+        raise NotImplementedError()
+
+
+    def comando_nowait(self, template, numero_identificador, prazo, **kwargs):
+        """Variante de :meth:`comando` que não aguarda pela resposta.
+
+        :rtype: concurrent.futures.Future
+        """
+        with self._lock_executor:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.TRABALHADORES)
+        return self._executor.submit(self.comando,
+                template, numero_identificador, prazo, **kwargs)
+
+
+    def parar(self):
+        """Libera os recursos mantidos pelo transporte."""
+        with self._lock_executor:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+class TransporteMemoria(Transporte):
+    """Transporte em memória, útil em testes e para medir o custo do próprio
+    cliente, sem qualquer equipamento ou Integrador.
+
+    .. sourcecode:: python
+
+        >>> transporte = TransporteMemoria({
+        ...         'ConsultarSAT': '{numero_identificador}|08000|SAT em operacao||'})
+        >>> transporte.comando('ConsultarSAT.xml', 123, 1, consulta={})
+        '123|08000|SAT em operacao||'
+        >>> transporte.remessas
+        [('ConsultarSAT', 123, {})]
+
+    :param dict respostas: Respostas por nome da operação. Cada resposta pode
+        ser uma string, formatada com os argumentos ``numero_identificador``
+        e os da consulta, ou um ``callable`` que recebe o número
+        identificador e a consulta e resulta na resposta *verbatim*.
+    """
+
+    def __init__(self, respostas=None):
+        super(TransporteMemoria, self).__init__()
+        self._respostas = {}
+        for operacao, resposta in (respostas or {}).items():
+            self._respostas[operacao.lower()] = resposta
+        self.remessas = []
+
+
+    def comando(self, template, numero_identificador, prazo, **kwargs):
+        operacao = nome_operacao(template)
+        consulta = kwargs.get('consulta', {})
+        self.remessas.append((operacao, numero_identificador, consulta))
+        try:
+            resposta = self._respostas[operacao.lower()]
+        except KeyError:
+            raise ValueError('Operacao sem resposta definida: {!r}'.format(
+                    operacao))
+        if callable(resposta):
+            return resposta(numero_identificador, consulta)
+        argumentos = dict(consulta)
+        argumentos['numero_identificador'] = numero_identificador
+        return resposta.format(**argumentos)
+
+
+    def comando_nowait(self, template, numero_identificador, prazo, **kwargs):
+        futuro = Future()
+        futuro.set_running_or_notify_cancel()
+        try:
+            futuro.set_result(self.comando(
+                    template, numero_identificador, prazo, **kwargs))
+        except Exception as e:
+            futuro.set_exception(e)
+        return futuro
+
+
+class TransporteDLL(Transporte):
+    """Transporte que invoca diretamente as funções da biblioteca SAT (DLL ou
+    *shared library*) no próprio processo, conforme os protótipos de
+    :attr:`FUNCTION_PROTOTYPES`. O número identificador é usado como número
+    de sessão. As invocações são serializadas, já que as bibliotecas SAT não
+    são, em geral, seguras para uso por várias *threads*. O prazo não é
+    considerado, pois a invocação não pode ser interrompida.
+
+    :param str caminho: Caminho completo para a biblioteca SAT.
+
+    :param int convencao: Opcional. Convenção de chamada, como em
+        :class:`~mfecfe.base.BibliotecaSAT`.
+    """
+
+    def __init__(self, caminho, convencao=None):
+        super(TransporteDLL, self).__init__()
+        self._caminho = caminho
+        self._convencao = convencao
+        self._libsat = None
+        self._lock = threading.Lock()
+        self._funcoes = dict((nome.lower(), nome) for nome in ARGUMENTOS_DLL)
+
+
+    def _carregar(self):
+        if self._convencao is None:
+            if self._caminho.endswith(('.DLL', '.dll')):
+                self._convencao = constantes.WINDOWS_STDCALL
+            else:
+                self._convencao = constantes.STANDARD_C
+
+        if self._convencao == constantes.STANDARD_C:
+            loader = ctypes.CDLL
+
+        elif self._convencao == constantes.WINDOWS_STDCALL:
+            loader = ctypes.WinDLL
+
+        else:
+            raise ValueError('Convencao de chamada desconhecida: {!r}'.format(
+                    self._convencao))
+
+        self._libsat = loader(self._caminho)
+
+
+    def comando(self, template, numero_identificador, prazo, **kwargs):
+        operacao = nome_operacao(template)
+        try:
+            funcao = self._funcoes[operacao.lower()]
+        except KeyError:
+            raise ValueError('Operacao nao suportada pela biblioteca SAT: '
+                    '{!r}'.format(operacao))
+        consulta = kwargs.get('consulta', {})
+        proto = FUNCTION_PROTOTYPES[funcao]
+        valores = [numero_identificador] + \
+                [consulta[nome] for nome in ARGUMENTOS_DLL[funcao]]
+        argumentos = [_argumento_c(tipo, valor)
+                for tipo, valor in zip(proto.argtypes, valores)]
+        with self._lock:
+            if self._libsat is None:
+                self._carregar()
+            fptr = getattr(self._libsat, funcao)
+            fptr.argtypes = proto.argtypes
+            fptr.restype = proto.restype
+            resposta = fptr(*argumentos)
+        if not isinstance(resposta, str):
+            resposta = resposta.decode('utf-8')
+        return resposta
+
+
+def _argumento_c(tipo, valor):
+    if tipo is c_int:
+        return int(valor)
+    if not isinstance(valor, bytes):
+        valor = u'{}'.format(valor).encode('utf-8')
+    return valor
+
+
+class TransporteSATHub(Transporte):
+    """Transporte sobre a API RESTful `SATHub`_, com o mesmo protocolo de
+    :class:`~mfecfe.clientesathub.ClienteSATHub`. O nome da operação, em
+    letras minúsculas, determina o serviço invocado e os campos enviados em
+    cada serviço são os mesmos do cliente (veja :attr:`CAMPOS`), obtidos da
+    consulta, exceto pelo número identificador do próprio comando e pelo
+    caminho do Integrador. A conexão HTTP é reaproveitada entre as
+    invocações.
+
+    :param string host: Nome ou endereço IP do host para o SATHub.
+
+    :param integer port: Número da porta pela qual o HTTPd responde.
+
+    :param integer numero_caixa: Número do caixa, conforme atributo ``B14`` do
+        item 4.2.2 da ER SAT.
+
+    :param string baseurl: Opcional. Prefixo base da URL para os serviços da
+        API RESTful.
+
+    :param caminho_integrador: Opcional. Enviado como ``caminho_integrador``,
+        como o argumento ``integrador`` de
+        :class:`~mfecfe.clientesathub.ClienteSATHub`.
+
+    :param string codigo_ativacao: Opcional. Código de ativação enviado nas
+        operações cuja consulta não o contém (como ``ConsultarSAT``).
+
+    .. _`SATHub`: https://github.com/base4sistemas/sathub
+    """
+
+    CAMPOS = dict(
+            AtivarSAT=('tipo_certificado', 'cnpj', 'codigo_uf'),
+            ComunicarCertificadoICPBRASIL=('certificado',),
+            EnviarDadosVenda=('dados_venda', 'codigo_ativacao',
+                    'caminho_integrador', 'numero_identificador'),
+            CancelarUltimaVenda=('chave_cfe', 'dados_cancelamento',
+                    'codigo_ativacao', 'caminho_integrador'),
+            ConsultarSAT=('codigo_ativacao', 'caminho_integrador'),
+            TesteFimAFim=('dados_venda',),
+            ConsultarStatusOperacional=(),
+            ConsultarNumeroSessao=('numero_sessao',),
+            ConfigurarInterfaceDeRede=('configuracao',),
+            AssociarAssinatura=('sequencia_cnpj', 'assinatura_ac'),
+            AtualizarSoftwareSAT=(),
+            ExtrairLogs=(),
+            BloquearSAT=(),
+            DesbloquearSAT=(),
+            TrocarCodigoDeAtivacao=('novo_codigo_ativacao', 'opcao',
+                    'codigo_emergencia'),
+        )
+    """Campos enviados em cada operação, além do ``numero_caixa``, conforme
+    os serviços invocados por :class:`~mfecfe.clientesathub.ClienteSATHub`.
+    """
+
+    RENOMEADOS = dict(cfe_venda='dados_venda', cfe_canc='dados_cancelamento')
+
+    def __init__(self, host, port, numero_caixa=1, baseurl='/hub/v1',
+                 caminho_integrador=False, codigo_ativacao=None):
+        super(TransporteSATHub, self).__init__()
+        self._host = host
+        self._port = port
+        self._numero_caixa = numero_caixa
+        self._baseurl = baseurl
+        self._caminho_integrador = caminho_integrador
+        self._codigo_ativacao = codigo_ativacao
+        self._campos = dict((nome.lower(), campos)
+                for nome, campos in self.CAMPOS.items())
+        # compartilhada pelas threads que invocam comando()
+        self._sessao = requests.Session()
+        self._sessao.headers['user-agent'] = 'satcfe/{}/ER-{}'.format(
+                satcfe.__version__, satcfe.VERSAO_ER)
+
+
+    def _url(self, metodo):
+        return 'http://{}:{}/{}/{}'.format(
+            self._host,
+            self._port,
+            self._baseurl.strip('/'), metodo)
+
+
+    def dados(self, operacao, numero_identificador, consulta):
+        """Monta os dados do formulário enviados ao SATHub para a operação.
+
+        :rtype: dict
+        """
+        valores = dict(codigo_ativacao=self._codigo_ativacao,
+                caminho_integrador=self._caminho_integrador)
+        for nome, valor in consulta.items():
+            valores[self.RENOMEADOS.get(nome, nome)] = valor
+        valores['numero_identificador'] = numero_identificador
+        payload = {'numero_caixa': self._numero_caixa}
+        for campo in self._campos[operacao.lower()]:
+            payload[campo] = valores.get(campo)
+        return payload
+
+
+    def comando(self, template, numero_identificador, prazo, **kwargs):
+        operacao = nome_operacao(template)
+        if operacao.lower() not in self._campos:
+            raise ValueError('Operacao nao suportada pelo SATHub: '
+                    '{!r}'.format(operacao))
+        resp = self._sessao.post(
+                self._url(operacao.lower()),
+                data=self.dados(operacao, numero_identificador,
+                                kwargs.get('consulta', {})),
+                timeout=getattr(prazo, 'tempo_limite', prazo))
+        resp.raise_for_status()
+        return resp.json().get('retorno')
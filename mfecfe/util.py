@@ -17,6 +17,8 @@
 # limitations under the License.
 #
 
+import _strptime  # noqa: importado antes das threads (bug 7980 do Python 2)
+
 from datetime import datetime
 from unidecode import unidecode
 
@@ -2,50 +2,336 @@
 # © 2016 Danimar Ribeiro, Trustcode
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import os
+import re
+import threading
+import uuid
+
 from lxml import etree
 
 from lxml import objectify
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from jinja2 import TemplateSyntaxError
 from . import filters
 
 
+TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), 'templates')
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+_TOKENS = re.compile(
+    r'<!--.*?-->'
+    r'|<\?(?P<pi>.*?)\?>'
+    r'|<!\[CDATA\[(?P<cdata>.*?)\]\]>'
+    r'|</(?P<end>[^\s>]+)\s*>'
+    r'|<(?P<start>[^\s/>!?]+)(?P<attrs>(?:[^>"\'{]|"[^"]*"|\'[^\']*\')*?)'
+    r'(?P<empty>/?)>'
+    # Jinja tags are taken whole, so that they may contain < and >
+    r'|(?P<text>(?:\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\}|[^<{]+|\{(?![{%#]))+)',
+    re.S)
+
+_JINJA = ('{{', '{%', '{#')
+
+# checks the syntax of the template text taken by compact_template
+_SYNTAX = Environment(extensions=['jinja2.ext.with_'])
+
+_environments = {}
+_environments_lock = threading.Lock()
+_bytecode_cache = None
+
+
+def set_bytecode_cache(directory):
+    """Stores the compiled templates in ``directory`` (or disables the
+    on-disk cache if ``None``), so that new processes skip the compilation.
+    Environments created before the call are discarded.
+    """
+    global _bytecode_cache
+    with _environments_lock:
+        _bytecode_cache = None if directory is None \
+                else FileSystemBytecodeCache(directory)
+        _environments.clear()
+
+
+class _Element(object):
+
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = _attributes(attrs)
+        self.children = []
+
+
+class _Text(object):
+
+    def __init__(self, text, cdata):
+        self.text = text
+        self.cdata = cdata
+        self.var = None
+
+
+def _has_jinja(text):
+    return any(tag in text for tag in _JINJA)
+
+
+def _attributes(attrs):
+    # serialized as lxml does, as the rendered document is never parsed
+    if not attrs.strip():
+        return ''
+    if _has_jinja(attrs):
+        raise ValueError('Template tags in attributes are not supported')
+    if 'xmlns' in attrs:
+        raise ValueError('Namespace declarations are not supported')
+    try:
+        element = etree.fromstring(u'<_ {}/>'.format(attrs))
+    except etree.XMLSyntaxError as e:
+        raise ValueError('Invalid attributes {!r}: {}'.format(attrs, e))
+    return etree.tostring(element, encoding='unicode')[2:-2]
+
+
+def _static_text(text):
+    # serialized as lxml does (e.g. > as &gt;, &#233; as the character)
+    try:
+        return compact_markup(text)
+    except etree.XMLSyntaxError as e:
+        raise ValueError('Invalid text {!r}: {}'.format(text, e))
+
+
+def _parse(source):
+    root = _Element(None, '')
+    stack = [root]
+    position = 0
+    for match in _TOKENS.finditer(source):
+        if match.start() != position:
+            break
+        position = match.end()
+        if match.group('pi') is not None:
+            if match.start() or not match.group('pi').startswith('xml '):
+                raise ValueError('Processing instructions are not supported')
+        elif match.group('start'):
+            element = _Element(match.group('start'),
+                               match.group('attrs').rstrip())
+            stack[-1].children.append(element)
+            if not match.group('empty'):
+                stack.append(element)
+        elif match.group('end'):
+            if len(stack) < 2 or stack[-1].tag != match.group('end'):
+                raise ValueError(
+                    'Unexpected </{}>'.format(match.group('end')))
+            stack.pop()
+        elif match.group('cdata') is not None:
+            stack[-1].children.append(_Text(match.group('cdata'), True))
+        elif match.group('text') is not None:
+            stack[-1].children.append(_Text(match.group('text'), False))
+    if position != len(source):
+        raise ValueError('Unsupported markup at {!r}'.format(
+            source[position:position + 20]))
+    if len(stack) != 1:
+        raise ValueError('Unclosed <{}>'.format(stack[-1].tag))
+    return root
+
+
+def _condition(node, variables):
+    # True if the node is never empty, False if it is always empty or the
+    # list of variables whose rendered text keeps it
+    if isinstance(node, _Text):
+        if _has_jinja(node.text):
+            node.var = '_v{}'.format(len(variables))
+            variables.append(node)
+            return [node.var]
+        return bool(node.text)
+    if any(isinstance(c, _Element) for c in node.children):
+        # blank text between elements is ignorable, as in XMLParser with
+        # remove_blank_text=True; any other text would be mixed content
+        for child in node.children:
+            if isinstance(child, _Element):
+                continue
+            if not child.cdata and not child.text.strip():
+                child.text = ''
+            elif not child.cdata and '{%' in child.text:
+                raise ValueError('Block tags must be inside an element')
+            else:
+                raise ValueError('Mixed content is not supported: {!r}'.format(
+                    child.text))
+    keep = []
+    for child in node.children:
+        condition = _condition(child, variables)
+        child.condition = condition
+        if condition is True:
+            keep = True
+        elif condition and keep is not True:
+            keep.extend(condition)
+    return keep or False
+
+
+def _emit(node, out):
+    if isinstance(node, _Text):
+        if node.var:
+            text = '{{{{ {} }}}}'.format(node.var)
+        else:
+            text = node.text if node.cdata else _static_text(node.text)
+        out.append(u'<![CDATA[{}]]>'.format(text) if node.cdata else text)
+        return
+    if node.condition is False:
+        return
+    if node.condition is not True:
+        out.append('{{% if {} %}}'.format(' or '.join(node.condition)))
+    out.append(u'<{}{}>'.format(node.tag, node.attrs))
+    for child in node.children:
+        _emit(child, out)
+    out.append(u'</{}>'.format(node.tag))
+    if node.condition is not True:
+        out.append('{% endif %}')
+
+
+def compact_template(source):
+    """Rewrites an XML template so that it renders the compact document, with
+    no comments, no blank text between elements and no empty elements, as
+    :func:`render_xml` produces with ``remove_empty``. Each expression is
+    rendered once, ahead of the document, and elements are emitted only if
+    some expression inside them is not empty.
+
+    Only a subset of XML is supported, and anything outside it raises
+    ``ValueError``: a single root element, optionally preceded by the XML
+    declaration; no processing instructions, DOCTYPE or namespace
+    declarations; no mixed content (text, CDATA or template tags beside
+    child elements); and no template tags in attributes. Block tags
+    (``{% %}``) must be confined to the text of an element.
+    """
+    root = _parse(source)
+    variables = []
+    elements = [c for c in root.children if isinstance(c, _Element)]
+    if len(elements) != 1 or any(c.cdata or c.text.strip()
+            for c in root.children if isinstance(c, _Text)):
+        raise ValueError('Expected a single root element')
+    for child in root.children:
+        child.condition = _condition(child, variables)
+    for text in variables:
+        try:
+            _SYNTAX.parse(text.text)
+        except TemplateSyntaxError as e:
+            raise ValueError('Template tags must be closed inside the text '
+                             'of an element: {!r} ({})'.format(text.text, e))
+    out = []
+    for text in variables:
+        out.append('{{% set {} %}}{}{{% endset %}}'.format(
+            text.var, text.text))
+        if not text.cdata:
+            # markup in the value is compacted as if it were in the template
+            out.append('{{% set {0} = {0}|compact_markup %}}'.format(
+                text.var))
+    for child in root.children:
+        if isinstance(child, _Element):
+            # the root element is kept even if empty
+            if child.condition is not True:
+                out.append(u'{{% if not ({}) %}}<{}{}/>{{% endif %}}'.format(
+                    ' or '.join(child.condition or ['false']), child.tag,
+                    child.attrs))
+            _emit(child, out)
+    return ''.join(out)
+
+
+def compact_markup(text):
+    """Compacts the markup in a value rendered outside a CDATA section,
+    removing blank text and empty elements. Plain text is returned as is.
+    """
+    if '<' not in text and '>' not in text and '&' not in text:
+        return text
+    wrapper = etree.fromstring(u'<_>{}</_>'.format(text), parser=_parser())
+    prune_empty(wrapper)
+    # the text is escaped as lxml does (& as &amp;, > as &gt;)
+    markup = etree.tostring(wrapper, encoding='unicode')
+    return u'' if markup == u'<_/>' else markup[3:-4]
+
+
+class CompactLoader(FileSystemLoader):
+    """Loads the templates rewritten by :func:`compact_template`."""
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super(CompactLoader, self).get_source(
+            environment, template)
+        return compact_template(source), filename, uptodate
+
+
+def get_environment(path, compact=False):
+    """Returns the process-wide environment for the templates in ``path``.
+    Templates are compiled once, on first use, and are never reloaded. If
+    ``compact``, the templates are loaded through :class:`CompactLoader`.
+    """
+    key = (os.path.normpath(os.path.abspath(path)), compact)
+    env = _environments.get(key)
+    if env is None:
+        with _environments_lock:
+            env = _environments.get(key)
+            if env is None:
+                loader = CompactLoader if compact else FileSystemLoader
+                env = Environment(
+                    loader=loader(key[0]),
+                    extensions=['jinja2.ext.with_'],
+                    bytecode_cache=_bytecode_cache,
+                    auto_reload=False,
+                    cache_size=-1)
+                env.filters["normalize"] = filters.strip_line_feed
+                env.filters["normalize_str"] = filters.normalize_str
+                env.filters["format_percent"] = filters.format_percent
+                env.filters["format_datetime"] = filters.format_datetime
+                env.filters["format_date"] = filters.format_date
+                env.filters["compact_markup"] = compact_markup
+                _environments[key] = env
+    return env
+
+
+def warm_up(path=TEMPLATES_PATH, compact=True):
+    """Compiles the ``.xml`` templates at the top of ``path`` ahead of the
+    first command (by default, as used by :func:`render_bytes`) and returns
+    how many were compiled.
+    """
+    env = get_environment(path, compact=compact)
+    names = env.list_templates(
+        filter_func=lambda name: '/' not in name and name.endswith('.xml'))
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
 def recursively_empty(e):
     if e.text:
         return False
     return all((recursively_empty(c) for c in e.iterchildren()))
 
 
-def render_xml(path, template_name, remove_empty, **data):
-    data = recursively_normalize(data)
-    env = Environment(
-        loader=FileSystemLoader(path), extensions=['jinja2.ext.with_'])
-
-    env.filters["normalize"] = filters.strip_line_feed
-    env.filters["normalize_str"] = filters.normalize_str
-    env.filters["format_percent"] = filters.format_percent
-    env.filters["format_datetime"] = filters.format_datetime
-    env.filters["format_date"] = filters.format_date
-
-    template = env.get_template(template_name)
-
-    xml = template.render(**data)
-    parser = etree.XMLParser(
+def _parser():
+    return etree.XMLParser(
         ns_clean=True,
         remove_blank_text=True,
         remove_comments=True,
         compact=True,
         strip_cdata=False
     )
+
+
+def prune_empty(tree):
+    """Removes, in a single post-order pass, the elements below the root
+    of ``tree`` that have no text and no remaining children. Since the
+    descendants are visited first, an element is empty exactly when
+    :func:`recursively_empty` would say so, without rescanning its subtree.
+    """
+    for dummy, elem in etree.iterwalk(tree, events=('end',)):
+        if not elem.text and not len(elem):
+            parent = elem.getparent()
+            if parent is not None:
+                parent.remove(elem)
+
+
+def render_xml(path, template_name, remove_empty, **data):
+    data = recursively_normalize(data)
+    template = get_environment(path).get_template(template_name)
+
+    xml = template.render(**data)
     tree = etree.fromstring(
         xml,
-        parser=parser
+        parser=_parser()
     )
     if remove_empty:
-        context = etree.iterwalk(tree)
-        for dummy, elem in context:
-            parent = elem.getparent()
-            if recursively_empty(elem):
-                parent.remove(elem)
+        prune_empty(tree)
         return etree.ElementTree(tree)
     for element in tree.iter("*"):  # remove espaços em branco
         if element.text is not None and not element.text.strip():
@@ -53,6 +339,97 @@ def render_xml(path, template_name, remove_empty, **data):
     return etree.ElementTree(tree)
 
 
+def render_bytes(path, template_name, **data):
+    """Renders the template straight to the UTF-8 encoded document, with the
+    XML declaration, in a single pass. The result is the same as serializing
+    ``render_xml(path, template_name, True, **data)``, without parsing the
+    rendered text back.
+    """
+    data = recursively_normalize(data)
+    template = get_environment(path, compact=True).get_template(template_name)
+    return XML_DECLARATION + template.render(**data).encode('utf-8')
+
+
+class Chunks(object):
+    """A value that :func:`render_parts` leaves out of the rendering, to be
+    written piece by piece by :func:`iter_bytes`, so that a large document
+    embedded in the remessa (e.g. a CF-e with thousands of items) is never
+    held whole in memory. It must be rendered inside a CDATA section, since
+    the pieces are written verbatim.
+
+    :param factory: Callable returning a new iterable of the text pieces on
+        each call, so that the value can be rendered more than once (e.g. on
+        retries).
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __iter__(self):
+        return iter(self.factory())
+
+
+_CHUNKS_MARK = 'mfecfe-chunks-{}-'.format(uuid.uuid4().hex)
+
+_CHUNKS_PLACEHOLDER = re.compile(
+    r'{}(\d+)\.'.format(_CHUNKS_MARK).encode('ascii'))
+
+
+def _replace_chunks(vals, found):
+    # as recursively_normalize, copies only the containers that change
+    if isinstance(vals, Chunks):
+        found.append(vals)
+        return '{}{}.'.format(_CHUNKS_MARK, len(found) - 1)
+    if type(vals) is dict:
+        items = vals.items()
+    elif type(vals) is list:
+        items = enumerate(vals)
+    else:
+        return vals
+    copy = None
+    for key, value in items:
+        replaced = _replace_chunks(value, found)
+        if replaced is not value:
+            if copy is None:
+                copy = type(vals)(vals)
+            copy[key] = replaced
+    return vals if copy is None else copy
+
+
+def render_parts(path, template_name, **data):
+    """Renders the template as :func:`render_bytes` does, except for the
+    :class:`Chunks` values, which are not rendered yet. Returns the list of
+    the rendered bytes and the :class:`Chunks`, in document order, which
+    :func:`iter_bytes` turns into the document.
+    """
+    found = []
+    data = _replace_chunks(data, found)
+    document = render_bytes(path, template_name, **data)
+    if not found:
+        return [document]
+    pieces = _CHUNKS_PLACEHOLDER.split(document)
+    parts = [pieces[0]]
+    for i in range(1, len(pieces), 2):
+        parts.append(found[int(pieces[i])])
+        parts.append(pieces[i + 1])
+    return parts
+
+
+def iter_bytes(parts):
+    """Yields the document from the parts returned by :func:`render_parts`,
+    one piece at a time. The pieces of :class:`Chunks` are normalized as
+    the other values and encoded as they are produced.
+    """
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+            continue
+        for piece in part:
+            if type(piece) is str:
+                piece = filters.normalize_str(piece)
+            yield piece if isinstance(piece, bytes) else piece.encode('utf-8')
+
+
 def sanitize_response(response):
     tree = etree.fromstring(response)
     # Remove namespaces inuteis na resposta
@@ -67,12 +444,24 @@ def sanitize_response(response):
 
 
 def recursively_normalize(vals):
-    for item in vals:
-        if type(vals[item]) is str:
-            vals[item] = filters.normalize_str(vals[item])
-        elif type(vals[item]) is dict:
-            recursively_normalize(vals[item])
-        elif type(vals[item]) is list:
-            for a in vals[item]:
-                recursively_normalize(a)
-    return vals
+    """Returns ``vals`` with its strings normalized by
+    :func:`~mfecfe.filters.normalize_str`, without changing ``vals``. Only
+    the dicts and lists with changed strings are copied; otherwise, the
+    same objects are returned.
+    """
+    if type(vals) is str:
+        return filters.normalize_str(vals)
+    if type(vals) is dict:
+        items = vals.items()
+    elif type(vals) is list:
+        items = enumerate(vals)
+    else:
+        return vals
+    copy = None
+    for key, value in items:
+        normalized = recursively_normalize(value)
+        if normalized is not value:
+            if copy is None:
+                copy = type(vals)(vals)
+            copy[key] = normalized
+    return vals if copy is None else copy
@@ -86,6 +86,10 @@ setup(
                 'testing': [
                         'pytest',
                         'pytest-cov',
+                        'watchdog==0.8.3',
+                    ],
+                'watchdog': [
+                        'watchdog==0.8.3',
                     ],
             },
         tests_require=['pytest'],